@@ -1,38 +1,202 @@
-from flask import Flask, jsonify, request
+# The development server (python api.py) loads .env before the services are imported, as wsgi.py
+# does for WSGI servers: they read their settings (pool sizes, concurrency, DB path) at import
+if __name__ == '__main__':
+	from dotenv import load_dotenv
+	load_dotenv()
+
+from flask import Blueprint, Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
-from services.subaccount_service import SubaccountService
-from services.phone_number_service import PhoneNumberService
-from services.conversations_service import ConversationsService
+from werkzeug.local import LocalProxy
+from services.phone_number_service import PhoneNumberService, SEARCH_LIMIT
+from services.conversations_service import ConversationsService, MESSAGE_PAGE_SIZE, conversation_details_cache
+from services.participant_index import CONVERSATION_PAGE_SIZE
+from services.provisioning_jobs import provisioning_params
+from services.job_store import job_store
+from services.badge_store import badge_store
+from services.phone_inventory import INVENTORY_FIELDS
+from services.fleet import Fleet
+from services.parent_accounts import parent_registry, UnknownParentError
+from services.webhook_queue import WebhookConsumer, webhook_queue, webhook_event_id, check_payload
+from services.metrics import metrics, current_timing, DEBUG_TIMING_ENABLED
+from services.rate_limiter import rate_limiter, TwilioUnavailableError
+from services.http_responses import FastJSONProvider, conditional_response, compressed_response
+from services.events import event_bus
+import threading
 import os
 import re
-from dotenv import load_dotenv
+import csv
+import io
 
-# Load environment variables
-load_dotenv()
+# Seconds between keep-alive comments on idle event streams, so proxies keep them open
+# and disconnected clients are noticed
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', '15'))
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 # Enable CORS and allow localhost:3000
-CORS(app, resources={r"/*": {"origins": "http://localhost:3000"}})
+CORS(app, resources={r"/*": {"origins": "http://localhost:3000"}}, expose_headers=['X-Debug-Timing', 'ETag'])
+
+# Instantiate services, every parent account gets its own (see services/parent_accounts.py)
+fleet = Fleet()
+webhook_consumer = WebhookConsumer(fleet.subaccount_services, badge_store)
+
+# The routes of parent_routes are served for the default parent account as they are, and for
+# any parent under /parents/<name>, e.g. GET /parents/emea/subaccounts
+parent_routes = Blueprint('parent_routes', __name__)
+
+@parent_routes.url_value_preprocessor
+def pop_parent(endpoint, values):
+	g.parent_name = values.pop('parent', None) if values else None
+
+@parent_routes.before_request
+def select_parent():
+	try:
+		g.parent_services = fleet.get(g.parent_name)
+	except UnknownParentError as e:
+		return jsonify({'error': str(e)}), 404
+
+def current_parent():
+	return g.parent_services.parent
+
+# The services of the parent account the request is for
+subaccount_service = LocalProxy(lambda: g.parent_services.subaccount_service)
+conversations_service = LocalProxy(lambda: g.parent_services.conversations_service)
+release_job_engine = LocalProxy(lambda: g.parent_services.release_job_engine)
+provisioning_job_engine = LocalProxy(lambda: g.parent_services.provisioning_job_engine)
+badge_worker = LocalProxy(lambda: g.parent_services.badge_worker)
+phone_inventory = LocalProxy(lambda: g.parent_services.phone_inventory)
+emergency_address_batch = LocalProxy(lambda: g.parent_services.emergency_address_batch)
+message_index = LocalProxy(lambda: g.parent_services.message_index)
+
+metrics.register_cache('conversation_details', conversation_details_cache)
+metrics.register_gauge(
+	'twilio_rate_limit', 'Current request rate allowed per account, adapted to 429 responses.', ('account',),
+	lambda: {(sid,): bucket['rate'] for sid, bucket in rate_limiter.stats()['buckets'].items()}
+)
+metrics.register_gauge(
+	'webhook_queue_events', 'Webhook events in the ingestion queue by status.', ('status',),
+	lambda: {(status,): count for status, count in webhook_queue.counts().items()}
+)
+metrics.register_gauge(
+	'event_subscribers', 'Clients connected to GET /events.', (),
+	lambda: {(): event_bus.stats()['subscribers']}
+)
+metrics.register_gauge(
+	'twilio_circuit_open', 'Whether calls to a Twilio host are failing fast (1) or not (0).', ('host',),
+	lambda: {(host,): int(breaker['state'] != 'closed') for host, breaker in rate_limiter.stats()['breakers'].items()}
+)
 
-# Instantiate services
-subaccount_service = SubaccountService()
-phone_number_service = PhoneNumberService()
-conversations_service = ConversationsService()
+# Time every request and attribute the Twilio calls it makes to its route
+@app.before_request
+def start_request_timing():
+	metrics.start_request(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def finish_request_timing(response):
+	timing = current_timing()
+	if timing is None:
+		return response
+	# Opt-in per request, covers the work done before a streamed body starts
+	if DEBUG_TIMING_ENABLED and request.headers.get('X-Debug-Timing'):
+		response.headers['X-Debug-Timing'] = timing.header()
+	method, status = request.method, response.status_code
+	# Recorded once the body is sent, so streamed responses are timed in full
+	response.call_on_close(lambda: metrics.finish_request(timing, method, status))
+	return response
+
+# Runs before finish_request_timing (after_request hooks run in reverse order), so 304s are recorded as such
+@app.after_request
+def cacheable_response(response):
+	# Unchanged bodies are answered with a 304, the others compressed when the client accepts it
+	response = conditional_response(request, response)
+	return compressed_response(request, response)
+
+_background_started = False
+_background_lock = threading.Lock()
+
+# Start the background workers with the first request, whatever server runs the app
+@app.before_request
+def start_background_workers():
+	global _background_started
+	if _background_started:
+		return
+	with _background_lock:
+		if not _background_started:
+			_background_started = True
+			fleet.start_workers(badge_worker=os.getenv('BADGE_WORKER_ENABLED', 'true').lower() == 'true')
+			if os.getenv('WEBHOOK_CONSUMER_ENABLED', 'true').lower() == 'true':
+				webhook_consumer.start()
+
+def error_response(e):
+	# Twilio being degraded or throttling us isn't our failure, tell the client when to retry
+	if isinstance(e, TwilioUnavailableError):
+		return jsonify({'error': str(e)}), 503, {'Retry-After': str(e.retry_after or 1)}
+	return jsonify({'error': str(e)}), 500
+
+def merge_stored_badges(subaccounts):
+	# Badges come from the badge store, kept up to date by the badge worker
+	stored = badge_store.get_all()
+	for subaccount in subaccounts:
+		badges = stored.get(subaccount['sid'])
+		if badges:
+			subaccount['allEmergenciesRegistered'] = badges['allEmergenciesRegistered']
+			subaccount['basicAuthMedia'] = badges['basicAuthMedia']
+			subaccount['badgesCheckedAt'] = badges['badgesCheckedAt']
+	return subaccounts
+
+PAGINATION_ARGS = ('page', 'page_size', 'cursor', 'status', 'friendly_name', 'q', 'sort', 'order')
+
+def positive_int_arg(args, name, default=None):
+	# Unlike args.get(name, type=int), which silently falls back to the default, a bad value is an error
+	value = args.get(name)
+	if value is None:
+		return default
+	try:
+		value = int(value)
+	except ValueError:
+		raise ValueError(f'{name} must be an integer')
+	if value < 1:
+		raise ValueError(f'{name} must be positive')
+	return value
 
 # List all subaccounts
-@app.route('/subaccounts', methods=['GET'])
+# With any of PAGINATION_ARGS, returns one page {items, page, page_size, total, next_cursor}
+@parent_routes.route('/subaccounts', methods=['GET'])
 def list_subaccounts():
 	try:
-		subaccounts = subaccount_service.list_subaccounts()
-		return jsonify(subaccounts), 200
+		if not any(arg in request.args for arg in PAGINATION_ARGS):
+			subaccounts = subaccount_service.list_subaccounts()
+			return jsonify(merge_stored_badges(subaccounts)), 200
+		
+		args = request.args
+		page = subaccount_service.query_subaccounts(
+			page=positive_int_arg(args, 'page') if not args.get('cursor') else None,
+			page_size=positive_int_arg(args, 'page_size', 10),
+			cursor=args.get('cursor'),
+			status=args.get('status'),
+			friendly_name=args.get('friendly_name'),
+			search=args.get('q'),
+			sort=args.get('sort', 'friendly_name'),
+			order=args.get('order', 'asc')
+		)
+		merge_stored_badges(page['items'])
+		return jsonify(page), 200
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
 
 # Get subaccount info
-@app.route('/subaccounts/<subaccount_sid>', methods=['GET'])
+@parent_routes.route('/subaccounts/<subaccount_sid>', methods=['GET'])
 def get_subaccount(subaccount_sid):
 	try:
+		badge_worker.touch(subaccount_sid)
 		subaccount_info = subaccount_service.get_subaccount_info(subaccount_sid)
+		badge_store.save({
+			'sid': subaccount_sid,
+			'allEmergenciesRegistered': subaccount_info['allEmergenciesRegistered'],
+			'basicAuthMedia': subaccount_info['basicAuthMedia']
+		})
 		# Convert the AccountInstance object to a dictionary and add badge fields
 		subaccount_data = extract_subaccount_data(subaccount_info['account_instance'])
 		subaccount_data['allEmergenciesRegistered'] = subaccount_info['allEmergenciesRegistered']
@@ -40,28 +204,80 @@ def get_subaccount(subaccount_sid):
 		
 		return jsonify(subaccount_data), 200
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
 
 # Get badge status for a subaccount (lightweight endpoint)
-@app.route('/subaccounts/<subaccount_sid>/badges', methods=['GET'])
+@parent_routes.route('/subaccounts/<subaccount_sid>/badges', methods=['GET'])
 def get_subaccount_badges(subaccount_sid):
 	try:
-		# Fetch the subaccount to get auth token
-		subaccount = subaccount_service.client.api.accounts(subaccount_sid).fetch()
+		badges = subaccount_service.get_badges(subaccount_sid)
+		badge_store.save(badges)
 		
-		all_emergencies_registered = subaccount_service.check_all_emergencies_registered(subaccount_sid, subaccount.auth_token)
-		basic_auth_media = subaccount_service.check_basic_auth_media(subaccount_sid)
-		
-		return jsonify({
-			'sid': subaccount_sid,
-			'allEmergenciesRegistered': all_emergencies_registered,
-			'basicAuthMedia': basic_auth_media
-		}), 200
+		return jsonify(badges), 200
+	except Exception as e:
+		return error_response(e)
+
+# Get badge status for many subaccounts at once, streamed as NDJSON as each one finishes
+# Body: {"sids": [...]} or {"page": 1, "page_size": 10}, optional "concurrency"
+@parent_routes.route('/subaccounts/badges', methods=['POST'])
+def get_subaccounts_badges():
+	data = request.get_json(silent=True) or {}
+	
+	try:
+		sids = resolve_badge_sids(data)
+		concurrency = data.get('concurrency')
+		concurrency = int(concurrency) if concurrency else None
+	except (TypeError, ValueError) as e:
+		return jsonify({'error': str(e)}), 400
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
+	
+	def generate():
+		for result in subaccount_service.iter_badges(sids, max_workers=concurrency):
+			badge_store.save(result)
+			yield app.json.dumps(result) + '\n'
+	
+	return Response(stream_with_context(generate()), mimetype='application/x-ndjson'), 200
+
+# Ask the badge worker to recompute badges now, for the given SIDs or every active subaccount
+@parent_routes.route('/subaccounts/badges/refresh', methods=['POST'])
+def refresh_subaccounts_badges():
+	data = request.get_json(silent=True) or {}
+	sids = data.get('sids')
+	if sids is not None:
+		try:
+			check_sids(sids)
+		except ValueError as e:
+			return jsonify({'error': str(e)}), 400
+	
+	badge_worker.start()
+	badge_worker.trigger(sids)
+	return jsonify({'message': 'Badge refresh scheduled.', 'sids': sids}), 202
+
+def resolve_badge_sids(data):
+	# Either an explicit list of SIDs or a page of the subaccount list
+	sids = data.get('sids')
+	if sids is None:
+		page = int(data.get('page', 1))
+		page_size = int(data.get('page_size', 10))
+		if page < 1 or page_size < 1:
+			raise ValueError('page and page_size must be positive')
+		subaccounts = subaccount_service.list_subaccounts()
+		start = (page - 1) * page_size
+		sids = [sa['sid'] for sa in subaccounts[start:start + page_size]]
+	else:
+		# Checked before streaming starts, a bad SID can't fail the response once the 200 is sent
+		check_sids(sids)
+	return sids
+
+def check_sids(sids):
+	if not isinstance(sids, list):
+		raise ValueError('sids must be a list')
+	if not all(isinstance(sid, str) and sid for sid in sids):
+		raise ValueError('Every entry of sids must be a non-empty string')
 
 # Create a new subaccount
-@app.route('/subaccounts', methods=['POST'])
+@parent_routes.route('/subaccounts', methods=['POST'])
 def create_subaccount():
 	data = request.json
 	friendly_name = data.get('friendly_name')
@@ -72,10 +288,10 @@ def create_subaccount():
 		subaccount_data =  extract_subaccount_data(new_subaccount)
 		return jsonify(subaccount_data), 201
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
 
 # Update subaccount info
-@app.route('/subaccounts/<subaccount_sid>', methods=['PUT'])
+@parent_routes.route('/subaccounts/<subaccount_sid>', methods=['PUT'])
 def update_subaccount(subaccount_sid):
 	data = request.json
 	friendly_name = data.get('friendly_name')
@@ -84,43 +300,97 @@ def update_subaccount(subaccount_sid):
 		updated_subaccount = subaccount_service.update_subaccount(subaccount_sid, friendly_name)
 		return jsonify(updated_subaccount), 200
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
 
 # Delete (close) a subaccount and release all its phone numbers
-@app.route('/subaccounts/<subaccount_sid>', methods=['DELETE'])
+# Runs as a background job, poll the returned status URL for progress
+@parent_routes.route('/subaccounts/<subaccount_sid>', methods=['DELETE'])
 def delete_subaccount(subaccount_sid):
 	try:
-		data = request.json
+		data = request.get_json(silent=True) or {}
 		closed = data.get('closed')
-		updated_subaccount = subaccount_service.close_subaccount(subaccount_sid, closed)
+		job_id = release_job_engine.start_close(subaccount_sid, closed)
+		badge_worker.touch(subaccount_sid)
+		status_url = f'/jobs/{job_id}'
 		
-		# Return a confirmation message
 		return jsonify({
-			'sid': updated_subaccount.sid,
-			'friendly_name': updated_subaccount.friendly_name,
-			'status': updated_subaccount.status,
-			'message': f'Subaccount {updated_subaccount.friendly_name} has been closed and all phone numbers released.'
-		}), 200
+			'sid': subaccount_sid,
+			'job_id': job_id,
+			'status_url': status_url,
+			'message': f'Releasing all phone numbers of subaccount {subaccount_sid}.'
+		}), 202, {'Location': status_url}
+	except Exception as e:
+		return error_response(e)
+
+# Parent accounts served by this process, the first one is the one the routes without /parents/<name> use
+@app.route('/parents', methods=['GET'])
+def list_parents():
+	return jsonify([parent.describe() for parent in parent_registry.all()]), 200
+
+# Subaccounts of every parent account, each with the name of its parent, listed in parallel
+# Parents that couldn't be listed are left out and named in the X-Fleet-Errors header
+@app.route('/fleet/subaccounts', methods=['GET'])
+def list_fleet_subaccounts():
+	try:
+		subaccounts, errors = fleet.list_subaccounts()
+		headers = {'X-Fleet-Errors': ','.join(sorted(errors))} if errors else {}
+		return jsonify(merge_stored_badges(subaccounts)), 200, headers
+	except Exception as e:
+		return error_response(e)
+
+# Ask the badge worker of every parent account to recompute all its subaccounts' badges now
+@app.route('/fleet/badges/refresh', methods=['POST'])
+def refresh_fleet_badges():
+	try:
+		fleet.refresh_badges()
+		return jsonify({'message': 'Badge refresh scheduled.', 'parents': [parent.name for parent in parent_registry.all()]}), 202
+	except Exception as e:
+		return error_response(e)
+
+# Status and per-item progress of a background job
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+	try:
+		job = job_store.get_job(job_id, include_items=request.args.get('items') == 'true')
+		if job is None:
+			return jsonify({'error': f'Job {job_id} not found'}), 404
+		
+		return jsonify(job), 200
+	except Exception as e:
+		return error_response(e)
+
+# Resume an interrupted or failed job, only the unfinished items are retried
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+	try:
+		if not fleet.resume_job(job_id):
+			return jsonify({'error': f'Job {job_id} not found'}), 404
+		
+		return jsonify(job_store.get_job(job_id)), 202, {'Location': f'/jobs/{job_id}'}
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
 
 
-@app.route('/subaccounts/<subaccount_sid>/<phone_number_sid>', methods=['DELETE'])
+@parent_routes.route('/subaccounts/<subaccount_sid>/<phone_number_sid>', methods=['DELETE'])
 def delete_phone_number(subaccount_sid, phone_number_sid):
 	try:
 		res = subaccount_service.release_phone_number(subaccount_sid, phone_number_sid)
+		badge_worker.touch(subaccount_sid)
+		phone_inventory.invalidate(subaccount_sid)
 		# Return a confirmation message
 		return jsonify({
 			'res': res,
 			'message': f'Subaccount {subaccount_sid} has been closed and all phone numbers released.'
 		}), 200
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
 
-@app.route('/subaccounts/<subaccount_sid>/<phone_number>', methods=['PUT'])
+@parent_routes.route('/subaccounts/<subaccount_sid>/<phone_number>', methods=['PUT'])
 def remove_emergency_address(subaccount_sid, phone_number):
 	try:
 		res = subaccount_service.remove_emergency_address(subaccount_sid, phone_number)
+		badge_worker.touch(subaccount_sid)
+		phone_inventory.invalidate(subaccount_sid)
 		
 		# Return a confirmation message
 		return jsonify({
@@ -128,20 +398,82 @@ def remove_emergency_address(subaccount_sid, phone_number):
 			'message': f'Phone number {phone_number} emergency address removed.'
 		}), 200
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
 
 # Get all phone number info
-@app.route('/subaccounts/<subaccount_sid>/phone-numbers', methods=['GET'])
+@parent_routes.route('/subaccounts/<subaccount_sid>/phone-numbers', methods=['GET'])
 def get_phone_numbers_info(subaccount_sid):
 	try:
-		phone_numbers_data = subaccount_service.get_phone_numbers(subaccount_sid)
+		page_size = request.args.get('page_size', type=int)
+		phone_numbers_data = subaccount_service.get_phone_numbers(subaccount_sid, page_size=page_size)
 		
 		return jsonify(phone_numbers_data), 200
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
+
+# Phone numbers of all the subaccounts, from the local inventory
+# Filters: emergency_status (comma-separated, 'none' for no address), emergency_registered=true|false,
+# created_after/created_before (ISO 8601), prefix, subaccount_sid. format=ndjson (default) or csv.
+# refresh=true re-lists every subaccount instead of only the stale ones.
+@parent_routes.route('/phone-numbers', methods=['GET'])
+def get_phone_number_inventory():
+	try:
+		args = request.args
+		output_format = args.get('format', 'ndjson')
+		if output_format not in ('ndjson', 'csv'):
+			return jsonify({'error': "format must be 'ndjson' or 'csv'"}), 400
+		emergency_registered = args.get('emergency_registered')
+		if emergency_registered not in (None, 'true', 'false'):
+			return jsonify({'error': "emergency_registered must be 'true' or 'false'"}), 400
+		
+		sync = phone_inventory.sync(max_age=0 if args.get('refresh') == 'true' else None)
+		numbers = phone_inventory.query(
+			emergency_status=args.get('emergency_status').split(',') if args.get('emergency_status') else None,
+			emergency_registered=None if emergency_registered is None else emergency_registered == 'true',
+			created_after=args.get('created_after'),
+			created_before=args.get('created_before'),
+			prefix=args.get('prefix'),
+			subaccount_sid=args.get('subaccount_sid')
+		)
+		
+		if output_format == 'csv':
+			response = stream_csv(numbers, INVENTORY_FIELDS)
+			response.headers['Content-Disposition'] = 'attachment; filename=phone-numbers.csv'
+		else:
+			response = stream_items(numbers, ndjson=True)
+		# Subaccounts that couldn't be listed are served from their last sync
+		if sync['errors']:
+			response.headers['X-Inventory-Sync-Errors'] = ','.join(sorted(sync['errors']))
+		return response, 200
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
+	except Exception as e:
+		return error_response(e)
+
+# Assign or remove the emergency address of many numbers across subaccounts
+# Body: {"action": "assign" | "remove", "emergency_address_sid": "AD..." or {subaccount_sid: "AD..."},
+# "items": [{"subaccount_sid", "phone_number_sid"}, ...] or "filter": {...GET /phone-numbers filters}},
+# e.g. {"action": "assign", "emergency_address_sid": {...}, "filter": {"emergency_registered": false}}
+@parent_routes.route('/phone-numbers/emergency-address', methods=['POST'])
+def update_emergency_addresses():
+	try:
+		data = request.get_json(silent=True) or {}
+		if ('items' in data) == ('filter' in data):
+			return jsonify({'error': 'Either items or filter is required'}), 400
+		try:
+			items = data['items'] if 'items' in data else emergency_address_batch.select(data['filter'] or {})
+			if not isinstance(items, list):
+				return jsonify({'error': 'items must be a list'}), 400
+			results = emergency_address_batch.run(data.get('action'), items, data.get('emergency_address_sid'))
+		except (TypeError, ValueError) as e:
+			return jsonify({'error': str(e)}), 400
+		
+		return jsonify(results), 200
+	except Exception as e:
+		return error_response(e)
 
 # Get phone number info
-@app.route('/subaccounts/<subaccount_sid>/<phone_number_sid>', methods=['GET'])
+@parent_routes.route('/subaccounts/<subaccount_sid>/<phone_number_sid>', methods=['GET'])
 def get_phone_number_info(subaccount_sid, phone_number_sid):
 	try:
 		phone_number_info = subaccount_service.get_phone_number_info(subaccount_sid, phone_number_sid)
@@ -149,7 +481,51 @@ def get_phone_number_info(subaccount_sid, phone_number_sid):
 		
 		return jsonify(phone_number_info), 200
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
+
+# Server-Sent Events stream of changes: badges, purchased/released numbers, emergency address
+# removals and subaccount creations, renames and closes, as they happen in this process.
+# subaccount_sid=AC1,AC2 limits it to some subaccounts. Reconnecting clients send Last-Event-ID
+# and get what they missed; when that is no longer possible a 'resync' event tells them to refetch
+@app.route('/events', methods=['GET'])
+def stream_events():
+	sids = [sid for value in request.args.getlist('subaccount_sid') for sid in value.split(',') if sid]
+	last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+	try:
+		last_event_id = int(last_event_id) if last_event_id else None
+	except ValueError:
+		return jsonify({'error': 'Last-Event-ID must be an event id'}), 400
+
+	subscription = event_bus.subscribe(sids or None, last_event_id)
+
+	def generate():
+		try:
+			yield 'retry: 5000\n\n'
+			while True:
+				if subscription.overflowed:
+					subscription.reset()
+					yield f'id: {event_bus.last_id}\nevent: resync\ndata: {{}}\n\n'
+					continue
+				event = subscription.get(EVENTS_HEARTBEAT)
+				if event is None:
+					yield ': keep-alive\n\n'
+					continue
+				yield f"id: {event['id']}\nevent: {event['type']}\ndata: {app.json.dumps(event)}\n\n"
+		finally:
+			subscription.close()
+	
+	return Response(stream_with_context(generate()), mimetype='text/event-stream',
+		headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Hit/miss counters for the account and auth token caches
+@parent_routes.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+	return jsonify(subaccount_service.cache_stats()), 200
+
+# Prometheus scrape endpoint
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+	return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 def extract_subaccount_data(subaccount):
 	return {
@@ -162,76 +538,89 @@ def extract_subaccount_data(subaccount):
 	}
 
 
-# Search for available phone numbers in a country or area code
-@app.route('/subaccounts/<subaccount_sid>/search-phone-numbers', methods=['GET'])
+# Search available numbers across countries, number types and area codes
+# Query: country, area_code and type (local, mobile, toll_free) as comma-separated lists, limit per query
+@parent_routes.route('/subaccounts/<subaccount_sid>/search-phone-numbers', methods=['GET'])
 def search_available_phone_numbers(subaccount_sid):
 	try:
-		# Get the subaccount auth token from the request
-		# data = request.args
-		# subaccount_auth_token = data.get('auth_token')
-		# country = data.get('country', 'US')  # Default country is US
-		# area_code = data.get('area_code')  # Optional area code
-		
-		# if not subaccount_auth_token:
-		#     return jsonify({'error': 'Auth token is required'}), 400
+		args = request.args
+		split = lambda value: [item.strip() for item in value.split(',') if item.strip()]
+		limit = args.get('limit', SEARCH_LIMIT, type=int)
+		if limit < 1 or limit > 1000:
+			return jsonify({'error': 'limit must be between 1 and 1000'}), 400
 		
-		# # Create PhoneNumberService for the subaccount
-		# phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token)
+		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=subaccount_service.get_auth_token(subaccount_sid),
+			parent=current_parent())
+		available_numbers = phone_number_service.search_available_phone_numbers(
+			countries=split(args.get('country', 'US')),
+			area_codes=split(args.get('area_code', '')),
+			number_types=split(args.get('type', 'local')),
+			limit=limit
+		)
 		
-		# # Search for available phone numbers
-		# available_numbers = phone_number_service.search_available_phone_numbers(country=country, area_code=area_code)
-		
-		return jsonify('ok'), 200
+		return jsonify(available_numbers), 200
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
 
-# Buy a phone number for the subaccount
-@app.route('/subaccounts/<subaccount_sid>/buy-phone-number', methods=['POST'])
+# Buy many numbers at once, given or found with a search, as a background job
+# Body: {"phone_numbers": [...]} or {"search": {"country", "area_code", "type"}, "count": n},
+# plus optional friendly_name and emergency_address_sid applied by the purchase itself
+@parent_routes.route('/subaccounts/<subaccount_sid>/buy-phone-number', methods=['POST'])
 def buy_phone_number(subaccount_sid):
 	try:
-		# Get the phone number and auth token from the request body
-		# data = request.json
-		# subaccount_auth_token = data.get('auth_token')
-		# phone_number = data.get('phone_number')
-		
-		# if not subaccount_auth_token or not phone_number:
-		#     return jsonify({'error': 'Auth token and phone number are required'}), 400
-		
-		# # Create PhoneNumberService for the subaccount
-		# phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token)
-		
-		# # Buy the phone number
-		# purchased_number = phone_number_service.buy_phone_number(phone_number)
+		data = request.get_json(silent=True) or {}
+		# A single number is a one-item job
+		if data.get('phone_number') and not data.get('phone_numbers'):
+			data['phone_numbers'] = [data['phone_number']]
+		try:
+			params = provisioning_params(data)
+		except ValueError as e:
+			return jsonify({'error': str(e)}), 400
+
+		job_id = provisioning_job_engine.start(subaccount_sid, params)
+		status_url = f'/jobs/{job_id}'
 		
-		return jsonify('ok'), 201
+		return jsonify({
+			'sid': subaccount_sid,
+			'job_id': job_id,
+			'status_url': status_url,
+			'message': f'Buying phone numbers for subaccount {subaccount_sid}.'
+		}), 202, {'Location': status_url}
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
 
 
+# SendGrid inbound parse webhook for the "subaccount created" emails
+# The payload is only queued here, the webhook consumer looks the account up in the background
 @app.route('/subaccount-created', methods=['POST'])
 def email_webhook():
-	# SendGrid sends the email data as multipart/form-data
-	# email_body = request.form.get('text')
-	print("email received")
-	data = request.json
-	print(data)
-	# Extract the account ID using regex or another method
-	# account_id_match = re.search(r'Id: (\w+)', email_body)
-	# if account_id_match:
-	# 	account_id = account_id_match.group(1)
-	# 	print(f"Extracted Account ID: {account_id}")
-
-	# 	# Log the account ID into your Excel file or database
-	# 	# Example logging (expand this to log to file or database)
-	# 	with open('accounts_log.txt', 'a') as f:
-	# 		f.write(f"Account ID: {account_id}\n")
+	try:
+		# SendGrid sends the email data as multipart/form-data, JSON is accepted too
+		payload = request.form.to_dict() if request.form else (request.get_json(silent=True) or {})
+		try:
+			check_payload(payload)
+		except ValueError as e:
+			return jsonify({'error': str(e)}), 400
+		event_id = webhook_event_id(payload)
+		queued = webhook_queue.enqueue(event_id, payload)
+		if queued:
+			webhook_consumer.wake()
 		
-	# 	return jsonify({"status": "success", "account_id": account_id}), 200
-	# else:
-	# 	return jsonify({"status": "failed", "message": "No Account ID found"}), 400
-	return jsonify({"status": "success"}), 200
+		return jsonify({"status": "success", "id": event_id, "duplicate": not queued}), 200
+	except Exception as e:
+		return error_response(e)
+
+@app.route('/subaccount-created/<event_id>', methods=['GET'])
+def get_webhook_event(event_id):
+	event = webhook_queue.get(event_id)
+	if event is None:
+		return jsonify({'error': f'Event {event_id} not found'}), 404
+	
+	return jsonify(event), 200
 
-@app.route('/subaccounts/<subaccount_sid>/conversations/message', methods=['DELETE'])
+@parent_routes.route('/subaccounts/<subaccount_sid>/conversations/message', methods=['DELETE'])
 def delete_message(subaccount_sid):
 	try:
 		# Get the subaccount auth token from the request
@@ -241,18 +630,215 @@ def delete_message(subaccount_sid):
 		
 		return jsonify('ok'), 200
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
+
+def stream_items(items, ndjson=False):
+	"""
+	Stream items as NDJSON, or as a chunked JSON array, without holding them all in memory.
+	The first item is pulled before responding so an upstream failure still gets an error status.
+	"""
+	items = iter(items)
+	first = next(items, None)
+	
+	def generate():
+		if ndjson:
+			if first is not None:
+				yield app.json.dumps(first) + '\n'
+			for item in items:
+				yield app.json.dumps(item) + '\n'
+		else:
+			yield '['
+			if first is not None:
+				yield app.json.dumps(first)
+			for item in items:
+				yield ',' + app.json.dumps(item)
+			yield ']'
+	
+	mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+	return Response(stream_with_context(generate()), mimetype=mimetype)
+
+def stream_csv(items, fields):
+	# Same as stream_items, as CSV with a header row
+	items = iter(items)
+	first = next(items, None)
+	
+	def generate():
+		buffer = io.StringIO()
+		writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+		writer.writeheader()
+		for item in ([first] if first is not None else []):
+			writer.writerow(item)
+		yield buffer.getvalue()
+		for item in items:
+			buffer.seek(0)
+			buffer.truncate()
+			writer.writerow(item)
+			yield buffer.getvalue()
+	
+	return Response(stream_with_context(generate()), mimetype='text/csv')
+
+# List a subaccount's conversations
+# With page_size or cursor, returns one page {items, next_cursor}, otherwise streams them all
+# details=true adds each conversation's last message, an upper bound of its message count
+# (the last message's index + 1, indexes can skip numbers) and its participant count
+@parent_routes.route('/subaccounts/<subaccount_sid>/conversations', methods=['GET'])
+def list_subaccount_conversations(subaccount_sid):
+	try:
+		args = request.args
+		details = args.get('details') == 'true'
+		if 'page_size' in args or 'cursor' in args:
+			page = conversations_service.get_conversations_page(
+				subaccount_sid,
+				page_size=args.get('page_size', CONVERSATION_PAGE_SIZE, type=int),
+				cursor=args.get('cursor'),
+				details=details
+			)
+			return jsonify(page), 200
+		
+		conversations = conversations_service.iter_conversations(subaccount_sid, details=details)
+		return stream_items(conversations, ndjson=args.get('format') == 'ndjson'), 200
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
+	except Exception as e:
+		return error_response(e)
+
+# Full-text search of the messages of all the subaccount's conversations, e.g. ?q=refund or ?q=5551234
+# Answered from the local message index without calling Twilio, which is synced in the background
+# when stale (or with refresh=true); synced_at and syncing tell how current the results are
+@parent_routes.route('/subaccounts/<subaccount_sid>/conversations/search', methods=['GET'])
+def search_messages(subaccount_sid):
+	try:
+		args = request.args
+		if args.get('refresh') == 'true':
+			message_index.sync_in_background(subaccount_sid)
+		results = message_index.search(subaccount_sid, args.get('q', ''), limit=args.get('limit', 50, type=int))
+		
+		return jsonify(results), 200
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
+	except Exception as e:
+		return error_response(e)
+
+# List the messages of a conversation, same paging/streaming options as the conversations list
+# order=desc returns the newest messages first
+@parent_routes.route('/subaccounts/<subaccount_sid>/conversations/<conversation_sid>/messages', methods=['GET'])
+def get_messages(subaccount_sid, conversation_sid):
+	try:
+		args = request.args
+		order = args.get('order', 'asc')
+		service = ConversationsService(subaccount_sid, parent=current_parent())
+		if 'page_size' in args or 'cursor' in args:
+			page = service.get_messages_page(
+				conversation_sid,
+				page_size=args.get('page_size', MESSAGE_PAGE_SIZE, type=int),
+				cursor=args.get('cursor'),
+				order=order
+			)
+			return jsonify(page), 200
+		
+		if order not in ('asc', 'desc'):
+			return jsonify({'error': "order must be 'asc' or 'desc'"}), 400
+		return stream_items(service.iter_messages(conversation_sid, order=order), ndjson=args.get('format') == 'ndjson'), 200
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
+	except Exception as e:
+		return error_response(e)
 
-@app.route('/subaccounts/<subaccount_sid>/<phone_number>/conversations', methods=['GET'])
+@parent_routes.route('/subaccounts/<subaccount_sid>/conversations/<conversation_sid>/messages/<message_sid>', methods=['GET'])
+def get_message_details(subaccount_sid, conversation_sid, message_sid):
+	try:
+		message = ConversationsService(subaccount_sid, parent=current_parent()).get_message_details(conversation_sid, message_sid)
+		
+		return jsonify(message), 200
+	except Exception as e:
+		return error_response(e)
+
+@parent_routes.route('/subaccounts/<subaccount_sid>/<phone_number>/conversations', methods=['GET'])
 def get_conversations(subaccount_sid, phone_number):
 	try:
 		print("PHONE: ", phone_number)
 		# Get the conversations list from the phone number
-		conversations = conversations_service.list_conversations(subaccount_sid,phone_number)
+		conversations = conversations_service.list_conversations(subaccount_sid, phone_number, details=request.args.get('details') == 'true')
 		
 		return conversations, 200
 	except Exception as e:
-		return jsonify({'error': str(e)}), 500
+		return error_response(e)
+
+# Async variants of the fan-out routes, backed by the aiohttp based services.
+# aiohttp is slow to import, it is loaded by the first async request rather than at startup
+
+def async_subaccount_service(concurrency=None):
+	from services.async_subaccount_service import AsyncSubaccountService
+	return AsyncSubaccountService(subaccount_service.auth_token_cache, concurrency or subaccount_service.badge_concurrency,
+		parent=current_parent())
+
+def async_conversations_service():
+	from services.async_conversations_service import AsyncConversationsService
+	return AsyncConversationsService(parent=current_parent())
+
+@parent_routes.route('/async/subaccounts/<subaccount_sid>/badges', methods=['GET'])
+async def get_subaccount_badges_async(subaccount_sid):
+	try:
+		async with async_subaccount_service() as service:
+			badges = await service.get_badges(subaccount_sid)
+		
+		return jsonify(badges), 200
+	except Exception as e:
+		return error_response(e)
+
+@parent_routes.route('/async/subaccounts/badges', methods=['POST'])
+async def get_subaccounts_badges_async():
+	data = request.get_json(silent=True) or {}
+	
+	try:
+		sids = resolve_badge_sids(data)
+		concurrency = data.get('concurrency')
+		concurrency = min(int(concurrency), subaccount_service.badge_concurrency) if concurrency else None
+	except (TypeError, ValueError) as e:
+		return jsonify({'error': str(e)}), 400
+	except Exception as e:
+		return error_response(e)
+	
+	try:
+		async with async_subaccount_service(concurrency) as service:
+			badges = await service.get_badges_many(sids)
+		
+		return jsonify(badges), 200
+	except Exception as e:
+		return error_response(e)
+
+@parent_routes.route('/async/subaccounts/<subaccount_sid>', methods=['DELETE'])
+async def delete_subaccount_async(subaccount_sid):
+	try:
+		data = request.json
+		closed = data.get('closed')
+		async with async_subaccount_service() as service:
+			updated_subaccount = await service.close_subaccount(subaccount_sid, closed)
+		if closed:
+			subaccount_service.account_closed(updated_subaccount)
+		
+		return jsonify({
+			'sid': updated_subaccount.sid,
+			'friendly_name': updated_subaccount.friendly_name,
+			'status': updated_subaccount.status,
+			'message': f'Subaccount {updated_subaccount.friendly_name} has been closed and all phone numbers released.'
+		}), 200
+	except Exception as e:
+		return error_response(e)
+
+@parent_routes.route('/async/subaccounts/<subaccount_sid>/<phone_number>/conversations', methods=['GET'])
+async def get_conversations_async(subaccount_sid, phone_number):
+	try:
+		async with async_conversations_service() as service:
+			conversations = await service.list_conversations(subaccount_sid, phone_number)
+		
+		return jsonify(conversations), 200
+	except Exception as e:
+		return error_response(e)
+
+app.register_blueprint(parent_routes)
+app.register_blueprint(parent_routes, url_prefix='/parents/<parent>', name='parent')
 
 if __name__ == '__main__':
+	# Development server, see wsgi.py for WSGI servers
 	app.run(debug=True)
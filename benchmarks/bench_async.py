@@ -0,0 +1,59 @@
+"""
+Compare sync and async badge scans against the local mock Twilio server.
+
+	python benchmarks/bench_async.py --sizes 10 100 1000 --latency 0.02
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_twilio import MockTwilio, PARENT_ACCOUNT_SID
+
+def run_sync(sids):
+	from services.subaccount_service import SubaccountService
+	service = SubaccountService()
+	start = time.perf_counter()
+	results = list(service.iter_badges(sids))
+	return time.perf_counter() - start, results
+
+def run_async(sids):
+	from services.async_subaccount_service import AsyncSubaccountService
+
+	async def scan():
+		async with AsyncSubaccountService() as service:
+			return await service.get_badges_many(sids)
+
+	start = time.perf_counter()
+	results = asyncio.run(scan())
+	return time.perf_counter() - start, results
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='Subaccount counts to benchmark')
+	parser.add_argument('--numbers', type=int, default=5, help='Phone numbers per subaccount')
+	parser.add_argument('--latency', type=float, default=0.02, help='Injected latency per mock request, in seconds')
+	args = parser.parse_args()
+
+	print(f"{'subaccounts':>12} {'sync (s)':>10} {'async (s)':>10} {'speedup':>8}")
+	for size in args.sizes:
+		server = MockTwilio(subaccounts=size, numbers_per_subaccount=args.numbers, latency=args.latency)
+		os.environ['TWILIO_API_BASE_URL'] = server.start()
+		os.environ['TWILIO_ACCOUNT_SID'] = PARENT_ACCOUNT_SID
+		os.environ['TWILIO_AUTH_TOKEN'] = 'benchmark'
+		try:
+			sids = list(server.accounts)
+			sync_elapsed, sync_results = run_sync(sids)
+			async_elapsed, async_results = run_async(sids)
+			errors = sum(1 for result in sync_results + async_results if 'error' in result)
+			if errors:
+				print(f"warning: {errors} badge computations failed")
+			print(f"{size:>12} {sync_elapsed:>10.3f} {async_elapsed:>10.3f} {sync_elapsed / async_elapsed:>7.1f}x")
+		finally:
+			server.stop()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,115 @@
+"""
+Per-route benchmarks of api.py against the local mock Twilio server.
+
+	python -m pytest benchmarks/bench_routes.py
+
+Every route is warmed up, then requested BENCH_ITERATIONS times in a row; throughput,
+p50/p99 latency and Twilio calls per request are written to bench_results.json.
+A route fails when its p50 is more than BENCH_THRESHOLD (default 25%) slower than in
+benchmarks/baseline.json, which is only compared at the same scale. Record a baseline
+with BENCH_UPDATE_BASELINE=1. Without one the routes pass unchecked, with a warning and a
+note in the summary; BENCH_REQUIRE_BASELINE=1 fails them instead.
+
+The scale defaults to 500 subaccounts x 200 numbers with 20ms of latency per Twilio call,
+see conftest.py for the BENCH_* settings (including 429 injection with BENCH_RATE_LIMIT).
+"""
+import itertools
+import os
+import time
+
+import pytest
+
+BENCH_ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '20'))
+BENCH_WARMUP = int(os.getenv('BENCH_WARMUP', '2'))
+BENCH_THRESHOLD = float(os.getenv('BENCH_THRESHOLD', '0.25'))
+# Fail the routes that have no baseline to compare with, instead of reporting them unchecked
+BENCH_REQUIRE_BASELINE = os.getenv('BENCH_REQUIRE_BASELINE', '').lower() in ('1', 'true')
+
+def percentile(samples, fraction):
+	# Nearest-rank percentile
+	ordered = sorted(samples)
+	return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+class Fixtures:
+	"""Picks the SIDs the routes are requested with out of the mock server's data."""
+	def __init__(self, server):
+		self.subaccount_sid = next(iter(server.accounts))
+		numbers = list(server.phone_numbers[self.subaccount_sid].values())
+		self.phone_number_sid = numbers[0]['sid']
+		self.phone_number = numbers[0]['phone_number']
+		# Each emergency address removal gets a number of its own
+		self.registered_numbers = itertools.cycle([
+			f"{subaccount_sid}/{number['sid']}" for subaccount_sid, subaccount_numbers in server.phone_numbers.items()
+			for number in subaccount_numbers.values() if number['emergency_address_sid']
+		])
+		self.conversation_sid = next(iter(server.conversations), None)
+		self.conversation_phone_number = server.participants[self.conversation_sid][0]['messaging_binding']['address'] if self.conversation_sid else self.phone_number
+
+# name -> (method, path, json body) built from the fixtures
+ROUTES = {
+	'GET /subaccounts': lambda f: ('GET', '/subaccounts', None),
+	'GET /subaccounts?page_size=50': lambda f: ('GET', '/subaccounts?page_size=50&sort=date_created', None),
+	'GET /subaccounts/<sid>': lambda f: ('GET', f'/subaccounts/{f.subaccount_sid}', None),
+	'GET /subaccounts/<sid>/badges': lambda f: ('GET', f'/subaccounts/{f.subaccount_sid}/badges', None),
+	'POST /subaccounts/badges (page of 50)': lambda f: ('POST', '/subaccounts/badges', {'page': 1, 'page_size': 50}),
+	'GET /subaccounts/<sid>/phone-numbers': lambda f: ('GET', f'/subaccounts/{f.subaccount_sid}/phone-numbers', None),
+	'GET /phone-numbers?emergency_registered=false': lambda f: ('GET', '/phone-numbers?emergency_registered=false', None),
+	'GET /phone-numbers?format=csv': lambda f: ('GET', '/phone-numbers?format=csv', None),
+	'GET /subaccounts/<sid>/<phone_number_sid>': lambda f: ('GET', f'/subaccounts/{f.subaccount_sid}/{f.phone_number_sid}', None),
+	'PUT /subaccounts/<sid>/<phone_number>': lambda f: ('PUT', f'/subaccounts/{next(f.registered_numbers)}', None),
+	'GET /subaccounts/<sid>/conversations': lambda f: ('GET', f'/subaccounts/{f.subaccount_sid}/conversations', None),
+	'GET /subaccounts/<sid>/conversations/<sid>/messages': lambda f: ('GET', f'/subaccounts/{f.subaccount_sid}/conversations/{f.conversation_sid}/messages', None),
+	'GET /subaccounts/<sid>/<phone_number>/conversations': lambda f: ('GET', f'/subaccounts/{f.subaccount_sid}/{f.conversation_phone_number}/conversations', None),
+	'GET /async/subaccounts/<sid>/badges': lambda f: ('GET', f'/async/subaccounts/{f.subaccount_sid}/badges', None),
+	'GET /metrics': lambda f: ('GET', '/metrics', None),
+}
+
+@pytest.fixture(scope='module')
+def fixtures(mock_twilio):
+	return Fixtures(mock_twilio)
+
+@pytest.mark.parametrize('name', list(ROUTES))
+def test_route(name, client, mock_twilio, fixtures, baseline, bench_results, unchecked_routes):
+	if 'conversations' in name and fixtures.conversation_sid is None:
+		pytest.skip('BENCH_CONVERSATIONS is 0')
+
+	def request():
+		method, path, body = ROUTES[name](fixtures)
+		response = client.open(path, method=method, json=body)
+		# Read streamed bodies to the end, they are part of the route's latency
+		response.get_data()
+		response.close()
+		assert response.status_code < 400, f'{method} {path} returned {response.status_code}: {response.get_data(as_text=True)[:200]}'
+
+	for _ in range(BENCH_WARMUP):
+		request()
+
+	calls_before = mock_twilio.request_count
+	samples = []
+	started = time.perf_counter()
+	for _ in range(BENCH_ITERATIONS):
+		request_started = time.perf_counter()
+		request()
+		samples.append(time.perf_counter() - request_started)
+	elapsed = time.perf_counter() - started
+
+	result = {
+		'iterations': BENCH_ITERATIONS,
+		'throughput': BENCH_ITERATIONS / elapsed,
+		'p50': percentile(samples, 0.50),
+		'p99': percentile(samples, 0.99),
+		'twilio_calls': (mock_twilio.request_count - calls_before) / BENCH_ITERATIONS
+	}
+	bench_results[name] = result
+
+	reference = (baseline or {}).get('routes', {}).get(name)
+	if not reference:
+		unchecked_routes.append(name)
+		if BENCH_REQUIRE_BASELINE:
+			pytest.fail(f'{name} has no baseline to compare its p50 with (BENCH_REQUIRE_BASELINE is set)')
+	else:
+		limit = reference['p50'] * (1 + BENCH_THRESHOLD)
+		assert result['p50'] <= limit, (
+			f"{name} regressed: p50 {result['p50'] * 1000:.1f}ms, baseline {reference['p50'] * 1000:.1f}ms "
+			f"(threshold {BENCH_THRESHOLD:.0%})"
+		)
@@ -0,0 +1,93 @@
+"""
+Cold-start latency of the API process, as seen by a freshly started (autoscaled) worker.
+
+	python benchmarks/bench_startup.py --runs 10
+
+Every run starts a new interpreter and times, from the interpreter's start:
+	import: importing api.py
+	first request: the first request that doesn't call Twilio (GET /metrics)
+	first Twilio request: the first request calling Twilio (GET /subaccounts/<sid>) against
+		the local mock server, which creates the process' first Twilio client
+
+With --max-import-ms the script exits with an error when the median import time is above it.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_twilio import MockTwilio, PARENT_ACCOUNT_SID
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter, prints the timings as JSON
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import api
+imported = time.perf_counter()
+client = api.app.test_client()
+assert client.get('/metrics').status_code == 200
+first_request = time.perf_counter()
+response = client.get('/subaccounts/' + sys.argv[1])
+assert response.status_code == 200, response.get_data(as_text=True)
+first_twilio_request = time.perf_counter()
+print(json.dumps({
+	'import': imported - started,
+	'first request': first_request - started,
+	'first Twilio request': first_twilio_request - started
+}))
+"""
+
+def run_once(env, subaccount_sid):
+	output = subprocess.run(
+		[sys.executable, '-c', CHILD, subaccount_sid],
+		cwd=ROOT, env=env, check=True, capture_output=True, text=True
+	).stdout
+	return json.loads(output.strip().splitlines()[-1])
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--runs', type=int, default=10, help='Interpreters started')
+	parser.add_argument('--max-import-ms', type=float, help='Fail when the median import time is above this')
+	args = parser.parse_args()
+
+	server = MockTwilio(subaccounts=1, numbers_per_subaccount=1)
+	base_url = server.start()
+	db_dir = tempfile.mkdtemp(prefix='butler-startup-')
+	env = dict(
+		os.environ,
+		TWILIO_API_BASE_URL=base_url,
+		TWILIO_ACCOUNT_SID=PARENT_ACCOUNT_SID,
+		TWILIO_AUTH_TOKEN='benchmark',
+		BUTLER_DB_PATH=os.path.join(db_dir, 'butler.db'),
+		BADGE_WORKER_ENABLED='false',
+		WEBHOOK_CONSUMER_ENABLED='false'
+	)
+	subaccount_sid = next(iter(server.accounts))
+
+	try:
+		# One untimed run so every run finds compiled bytecode
+		run_once(env, subaccount_sid)
+		samples = [run_once(env, subaccount_sid) for _ in range(args.runs)]
+	finally:
+		server.stop()
+
+	print(f"{'phase':<24} {'min (ms)':>9} {'p50 (ms)':>9} {'max (ms)':>9}")
+	medians = {}
+	for phase in samples[0]:
+		values = [sample[phase] * 1000 for sample in samples]
+		medians[phase] = statistics.median(values)
+		print(f'{phase:<24} {min(values):>9.1f} {medians[phase]:>9.1f} {max(values):>9.1f}')
+
+	if args.max_import_ms is not None and medians['import'] > args.max_import_ms:
+		print(f"import took {medians['import']:.1f}ms, more than {args.max_import_ms:.1f}ms")
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,112 @@
+"""
+Fixtures of the route benchmarks (bench_routes.py), see that module for how to run them.
+"""
+import json
+import os
+import sys
+import tempfile
+import warnings
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_twilio import MockTwilio, PARENT_ACCOUNT_SID
+
+BENCH_SUBACCOUNTS = int(os.getenv('BENCH_SUBACCOUNTS', '500'))
+BENCH_NUMBERS = int(os.getenv('BENCH_NUMBERS', '200'))
+BENCH_CONVERSATIONS = int(os.getenv('BENCH_CONVERSATIONS', '200'))
+BENCH_MESSAGES = int(os.getenv('BENCH_MESSAGES', '50'))
+BENCH_LATENCY = float(os.getenv('BENCH_LATENCY', '0.02'))
+BENCH_RATE_LIMIT = float(os.getenv('BENCH_RATE_LIMIT', '0'))
+BENCH_RETRY_AFTER = int(os.getenv('BENCH_RETRY_AFTER', '0'))
+
+BASELINE_PATH = os.getenv('BENCH_BASELINE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'))
+RESULTS_PATH = os.getenv('BENCH_RESULTS', 'bench_results.json')
+
+def scale():
+	return {
+		'subaccounts': BENCH_SUBACCOUNTS,
+		'numbers_per_subaccount': BENCH_NUMBERS,
+		'conversations': BENCH_CONVERSATIONS,
+		'messages_per_conversation': BENCH_MESSAGES,
+		'latency': BENCH_LATENCY,
+		'rate_limit': BENCH_RATE_LIMIT
+	}
+
+@pytest.fixture(scope='session')
+def mock_twilio():
+	server = MockTwilio(
+		subaccounts=BENCH_SUBACCOUNTS,
+		numbers_per_subaccount=BENCH_NUMBERS,
+		conversations=BENCH_CONVERSATIONS,
+		messages_per_conversation=BENCH_MESSAGES,
+		latency=BENCH_LATENCY,
+		rate_limit=BENCH_RATE_LIMIT,
+		retry_after=BENCH_RETRY_AFTER
+	)
+	base_url = server.start()
+	db_dir = tempfile.mkdtemp(prefix='butler-bench-')
+	os.environ.update({
+		'TWILIO_API_BASE_URL': base_url,
+		'TWILIO_ACCOUNT_SID': PARENT_ACCOUNT_SID,
+		'TWILIO_AUTH_TOKEN': 'benchmark',
+		'BUTLER_DB_PATH': os.path.join(db_dir, 'butler.db'),
+		'BADGE_WORKER_ENABLED': 'false'
+	})
+	yield server
+	server.stop()
+
+@pytest.fixture(scope='session')
+def client(mock_twilio):
+	# Imported once the environment points at the mock server
+	import api
+	return api.app.test_client()
+
+@pytest.fixture(scope='session')
+def baseline():
+	if not os.path.exists(BASELINE_PATH):
+		reason = f'no baseline at {BASELINE_PATH}'
+	else:
+		with open(BASELINE_PATH) as f:
+			baseline = json.load(f)
+		# Timings are only comparable at the same scale
+		if baseline.get('scale') == scale():
+			return baseline
+		reason = f'the baseline at {BASELINE_PATH} was recorded at another scale'
+	unchecked['reason'] = reason
+	warnings.warn(f'p50 regressions are not checked: {reason}, record one with BENCH_UPDATE_BASELINE=1')
+	return None
+
+# Filled by the benchmarks, reported and saved at the end of the session
+results = {}
+# Routes whose p50 had no baseline to be compared with, and why
+unchecked = {'routes': [], 'reason': None}
+
+def pytest_terminal_summary(terminalreporter):
+	if not results:
+		return
+	report = {'scale': scale(), 'routes': results}
+	with open(RESULTS_PATH, 'w') as f:
+		json.dump(report, f, indent=2, sort_keys=True)
+	if os.getenv('BENCH_UPDATE_BASELINE'):
+		with open(BASELINE_PATH, 'w') as f:
+			json.dump(report, f, indent=2, sort_keys=True)
+
+	write = terminalreporter.write_line
+	write('')
+	write(f"{'route':<72} {'req/s':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'calls':>7}")
+	for name, result in sorted(results.items()):
+		write(f"{name:<72} {result['throughput']:>8.1f} {result['p50'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f} {result['twilio_calls']:>7.1f}")
+	write(f'results written to {RESULTS_PATH}')
+	if unchecked['routes']:
+		write(f"{len(unchecked['routes'])} of {len(results)} routes not compared with a baseline "
+			f"({unchecked['reason'] or 'missing from it'}), record one with BENCH_UPDATE_BASELINE=1", yellow=True)
+
+@pytest.fixture(scope='session')
+def bench_results():
+	return results
+
+@pytest.fixture(scope='session')
+def unchecked_routes():
+	return unchecked['routes']
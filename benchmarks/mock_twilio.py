@@ -0,0 +1,342 @@
+"""
+Local stand-in for the parts of the Twilio REST API used by the services.
+
+Point the services at it with TWILIO_API_BASE_URL (see services/client_registry.py):
+
+	server = MockTwilio(subaccounts=100, numbers_per_subaccount=5, latency=0.02)
+	base_url = server.start()
+	os.environ['TWILIO_API_BASE_URL'] = base_url
+	...
+	server.stop()
+"""
+from aiohttp import web
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import asyncio
+import random
+import threading
+
+PARENT_ACCOUNT_SID = 'AC' + '0' * 32
+
+def _sid(prefix, *numbers):
+	return prefix + ''.join(f'{n:08d}' for n in numbers).rjust(32, '0')
+
+def _rfc2822(dt):
+	return format_datetime(dt)
+
+def _iso8601(dt):
+	return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+class MockTwilio:
+	"""
+	In-memory fixture set served over HTTP with optional injected latency and rate limiting.
+
+	Args:
+		subaccounts: Number of subaccounts under the parent account.
+		numbers_per_subaccount: IncomingPhoneNumbers per subaccount.
+		conversations: Conversations visible to the parent account.
+		participants_per_conversation: Participants per conversation.
+		messages_per_conversation: Messages per conversation.
+		latency: Seconds to sleep before answering each request.
+		rate_limit: Fraction of requests answered with a 429, like Twilio's concurrency limit.
+		retry_after: Retry-After header value of the 429 responses, in seconds.
+		seed: Seed of the rate limiting draws, so runs are reproducible.
+	"""
+	def __init__(self, subaccounts=10, numbers_per_subaccount=5, conversations=0,
+			participants_per_conversation=2, messages_per_conversation=0, latency=0.0,
+			rate_limit=0.0, retry_after=1, seed=0):
+		self.latency = latency
+		self.rate_limit = rate_limit
+		self.retry_after = retry_after
+		self._random = random.Random(seed)
+		self.request_count = 0
+		self.rate_limited_count = 0
+		self._loop = None
+		self._thread = None
+		self._runner = None
+		self._started = threading.Event()
+
+		now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+		self.accounts = {}
+		self.phone_numbers = {}
+		self.credential_lists = {}
+		for i in range(subaccounts):
+			sid = _sid('AC', 1, i)
+			self.accounts[sid] = {
+				'sid': sid,
+				'owner_account_sid': PARENT_ACCOUNT_SID,
+				'friendly_name': f'Subaccount {i}',
+				'status': 'active',
+				'type': 'Full',
+				'auth_token': f'token{i}',
+				'date_created': _rfc2822(now + timedelta(minutes=i)),
+				'date_updated': _rfc2822(now + timedelta(minutes=i)),
+				'uri': f'/2010-04-01/Accounts/{sid}.json'
+			}
+			numbers = {}
+			for j in range(numbers_per_subaccount):
+				pn_sid = _sid('PN', i, j)
+				# Every third number is missing its emergency address
+				registered = j % 3 != 2
+				numbers[pn_sid] = {
+					'sid': pn_sid,
+					'account_sid': sid,
+					'phone_number': f'+1555{i:03d}{j:04d}',
+					'friendly_name': f'({i:03d}) {j:04d}',
+					'status': 'in-use',
+					'emergency_address_sid': _sid('AD', i, j) if registered else None,
+					'emergency_address_status': 'registered' if registered else 'unregistered',
+					'date_created': _rfc2822(now + timedelta(hours=j)),
+					'date_updated': _rfc2822(now + timedelta(hours=j))
+				}
+			self.phone_numbers[sid] = numbers
+			# Half the subaccounts have basic auth for media enabled
+			self.credential_lists[sid] = [{'sid': _sid('CL', i), 'friendly_name': 'media'}] if i % 2 == 0 else []
+
+		self.conversations = {}
+		self.participants = {}
+		self.messages = {}
+		for i in range(conversations):
+			sid = _sid('CH', i)
+			self.conversations[sid] = {
+				'sid': sid,
+				'account_sid': PARENT_ACCOUNT_SID,
+				'friendly_name': f'Conversation {i}',
+				'state': 'active',
+				'date_created': _iso8601(now + timedelta(minutes=i)),
+				'date_updated': _iso8601(now + timedelta(minutes=i))
+			}
+			self.participants[sid] = [{
+				'sid': _sid('MB', i, k),
+				'conversation_sid': sid,
+				'identity': None,
+				'messaging_binding': {'type': 'sms', 'address': f'+1555{i % 1000:03d}{k:04d}'},
+				'date_created': _iso8601(now),
+				'date_updated': _iso8601(now)
+			} for k in range(participants_per_conversation)]
+			self.messages[sid] = [{
+				'sid': _sid('IM', i, k),
+				'conversation_sid': sid,
+				'account_sid': PARENT_ACCOUNT_SID,
+				'index': k,
+				'author': self.participants[sid][k % participants_per_conversation]['messaging_binding']['address'] if participants_per_conversation else 'system',
+				'body': f'Message {k} of conversation {i}',
+				'participant_sid': None,
+				'attributes': '{}',
+				'date_created': _iso8601(now + timedelta(seconds=k)),
+				'date_updated': _iso8601(now + timedelta(seconds=k))
+			} for k in range(messages_per_conversation)]
+
+	def start(self, host='127.0.0.1', port=0):
+		"""Serve on a background thread and return the base URL."""
+		self._thread = threading.Thread(target=self._serve, args=(host, port), daemon=True)
+		self._thread.start()
+		self._started.wait()
+		return f'http://{host}:{self.port}'
+
+	def stop(self):
+		if self._loop:
+			asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+			self._loop.call_soon_threadsafe(self._loop.stop)
+			self._thread.join()
+
+	def _serve(self, host, port):
+		self._loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self._loop)
+		app = web.Application(middlewares=[self._middleware])
+		app.add_routes([
+			web.get('/2010-04-01/Accounts.json', self.list_accounts),
+			web.get('/2010-04-01/Accounts/{account}.json', self.fetch_account),
+			web.post('/2010-04-01/Accounts/{account}.json', self.update_account),
+			web.get('/2010-04-01/Accounts/{account}/IncomingPhoneNumbers.json', self.list_phone_numbers),
+			web.post('/2010-04-01/Accounts/{account}/IncomingPhoneNumbers.json', self.create_phone_number),
+			web.get('/2010-04-01/Accounts/{account}/IncomingPhoneNumbers/{sid}.json', self.fetch_phone_number),
+			web.post('/2010-04-01/Accounts/{account}/IncomingPhoneNumbers/{sid}.json', self.update_phone_number),
+			web.delete('/2010-04-01/Accounts/{account}/IncomingPhoneNumbers/{sid}.json', self.delete_phone_number),
+			web.get('/2010-04-01/Accounts/{account}/SIP/CredentialLists.json', self.list_credential_lists),
+			web.get('/2010-04-01/Accounts/{account}/AvailablePhoneNumbers/{country}/{type}.json', self.list_available_phone_numbers),
+			web.get('/v1/Conversations', self.list_conversations),
+			web.get('/v1/Conversations/{conversation}/Participants', self.list_participants),
+			web.get('/v1/Conversations/{conversation}/Messages', self.list_messages),
+			web.get('/v1/Conversations/{conversation}/Messages/{sid}', self.fetch_message),
+		])
+		self._runner = web.AppRunner(app, access_log=None)
+		self._loop.run_until_complete(self._runner.setup())
+		site = web.TCPSite(self._runner, host, port)
+		self._loop.run_until_complete(site.start())
+		self.port = site._server.sockets[0].getsockname()[1]
+		self._started.set()
+		self._loop.run_forever()
+		self._loop.close()
+
+	@web.middleware
+	async def _middleware(self, request, handler):
+		self.request_count += 1
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		if self.rate_limit and self._random.random() < self.rate_limit:
+			self.rate_limited_count += 1
+			return web.json_response(
+				{'code': 20429, 'message': 'Too Many Requests', 'status': 429},
+				status=429,
+				headers={'Retry-After': str(self.retry_after)}
+			)
+		return await handler(request)
+
+	def _page_2010(self, request, key, records):
+		page_size = int(request.query.get('PageSize', 50))
+		page = int(request.query.get('Page', 0))
+		start = page * page_size
+		chunk = records[start:start + page_size]
+		next_page_uri = None
+		if start + page_size < len(records):
+			next_page_uri = f'{request.path}?PageSize={page_size}&Page={page + 1}'
+		return web.json_response({
+			key: chunk,
+			'page': page,
+			'page_size': page_size,
+			'start': start,
+			'end': start + len(chunk) - 1,
+			'uri': request.path_qs,
+			'first_page_uri': f'{request.path}?PageSize={page_size}&Page=0',
+			'next_page_uri': next_page_uri,
+			'previous_page_uri': None
+		})
+
+	def _page_v1(self, request, key, records):
+		page_size = int(request.query.get('PageSize', 50))
+		page = int(request.query.get('Page', 0))
+		start = page * page_size
+		chunk = records[start:start + page_size]
+		base = f'https://conversations.twilio.com{request.path}'
+		order = f"&Order={request.query['Order']}" if 'Order' in request.query else ''
+		next_page_url = None
+		if start + page_size < len(records):
+			next_page_url = f'{base}?PageSize={page_size}&Page={page + 1}{order}'
+		return web.json_response({
+			key: chunk,
+			'meta': {
+				'page': page,
+				'page_size': page_size,
+				'first_page_url': f'{base}?PageSize={page_size}&Page=0',
+				'previous_page_url': None,
+				'url': base,
+				'next_page_url': next_page_url,
+				'key': key
+			}
+		})
+
+	def _not_found(self):
+		return web.json_response({'code': 20404, 'message': 'The requested resource was not found', 'status': 404}, status=404)
+
+	async def list_accounts(self, request):
+		return self._page_2010(request, 'accounts', list(self.accounts.values()))
+
+	async def fetch_account(self, request):
+		account = self.accounts.get(request.match_info['account'])
+		return web.json_response(account) if account else self._not_found()
+
+	async def update_account(self, request):
+		account = self.accounts.get(request.match_info['account'])
+		if not account:
+			return self._not_found()
+		form = await request.post()
+		if 'FriendlyName' in form:
+			account['friendly_name'] = form['FriendlyName']
+		if 'Status' in form:
+			account['status'] = form['Status']
+		account['date_updated'] = _rfc2822(datetime.now(timezone.utc))
+		return web.json_response(account)
+
+	async def list_phone_numbers(self, request):
+		numbers = list(self.phone_numbers.get(request.match_info['account'], {}).values())
+		if 'PhoneNumber' in request.query:
+			numbers = [number for number in numbers if number['phone_number'] == request.query['PhoneNumber']]
+		return self._page_2010(request, 'incoming_phone_numbers', numbers)
+
+	async def create_phone_number(self, request):
+		numbers = self.phone_numbers.get(request.match_info['account'])
+		if numbers is None:
+			return self._not_found()
+		form = await request.post()
+		phone_number = form.get('PhoneNumber')
+		if any(number['phone_number'] == phone_number for numbers in self.phone_numbers.values() for number in numbers.values()):
+			return web.json_response({'code': 21422, 'message': 'PhoneNumber requested is not available', 'status': 400}, status=400)
+		pn_sid = _sid('PN', len(self.accounts) + 1, sum(len(numbers) for numbers in self.phone_numbers.values()) + 1, len(numbers))
+		now = _rfc2822(datetime.now(timezone.utc))
+		emergency_address_sid = form.get('EmergencyAddressSid') or None
+		numbers[pn_sid] = {
+			'sid': pn_sid,
+			'account_sid': request.match_info['account'],
+			'phone_number': phone_number,
+			'friendly_name': form.get('FriendlyName') or phone_number,
+			'status': 'in-use',
+			'emergency_address_sid': emergency_address_sid,
+			'emergency_address_status': 'registered' if emergency_address_sid else 'unregistered',
+			'date_created': now,
+			'date_updated': now
+		}
+		return web.json_response(numbers[pn_sid], status=201)
+
+	async def fetch_phone_number(self, request):
+		number = self.phone_numbers.get(request.match_info['account'], {}).get(request.match_info['sid'])
+		return web.json_response(number) if number else self._not_found()
+
+	async def update_phone_number(self, request):
+		number = self.phone_numbers.get(request.match_info['account'], {}).get(request.match_info['sid'])
+		if not number:
+			return self._not_found()
+		form = await request.post()
+		if 'EmergencyAddressSid' in form:
+			number['emergency_address_sid'] = form['EmergencyAddressSid'] or None
+			number['emergency_address_status'] = 'registered' if form['EmergencyAddressSid'] else 'unregistered'
+		if 'FriendlyName' in form:
+			number['friendly_name'] = form['FriendlyName']
+		return web.json_response(number)
+
+	async def delete_phone_number(self, request):
+		number = self.phone_numbers.get(request.match_info['account'], {}).pop(request.match_info['sid'], None)
+		return web.Response(status=204) if number else self._not_found()
+
+	async def list_credential_lists(self, request):
+		return self._page_2010(request, 'credential_lists', self.credential_lists.get(request.match_info['account'], []))
+
+	async def list_available_phone_numbers(self, request):
+		# Generated from the query, the same search always returns the same numbers
+		country = request.match_info['country']
+		number_type = request.match_info['type']
+		area_code = request.query.get('AreaCode') or {'Local': '555', 'Mobile': '556', 'TollFree': '800'}.get(number_type, '555')
+		page_size = int(request.query.get('PageSize', 50))
+		numbers = [{
+			'phone_number': f'+1{area_code}{7000000 + k:07d}',
+			'friendly_name': f'({area_code}) {700 + k // 10000:03d}-{k % 10000:04d}',
+			'iso_country': country,
+			'locality': 'Springfield',
+			'region': 'IL',
+			'postal_code': '62701',
+			'capabilities': {'voice': True, 'SMS': True, 'MMS': number_type != 'TollFree'}
+		} for k in range(page_size)]
+		return web.json_response({'available_phone_numbers': numbers, 'uri': request.path_qs})
+
+	async def list_conversations(self, request):
+		return self._page_v1(request, 'conversations', list(self.conversations.values()))
+
+	async def list_participants(self, request):
+		participants = self.participants.get(request.match_info['conversation'])
+		if participants is None:
+			return self._not_found()
+		return self._page_v1(request, 'participants', participants)
+
+	async def list_messages(self, request):
+		messages = self.messages.get(request.match_info['conversation'])
+		if messages is None:
+			return self._not_found()
+		if request.query.get('Order') == 'desc':
+			messages = messages[::-1]
+		return self._page_v1(request, 'messages', messages)
+
+	async def fetch_message(self, request):
+		for message in self.messages.get(request.match_info['conversation'], []):
+			if message['sid'] == request.match_info['sid']:
+				return web.json_response(message)
+		return self._not_found()
@@ -0,0 +1,199 @@
+from bisect import bisect_left, bisect_right
+import base64
+import json
+import os
+import threading
+import time
+
+# How long the index is served before it is re-synced with Twilio in the background
+ACCOUNT_INDEX_TTL = int(os.getenv('ACCOUNT_INDEX_TTL', '300'))
+ACCOUNT_PAGE_SIZE = int(os.getenv('ACCOUNT_PAGE_SIZE', '1000'))
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 200
+
+SORT_FIELDS = ('friendly_name', 'date_created', 'date_updated', 'status', 'sid')
+STATUSES = ('active', 'suspended', 'closed')
+
+def extract_account_data(account):
+	return {
+		'sid': account.sid,
+		'friendly_name': account.friendly_name,
+		'status': account.status,
+		'date_created': account.date_created.isoformat() if account.date_created else None,
+		'date_updated': account.date_updated.isoformat() if account.date_updated else None,
+		'owner_account_sid': account.owner_account_sid
+	}
+
+def _sort_value(record, sort):
+	value = record.get(sort) or ''
+	return value.lower() if sort == 'friendly_name' else value
+
+def encode_cursor(sort, order, record):
+	payload = json.dumps({'sort': sort, 'order': order, 'value': _sort_value(record, sort), 'sid': record['sid']})
+	return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+	try:
+		padded = cursor + '=' * (-len(cursor) % 4)
+		payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+		return payload['sort'], payload['order'], payload['value'], payload['sid']
+	except (ValueError, KeyError, TypeError):
+		raise ValueError('Invalid cursor')
+
+class AccountIndex:
+	"""
+	Locally cached, sorted view of all the accounts, so listing pages doesn't cost a full Twilio listing.
+
+	The first query loads every account. After ttl seconds, queries keep being served from the
+	index while it is re-synced in the background; writes made through SubaccountService are
+	applied to it directly with upsert().
+
+	Args:
+		loader: Callable returning every AccountInstance.
+		ttl: Seconds before the index is re-synced.
+	"""
+	def __init__(self, loader, ttl=ACCOUNT_INDEX_TTL):
+		self.loader = loader
+		self.ttl = ttl
+		self._records = {}
+		self._sorted = {}
+		self._loaded_at = None
+		self._refreshing = False
+		self._lock = threading.RLock()
+		self._load_lock = threading.Lock()
+
+	def refresh(self):
+		with self._load_lock:
+			records = {account.sid: extract_account_data(account) for account in self.loader()}
+			with self._lock:
+				if records != self._records:
+					self._records = records
+					self._sorted = {}
+				self._loaded_at = time.monotonic()
+				self._refreshing = False
+
+	def ensure_fresh(self):
+		with self._lock:
+			loaded_at = self._loaded_at
+			if loaded_at is not None:
+				if time.monotonic() - loaded_at > self.ttl and not self._refreshing:
+					# Serve the current index while it is re-synced
+					self._refreshing = True
+					threading.Thread(target=self._refresh_in_background, daemon=True).start()
+				return
+		self.refresh()
+
+	def _refresh_in_background(self):
+		try:
+			self.refresh()
+		except Exception as e:
+			print(f"Error refreshing account index: {e}")
+			with self._lock:
+				self._refreshing = False
+
+	def upsert(self, account):
+		with self._lock:
+			self._records[account.sid] = extract_account_data(account)
+			self._sorted = {}
+
+	def remove(self, account_sid):
+		with self._lock:
+			if self._records.pop(account_sid, None) is not None:
+				self._sorted = {}
+
+	def all(self):
+		self.ensure_fresh()
+		with self._lock:
+			return list(self._records.values())
+
+	def _sorted_view(self, sort):
+		# Callers hold the lock. Views are rebuilt lazily after a change.
+		view = self._sorted.get(sort)
+		if view is None:
+			records = sorted(self._records.values(), key=lambda record: (_sort_value(record, sort), record['sid']))
+			view = ([(_sort_value(record, sort), record['sid']) for record in records], records)
+			self._sorted[sort] = view
+		return view
+
+	def query(self, page=None, page_size=DEFAULT_PAGE_SIZE, cursor=None, status=None,
+			friendly_name=None, search=None, sort='friendly_name', order='asc'):
+		"""
+		Return one page of accounts.
+
+		Args:
+			page: 1-based page number. Ignored when a cursor is given.
+			page_size: Accounts per page, at most MAX_PAGE_SIZE.
+			cursor: next_cursor of the previous page.
+			status: Only accounts with this status.
+			friendly_name: Only accounts whose friendly name starts with this prefix (case-insensitive).
+			search: Only accounts whose friendly name or SID contains this text (case-insensitive).
+			sort: One of SORT_FIELDS.
+			order: 'asc' or 'desc'.
+		"""
+		if sort not in SORT_FIELDS:
+			raise ValueError(f"sort must be one of {', '.join(SORT_FIELDS)}")
+		if order not in ('asc', 'desc'):
+			raise ValueError("order must be 'asc' or 'desc'")
+		if status and status not in STATUSES:
+			raise ValueError(f"status must be one of {', '.join(STATUSES)}")
+		if page_size < 1 or page_size > MAX_PAGE_SIZE:
+			raise ValueError(f'page_size must be between 1 and {MAX_PAGE_SIZE}')
+		if page is not None and page < 1:
+			raise ValueError('page must be positive')
+
+		prefix = friendly_name.lower() if friendly_name else None
+		search = search.lower() if search else None
+
+		def matches(record):
+			if status and record['status'] != status:
+				return False
+			name = (record['friendly_name'] or '').lower()
+			if prefix and not name.startswith(prefix):
+				return False
+			if search and search not in name and search not in record['sid'].lower():
+				return False
+			return True
+
+		self.ensure_fresh()
+		with self._lock:
+			keys, records = self._sorted_view(sort)
+			if order == 'asc':
+				positions = range(len(records))
+			else:
+				positions = range(len(records) - 1, -1, -1)
+
+			if cursor:
+				cursor_sort, cursor_order, value, sid = decode_cursor(cursor)
+				if (cursor_sort, cursor_order) != (sort, order):
+					raise ValueError('cursor does not match sort and order')
+				# Resume right after the last record of the previous page
+				if order == 'asc':
+					positions = range(bisect_right(keys, (value, sid)), len(records))
+				else:
+					positions = range(bisect_left(keys, (value, sid)) - 1, -1, -1)
+				page = None
+
+			skip = (page - 1) * page_size if page else 0
+			items = []
+			has_more = False
+			for position in positions:
+				record = records[position]
+				if not matches(record):
+					continue
+				if skip:
+					skip -= 1
+					continue
+				if len(items) == page_size:
+					has_more = True
+					break
+				items.append(record)
+
+			total = sum(1 for record in records if matches(record)) if (status or prefix or search) else len(records)
+
+		return {
+			'items': items,
+			'page': page,
+			'page_size': page_size,
+			'total': total,
+			'next_cursor': encode_cursor(sort, order, items[-1]) if has_more else None
+		}
@@ -0,0 +1,63 @@
+from urllib3.util.retry import Retry
+from aiohttp_retry import ExponentialRetry, RetryClient
+import asyncio
+import time
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+from services.client_registry import (
+	TWILIO_MAX_RETRIES, TWILIO_RETRY_BACKOFF, TWILIO_HTTP_TIMEOUT, RETRY_STATUSES,
+	parent_account_sid, rewrite_url, twilio_client_class, _rate_limited
+)
+from services.metrics import metrics
+from services.parent_accounts import parent_registry
+from services.rate_limiter import rate_limiter, parse_retry_after
+
+class AsyncPooledHttpClient(AsyncTwilioHttpClient):
+	"""
+	AsyncTwilioHttpClient with the same retry and timeout settings as the pooled sync client.
+	aiohttp sessions are bound to an event loop, so these are not shared through the registry:
+	create one per loop (e.g. per request) and close it when done.
+	"""
+	def __init__(self, max_retries=TWILIO_MAX_RETRIES, backoff_factor=TWILIO_RETRY_BACKOFF,
+			timeout=TWILIO_HTTP_TIMEOUT, parent_sid=None):
+		super().__init__(pool_connections=True, timeout=timeout)
+		self.max_retries = max_retries
+		self.parent_sid = parent_sid
+		if max_retries:
+			retry_options = ExponentialRetry(
+				attempts=max_retries + 1,
+				start_timeout=backoff_factor,
+				retry_all_server_errors=False,
+				evaluate_response_callback=self._should_keep_response
+			)
+			self.session = RetryClient(client_session=self.session, retry_options=retry_options)
+
+	@staticmethod
+	async def _should_keep_response(response):
+		# Mirror the sync client: only idempotent methods are retried on 5xx
+		return not (response.status in RETRY_STATUSES and response.method in Retry.DEFAULT_ALLOWED_METHODS)
+
+	async def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None, allow_redirects=False):
+		parent_sid = parent_account_sid(self.parent_sid)
+		for attempt in range(self.max_retries + 1):
+			await asyncio.sleep(rate_limiter.acquire(url, auth, parent_sid))
+			started = time.perf_counter()
+			status = None
+			try:
+				response = await super().request(method, rewrite_url(url), params, data, headers, auth, timeout, allow_redirects)
+				status = response.status_code
+			finally:
+				metrics.record_twilio_call(method, url, status or 'error', time.perf_counter() - started)
+				retry_after = parse_retry_after(response.headers.get('Retry-After')) if status == 429 and response.headers else None
+				rate_limiter.record(url, auth, parent_sid, status, retry_after)
+			if status != 429:
+				return response
+			if attempt < self.max_retries:
+				await asyncio.sleep(rate_limiter.backoff(attempt, retry_after))
+		raise _rate_limited(retry_after)
+
+def get_async_client(http_client, username=None, password=None, account_sid=None, parent=None):
+	# Async clients are cheap wrappers around a caller-owned AsyncPooledHttpClient
+	parent = parent_registry.resolve(parent)
+	username = username or parent.account_sid
+	password = password or parent.auth_token
+	return twilio_client_class()(username, password, account_sid=account_sid, http_client=http_client)
@@ -0,0 +1,56 @@
+import asyncio
+import os
+from services.async_client import AsyncPooledHttpClient, get_async_client
+from services.conversations_service import extract_conversation_data, participant_matches
+
+# Upper bound on concurrent participant lookups
+PARTICIPANT_CONCURRENCY = int(os.getenv('PARTICIPANT_CONCURRENCY', '16'))
+
+class AsyncConversationsService:
+	"""
+	asyncio counterpart of ConversationsService. Like AsyncSubaccountService, use it as an
+	async context manager within one event loop.
+	"""
+	def __init__(self, concurrency=PARTICIPANT_CONCURRENCY, parent=None):
+		self.parent = parent
+		self.http_client = AsyncPooledHttpClient(parent_sid=parent.account_sid if parent else None)
+		self.semaphore = asyncio.Semaphore(concurrency)
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *excinfo):
+		await self.close()
+
+	async def close(self):
+		await self.http_client.close()
+
+	async def _has_participant(self, client, conversation_sid, phone_number):
+		async with self.semaphore:
+			try:
+				participants = await client.conversations.v1.conversations(conversation_sid).participants.list_async()
+			except Exception as participant_error:
+				print(f"Error fetching participants for conversation {conversation_sid}: {participant_error}")
+				return False
+		return any(participant_matches(participant, phone_number) for participant in participants)
+
+	async def list_conversations(self, subaccount_sid, phone_number=None):
+		client = get_async_client(self.http_client, account_sid=subaccount_sid, parent=self.parent)
+
+		try:
+			conversations = await client.conversations.v1.conversations.list_async()
+			if not phone_number:
+				return [extract_conversation_data(conversation) for conversation in conversations]
+
+			# Check every conversation's participants concurrently
+			matches = await asyncio.gather(*(
+				self._has_participant(client, conversation.sid, phone_number) for conversation in conversations
+			))
+		except Exception as e:
+			print(f"Error fetching conversations: {e}")
+			raise e
+
+		return [
+			extract_conversation_data(conversation)
+			for conversation, match in zip(conversations, matches) if match
+		]
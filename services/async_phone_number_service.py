@@ -0,0 +1,40 @@
+import asyncio
+from services.async_client import get_async_client
+from services.events import event_bus, PHONE_NUMBER_RELEASED
+from services.parent_accounts import parent_registry
+from services.phone_number_service import PHONE_NUMBER_PAGE_SIZE, RELEASE_CONCURRENCY, extract_phone_number_data
+
+class AsyncPhoneNumberService:
+	"""
+	asyncio counterpart of PhoneNumberService.
+
+	Args:
+		http_client: AsyncPooledHttpClient owned by the caller.
+		subaccount_sid: Subaccount to act on, defaults to the parent account.
+		subaccount_auth_token: Auth token of the subaccount.
+		concurrency: Maximum number of releases in flight at once.
+	"""
+	def __init__(self, http_client, subaccount_sid=None, subaccount_auth_token=None, concurrency=RELEASE_CONCURRENCY):
+		self.client = get_async_client(http_client, subaccount_sid, subaccount_auth_token)
+		self.subaccount_sid = subaccount_sid or parent_registry.default.account_sid
+		self.semaphore = asyncio.Semaphore(concurrency)
+
+	async def list_phone_numbers_details(self, page_size=None):
+		phone_numbers = await self.client.incoming_phone_numbers.list_async(page_size=page_size or PHONE_NUMBER_PAGE_SIZE)
+
+		return [extract_phone_number_data(pn) for pn in phone_numbers]
+
+	async def release_phone_number(self, phone_number_sid):
+		async with self.semaphore:
+			# The number doesn't need to be fetched to be updated or deleted
+			phone_number = self.client.incoming_phone_numbers(phone_number_sid)
+			# First, remove the emergency address before releasing the number
+			await phone_number.update_async(emergency_address_sid="")
+			await phone_number.delete_async()
+		event_bus.publish(PHONE_NUMBER_RELEASED, self.subaccount_sid, sid=phone_number_sid)
+		return f'Phone number {phone_number_sid} released successfully.'
+
+	async def release_all_phone_numbers(self):
+		phone_numbers = await self.list_phone_numbers_details()
+
+		return await asyncio.gather(*(self.release_phone_number(pn['sid']) for pn in phone_numbers))
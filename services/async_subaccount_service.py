@@ -0,0 +1,128 @@
+import asyncio
+from services.async_phone_number_service import AsyncPhoneNumberService
+from services.cache import TTLCache
+from services.rate_limiter import TwilioUnavailableError
+from services.async_client import AsyncPooledHttpClient, get_async_client
+from services.subaccount_service import (
+	ACCOUNT_CACHE_SIZE, AUTH_TOKEN_CACHE_TTL, BADGE_CONCURRENCY, summarize_emergency_status
+)
+
+class AsyncSubaccountService:
+	"""
+	asyncio counterpart of SubaccountService for the fan-out operations (badge scans, bulk releases).
+
+	The underlying aiohttp session is bound to the running event loop, so use it as an
+	async context manager within one loop:
+
+		async with AsyncSubaccountService() as service:
+			badges = await service.get_badges_many(sids)
+
+	Args:
+		auth_token_cache: TTLCache of subaccount auth tokens, pass SubaccountService.auth_token_cache to share it.
+		concurrency: Maximum number of subaccounts scanned at once.
+		parent: ParentAccount the subaccounts belong to, the default parent if None.
+	"""
+	def __init__(self, auth_token_cache=None, concurrency=BADGE_CONCURRENCY, parent=None):
+		self.http_client = AsyncPooledHttpClient(parent_sid=parent.account_sid if parent else None)
+		self.client = get_async_client(self.http_client, parent=parent)
+		self.auth_token_cache = auth_token_cache or TTLCache(maxsize=ACCOUNT_CACHE_SIZE, ttl=AUTH_TOKEN_CACHE_TTL)
+		self.semaphore = asyncio.Semaphore(concurrency)
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *excinfo):
+		await self.close()
+
+	async def close(self):
+		await self.http_client.close()
+
+	async def get_account(self, subaccount_sid):
+		account = await self.client.api.accounts(subaccount_sid).fetch_async()
+		self.auth_token_cache.set(account.sid, account.auth_token)
+		return account
+
+	async def get_auth_token(self, subaccount_sid):
+		auth_token = self.auth_token_cache.get(subaccount_sid)
+		if auth_token is None:
+			auth_token = (await self.get_account(subaccount_sid)).auth_token
+		return auth_token
+
+	async def get_phone_numbers(self, subaccount_sid, subaccount_auth_token=None, page_size=None):
+		if subaccount_auth_token is None:
+			subaccount_auth_token = await self.get_auth_token(subaccount_sid)
+
+		phone_number_service = AsyncPhoneNumberService(self.http_client, subaccount_sid, subaccount_auth_token)
+		return await phone_number_service.list_phone_numbers_details(page_size=page_size)
+
+	async def check_all_emergencies_registered(self, subaccount_sid, subaccount_auth_token=None):
+		try:
+			phone_numbers_data = await self.get_phone_numbers(subaccount_sid, subaccount_auth_token)
+
+			return summarize_emergency_status(phone_numbers_data)
+		except TwilioUnavailableError:
+			raise
+		except Exception as e:
+			print(f"Error checking emergency addresses for subaccount {subaccount_sid}: {e}")
+			return "failed"
+
+	async def check_basic_auth_media(self, subaccount_sid):
+		try:
+			credential_lists = await self.client.api.accounts(subaccount_sid).sip.credential_lists.list_async(limit=1)
+
+			return len(credential_lists) > 0
+		except TwilioUnavailableError:
+			raise
+		except Exception as e:
+			print(f"Error checking basic auth media for subaccount {subaccount_sid}: {e}")
+			return False
+
+	async def get_badges(self, subaccount_sid):
+		async with self.semaphore:
+			auth_token = await self.get_auth_token(subaccount_sid)
+			all_emergencies_registered, basic_auth_media = await asyncio.gather(
+				self.check_all_emergencies_registered(subaccount_sid, auth_token),
+				self.check_basic_auth_media(subaccount_sid)
+			)
+
+		return {
+			'sid': subaccount_sid,
+			'allEmergenciesRegistered': all_emergencies_registered,
+			'basicAuthMedia': basic_auth_media
+		}
+
+	async def get_badges_many(self, subaccount_sids):
+		"""
+		Compute badges for many subaccounts concurrently, at most `concurrency` at a time.
+		A failing SID gets an 'error' field instead of aborting the whole batch.
+		"""
+		subaccount_sids = list(dict.fromkeys(subaccount_sids))
+		results = await asyncio.gather(*(self.get_badges(sid) for sid in subaccount_sids), return_exceptions=True)
+
+		badges = []
+		for sid, result in zip(subaccount_sids, results):
+			if isinstance(result, Exception):
+				print(f"Error computing badges for subaccount {sid}: {result}")
+				result = {
+					'sid': sid,
+					'allEmergenciesRegistered': None,
+					'basicAuthMedia': None,
+					'error': str(result)
+				}
+			badges.append(result)
+		return badges
+
+	async def close_subaccount(self, subaccount_sid, closed):
+		subaccount = await self.get_account(subaccount_sid)
+
+		# Release all phone numbers concurrently
+		phone_number_service = AsyncPhoneNumberService(self.http_client, subaccount_sid, subaccount.auth_token)
+		await phone_number_service.release_all_phone_numbers()
+
+		# Close the subaccount by updating its status
+		if closed:
+			updated_subaccount = await subaccount.update_async(status='closed')
+			self.auth_token_cache.invalidate(subaccount_sid)
+			return updated_subaccount
+		else:
+			return subaccount
@@ -0,0 +1,90 @@
+import time
+from services.db import ensure_schema
+from services.events import event_bus, BADGES_UPDATED
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS badges (
+	sid TEXT PRIMARY KEY,
+	all_emergencies_registered TEXT,
+	basic_auth_media INTEGER,
+	error TEXT,
+	last_checked REAL,
+	last_touched REAL
+);
+"""
+
+class BadgeStore:
+	"""
+	Persists the last computed badges of every subaccount, with when they were checked
+	and when the subaccount was last touched (viewed or modified) through the API.
+	"""
+	def _db(self):
+		return ensure_schema('badges', SCHEMA)
+
+	def save(self, badges):
+		# A failed computation keeps the previous badge values, only the error is recorded
+		now = time.time()
+		event_bus.publish(BADGES_UPDATED, badges['sid'], **{key: value for key, value in badges.items() if key != 'sid'})
+		if badges.get('error'):
+			self._db().execute(
+				'INSERT INTO badges (sid, error, last_checked) VALUES (?, ?, ?) '
+				'ON CONFLICT(sid) DO UPDATE SET error = excluded.error, last_checked = excluded.last_checked',
+				(badges['sid'], badges['error'], now)
+			)
+			return
+		basic_auth_media = badges.get('basicAuthMedia')
+		self._db().execute(
+			'INSERT INTO badges (sid, all_emergencies_registered, basic_auth_media, error, last_checked) VALUES (?, ?, ?, NULL, ?) '
+			'ON CONFLICT(sid) DO UPDATE SET all_emergencies_registered = excluded.all_emergencies_registered, '
+			'basic_auth_media = excluded.basic_auth_media, error = NULL, last_checked = excluded.last_checked',
+			(badges['sid'], badges.get('allEmergenciesRegistered'), None if basic_auth_media is None else int(basic_auth_media), now)
+		)
+
+	def touch(self, sid):
+		self._db().execute(
+			'INSERT INTO badges (sid, last_touched) VALUES (?, ?) '
+			'ON CONFLICT(sid) DO UPDATE SET last_touched = excluded.last_touched',
+			(sid, time.time())
+		)
+
+	def get_all(self):
+		rows = self._db().execute('SELECT * FROM badges').fetchall()
+		return {row['sid']: self._to_badges(row) for row in rows}
+
+	def get(self, sid):
+		row = self._db().execute('SELECT * FROM badges WHERE sid = ?', (sid,)).fetchone()
+		return self._to_badges(row) if row else None
+
+	def due(self, sids, max_age, limit):
+		"""
+		Pick up to `limit` of the given SIDs whose badges need recomputing, most urgent first:
+		never checked, then touched since their last check (most recently touched first),
+		then checked longer than max_age seconds ago (oldest first).
+		"""
+		rows = {row['sid']: row for row in self._db().execute('SELECT sid, last_checked, last_touched FROM badges')}
+		now = time.time()
+		candidates = []
+		for sid in sids:
+			row = rows.get(sid)
+			last_checked = row['last_checked'] if row else None
+			last_touched = row['last_touched'] if row else None
+			if last_checked is None:
+				candidates.append((0, 0, sid))
+			elif last_touched and last_touched > last_checked:
+				candidates.append((1, -last_touched, sid))
+			elif now - last_checked > max_age:
+				candidates.append((2, last_checked, sid))
+		candidates.sort()
+		return [sid for _, _, sid in candidates[:limit]]
+
+	@staticmethod
+	def _to_badges(row):
+		return {
+			'sid': row['sid'],
+			'allEmergenciesRegistered': row['all_emergencies_registered'],
+			'basicAuthMedia': None if row['basic_auth_media'] is None else bool(row['basic_auth_media']),
+			'badgesError': row['error'],
+			'badgesCheckedAt': row['last_checked']
+		}
+
+badge_store = BadgeStore()
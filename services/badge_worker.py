@@ -0,0 +1,87 @@
+import os
+import threading
+from services.badge_store import badge_store
+
+# Seconds between two scheduling passes
+BADGE_REFRESH_INTERVAL = int(os.getenv('BADGE_REFRESH_INTERVAL', '60'))
+# Badges older than this are recomputed
+BADGE_MAX_AGE = int(os.getenv('BADGE_MAX_AGE', '900'))
+# Subaccounts recomputed per pass
+BADGE_BATCH_SIZE = int(os.getenv('BADGE_BATCH_SIZE', '100'))
+
+class BadgeWorker:
+	"""
+	Background scheduler that keeps the badge store up to date.
+
+	Every interval it picks the active subaccounts whose badges are missing, stale or
+	touched since their last check (see BadgeStore.due) and recomputes them with
+	SubaccountService.iter_badges, which bounds the concurrency. trigger() requests
+	an immediate pass, optionally for specific subaccounts.
+	"""
+	def __init__(self, subaccount_service, store=badge_store, interval=BADGE_REFRESH_INTERVAL,
+			max_age=BADGE_MAX_AGE, batch_size=BADGE_BATCH_SIZE):
+		self.subaccount_service = subaccount_service
+		self.store = store
+		self.interval = interval
+		self.max_age = max_age
+		self.batch_size = batch_size
+		self._wakeup = threading.Event()
+		self._stopped = threading.Event()
+		self._requested = set()
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def start(self):
+		with self._lock:
+			if self._thread is None or not self._thread.is_alive():
+				self._stopped.clear()
+				self._thread = threading.Thread(target=self._loop, name='badge-worker', daemon=True)
+				self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		self._wakeup.set()
+
+	def trigger(self, sids=None):
+		# Requested SIDs are recomputed first, regardless of their age
+		if sids:
+			with self._lock:
+				self._requested.update(sids)
+		else:
+			with self._lock:
+				self._requested.add(None)
+		self._wakeup.set()
+
+	def touch(self, sid):
+		self.store.touch(sid)
+
+	def _loop(self):
+		while not self._stopped.is_set():
+			try:
+				self.run_once()
+			except Exception as e:
+				print(f"Error refreshing badges: {e}")
+			self._wakeup.wait(self.interval)
+			self._wakeup.clear()
+
+	def run_once(self):
+		with self._lock:
+			requested = self._requested
+			self._requested = set()
+		force_all = None in requested
+		requested.discard(None)
+
+		active = [sa['sid'] for sa in self.subaccount_service.account_index.all() if sa['status'] == 'active']
+		if force_all:
+			due = active
+		else:
+			due = list(requested) + [sid for sid in self.store.due(active, self.max_age, self.batch_size) if sid not in requested]
+		if not due:
+			return 0
+
+		print(f"Recomputing badges for {len(due)} subaccounts")
+		for badges in self.subaccount_service.iter_badges(due):
+			self.store.save(badges)
+			if self._stopped.is_set():
+				break
+		return len(due)
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import threading
+import time
+
+_MISSING = object()
+
+class TTLCache:
+	"""
+	Thread-safe in-memory cache with a per-entry time to live and LRU eviction.
+
+	Args:
+		maxsize: Maximum number of entries kept. The least recently used entry is evicted first.
+		ttl: Seconds an entry stays valid after it was stored.
+	"""
+	def __init__(self, maxsize=1024, ttl=300):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default=None):
+		with self._lock:
+			entry = self._data.get(key, _MISSING)
+			if entry is not _MISSING:
+				expires_at, value = entry
+				if expires_at > time.monotonic():
+					self._data.move_to_end(key)
+					self.hits += 1
+					return value
+				# Expired, drop it
+				del self._data[key]
+			self.misses += 1
+			return default
+
+	def set(self, key, value, ttl=None):
+		expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+		with self._lock:
+			self._data[key] = (expires_at, value)
+			self._data.move_to_end(key)
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+				self.evictions += 1
+
+	def get_or_load(self, key, loader):
+		# The loader runs outside the lock so a slow upstream call doesn't block other keys
+		value = self.get(key, _MISSING)
+		if value is _MISSING:
+			value = loader()
+			self.set(key, value)
+		return value
+
+	def invalidate(self, key):
+		with self._lock:
+			self._data.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+	def stats(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				'size': len(self._data),
+				'maxsize': self.maxsize,
+				'ttl': self.ttl,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'hit_ratio': self.hits / lookups if lookups else None
+			}
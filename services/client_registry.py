@@ -0,0 +1,181 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from twilio.http.http_client import TwilioHttpClient
+from urllib.parse import urlsplit, urlunsplit
+import os
+import threading
+import time
+from services.metrics import metrics
+from services.parent_accounts import parent_registry
+from services.rate_limiter import rate_limiter, parse_retry_after, TwilioUnavailableError
+
+# Connection pool (per parent account) and retry settings for the shared Twilio HTTP sessions
+TWILIO_POOL_SIZE = int(os.getenv('TWILIO_POOL_SIZE', '32'))
+TWILIO_MAX_RETRIES = int(os.getenv('TWILIO_MAX_RETRIES', '3'))
+TWILIO_RETRY_BACKOFF = float(os.getenv('TWILIO_RETRY_BACKOFF', '0.5'))
+TWILIO_HTTP_TIMEOUT = float(os.getenv('TWILIO_HTTP_TIMEOUT', '30'))
+# Sessions unused for this many seconds are closed
+TWILIO_CLIENT_IDLE_TIMEOUT = int(os.getenv('TWILIO_CLIENT_IDLE_TIMEOUT', '600'))
+
+# 5xx responses retried by the HTTP adapters, for idempotent methods only.
+# 429s are paced and retried by the rate limiter instead, see send_with_rate_limit.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+def twilio_client_class():
+	# twilio.rest pulls in every API domain, it is imported with the first client rather than at startup
+	from twilio.rest import Client
+	return Client
+
+def rewrite_url(url):
+	# TWILIO_API_BASE_URL sends every Twilio request to another host, e.g. a local mock server
+	base_url = os.getenv('TWILIO_API_BASE_URL')
+	if not base_url:
+		return url
+	base = urlsplit(base_url)
+	parts = urlsplit(url)
+	return urlunsplit((base.scheme, base.netloc, parts.path, parts.query, parts.fragment))
+
+def parent_account_sid(parent_sid=None):
+	return parent_sid or parent_registry.default.account_sid
+
+def _rate_limited(retry_after):
+	return TwilioUnavailableError('Twilio is rate limiting requests, try again later', retry_after=max(1, round(retry_after or 1)))
+
+class PooledHttpClient(TwilioHttpClient):
+	"""
+	TwilioHttpClient backed by a keep-alive session with a sized connection pool and retries
+	with exponential backoff on 5xx responses. Calls are paced by the rate limiter, which also
+	retries 429s, and recorded in metrics.
+	"""
+	def __init__(self, pool_size=TWILIO_POOL_SIZE, max_retries=TWILIO_MAX_RETRIES,
+			backoff_factor=TWILIO_RETRY_BACKOFF, timeout=TWILIO_HTTP_TIMEOUT, parent_sid=None):
+		super().__init__(pool_connections=True, timeout=timeout)
+		self.max_retries = max_retries
+		self.parent_sid = parent_sid
+		retry = Retry(
+			total=max_retries,
+			backoff_factor=backoff_factor,
+			status_forcelist=RETRY_STATUSES,
+			respect_retry_after_header=True,
+			raise_on_status=False
+		)
+		adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+
+	def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None, allow_redirects=False):
+		parent_sid = parent_account_sid(self.parent_sid)
+		for attempt in range(self.max_retries + 1):
+			time.sleep(rate_limiter.acquire(url, auth, parent_sid))
+			started = time.perf_counter()
+			status = None
+			try:
+				response = super().request(method, rewrite_url(url), params, data, headers, auth, timeout, allow_redirects)
+				status = response.status_code
+			finally:
+				metrics.record_twilio_call(method, url, status or 'error', time.perf_counter() - started)
+				retry_after = parse_retry_after(response.headers.get('Retry-After')) if status == 429 and response.headers else None
+				rate_limiter.record(url, auth, parent_sid, status, retry_after)
+			if status != 429:
+				return response
+			if attempt < self.max_retries:
+				time.sleep(rate_limiter.backoff(attempt, retry_after))
+		raise _rate_limited(retry_after)
+
+	def close(self):
+		self.session.close()
+
+class ClientRegistry:
+	"""
+	Process-wide registry of Twilio clients keyed by parent account, then (credential, account SID).
+
+	Every parent account gets one pooled HTTP session, sized with its pool_size and paced by
+	its own rate budget, that is reused by all the clients of the parent and its subaccounts:
+	requests share keep-alive connections and TLS sessions instead of paying for a new
+	handshake each time, and a busy parent can't use up another parent's connections.
+	Clients and sessions idle for longer than idle_timeout are dropped. Sessions are per
+	process: a forked worker starts with none and opens its own on first use.
+	"""
+	def __init__(self, pool_size=TWILIO_POOL_SIZE, max_retries=TWILIO_MAX_RETRIES,
+			backoff_factor=TWILIO_RETRY_BACKOFF, idle_timeout=TWILIO_CLIENT_IDLE_TIMEOUT):
+		self.pool_size = pool_size
+		self.max_retries = max_retries
+		self.backoff_factor = backoff_factor
+		self.idle_timeout = idle_timeout
+		self._pools = {}
+		self._lock = threading.Lock()
+		self._last_sweep = time.monotonic()
+		self._pid = os.getpid()
+
+	def get_client(self, username=None, password=None, account_sid=None, parent=None):
+		"""
+		Return a client for the given credentials, defaulting to the parent account.
+
+		Args:
+			username: Account SID used to authenticate.
+			password: Auth token used to authenticate.
+			account_sid: Account the requests act on, when it differs from username.
+			parent: ParentAccount the requests are made for, the default parent if None.
+				Its credentials are used when username and password aren't given.
+		"""
+		parent = parent_registry.resolve(parent)
+		username = username or parent.account_sid
+		password = password or parent.auth_token
+		key = (username, password, account_sid)
+		now = time.monotonic()
+
+		with self._lock:
+			if self._pid != os.getpid():
+				# Forked: the inherited sessions' sockets belong to the parent process, leave them to it
+				self._pools = {}
+				self._pid = os.getpid()
+			self._evict_idle(now)
+			pool = self._pools.get(parent.name)
+			if pool is None:
+				pool = {
+					'http_client': PooledHttpClient(parent.pool_size or self.pool_size, self.max_retries,
+						self.backoff_factor, parent_sid=parent.account_sid),
+					'clients': {},
+					'last_used': now
+				}
+				self._pools[parent.name] = pool
+			pool['last_used'] = now
+
+			entry = pool['clients'].get(key)
+			if entry is None:
+				client = twilio_client_class()(username, password, account_sid=account_sid, http_client=pool['http_client'])
+				entry = pool['clients'][key] = {'client': client, 'last_used': now}
+			entry['last_used'] = now
+			return entry['client']
+
+	def _evict_idle(self, now):
+		# Sweep at most once a minute, callers hold the lock
+		if now - self._last_sweep < 60:
+			return
+		self._last_sweep = now
+		for name, pool in list(self._pools.items()):
+			if now - pool['last_used'] > self.idle_timeout:
+				del self._pools[name]
+				pool['http_client'].close()
+				continue
+			for key, entry in list(pool['clients'].items()):
+				if now - entry['last_used'] > self.idle_timeout:
+					del pool['clients'][key]
+
+	def close(self):
+		with self._lock:
+			for pool in self._pools.values():
+				pool['http_client'].close()
+			self._pools.clear()
+
+	def stats(self):
+		with self._lock:
+			return {
+				'sessions': len(self._pools),
+				'clients': sum(len(pool['clients']) for pool in self._pools.values())
+			}
+
+client_registry = ClientRegistry()
+
+def get_client(username=None, password=None, account_sid=None, parent=None):
+	return client_registry.get_client(username, password, account_sid, parent)
@@ -1,100 +1,215 @@
-from twilio.rest import Client
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import urlsplit
+import base64
 import os
+from services.cache import TTLCache
+from services.client_registry import get_client
+from services.metrics import bind_context
+from services.parent_accounts import parent_registry
+from services.participant_index import participant_index, CONVERSATION_PAGE_SIZE
+
+MESSAGE_PAGE_SIZE = int(os.getenv('MESSAGE_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = 1000
+
+# Conversation details (last message, counts): concurrent fetches per list, how long they are
+# kept, and how much of the last message is returned
+CONVERSATION_DETAILS_CONCURRENCY = int(os.getenv('CONVERSATION_DETAILS_CONCURRENCY', '8'))
+CONVERSATION_DETAILS_TTL = int(os.getenv('CONVERSATION_DETAILS_TTL', '300'))
+MESSAGE_PREVIEW_LENGTH = int(os.getenv('MESSAGE_PREVIEW_LENGTH', '160'))
+
+# Keyed by (conversation SID, date_updated), an updated conversation gets fetched again
+conversation_details_cache = TTLCache(maxsize=10000, ttl=CONVERSATION_DETAILS_TTL)
+
+def extract_conversation_data(conversation):
+	return {
+		'sid': conversation.sid,
+		'friendlyName': conversation.friendly_name or "Unnamed Conversation",
+		'dateCreated': conversation.date_created.isoformat(),
+		'dateUpdated': conversation.date_updated.isoformat()
+	}
+
+def extract_message_data(msg):
+	return {
+		'sid': msg.sid,
+		'index': msg.index,
+		'author': msg.author,
+		'body': msg.body,
+		'dateCreated': msg.date_created.isoformat(),
+		'dateUpdated': msg.date_updated.isoformat()
+	}
+
+def encode_page_cursor(page):
+	# The cursor is Twilio's own next page URL, opaque to the client
+	url = page.next_page_url
+	return base64.urlsafe_b64encode(url.encode()).decode().rstrip('=') if url else None
+
+def decode_page_cursor(cursor, resource_list):
+	"""
+	Turn a cursor back into a Twilio page URL, refusing anything that doesn't point at the
+	same Twilio resource (the URL is requested with our credentials).
+	"""
+	try:
+		url = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode()).decode()
+	except ValueError:
+		raise ValueError('Invalid cursor')
+	parts = urlsplit(url)
+	if parts.scheme != 'https' or not parts.netloc.endswith('.twilio.com') or not parts.path.endswith(resource_list._uri):
+		raise ValueError('Invalid cursor')
+	return url
+
+def get_page(resource_list, page_size, cursor=None, **params):
+	if page_size < 1 or page_size > MAX_PAGE_SIZE:
+		raise ValueError(f'page_size must be between 1 and {MAX_PAGE_SIZE}')
+	if cursor:
+		page = resource_list.get_page(decode_page_cursor(cursor, resource_list))
+	else:
+		page = resource_list.page(page_size=page_size, **params)
+	return page
+
+def participant_matches(participant, phone_number):
+	# Match on the SMS binding address, or on the chat identity
+	messaging_binding = getattr(participant, 'messaging_binding', None)
+	if messaging_binding and isinstance(messaging_binding, dict):
+		participant_address = messaging_binding.get('address')
+		if participant_address and phone_number in participant_address:
+			return True
+	return getattr(participant, 'identity', None) == phone_number
 
 class ConversationsService:
-	def __init__(self, subaccount_sid=None, subaccount_auth_token=None):
+	def __init__(self, subaccount_sid=None, subaccount_auth_token=None, parent=None):
+		# parent: ParentAccount the subaccounts belong to, the default parent if None
+		self.parent = parent
+		resolved = parent_registry.resolve(parent)
 		if not subaccount_sid and not subaccount_auth_token:
-			self.client = Client(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
+			self.credentials = (resolved.account_sid, resolved.auth_token)
 		else:
-			self.client = Client(subaccount_sid, os.getenv('TWILIO_AUTH_TOKEN'))
+			self.credentials = (subaccount_sid, resolved.auth_token)
 		self.subaccount_sid = subaccount_sid
 
-	def list_conversations(self, subaccount_sid, phone_number=None):
+	@property
+	def client(self):
+		# Clients come from the shared registry so connections are reused across requests
+		return get_client(*self.credentials, parent=self.parent)
+
+	def _conversations(self, subaccount_sid=None):
+		# Use the subaccount SID if it's set, otherwise use the default client
+		subaccount_sid = subaccount_sid or self.subaccount_sid
+		if subaccount_sid:
+			return get_client(account_sid=subaccount_sid, parent=self.parent).conversations.v1.conversations
+		return self.client.conversations.v1.conversations
+
+	def iter_conversations(self, subaccount_sid=None, details=False):
+		# Pages are fetched lazily, memory stays flat however many conversations there are
+		conversations = (extract_conversation_data(conversation)
+			for conversation in self._conversations(subaccount_sid).stream(page_size=CONVERSATION_PAGE_SIZE))
+		if not details:
+			yield from conversations
+			return
+		# Details are added a page at a time, as the conversations arrive
+		while True:
+			batch = list(islice(conversations, CONVERSATION_PAGE_SIZE))
+			if not batch:
+				return
+			yield from self.add_details(batch, subaccount_sid)
+
+	def get_conversations_page(self, subaccount_sid=None, page_size=CONVERSATION_PAGE_SIZE, cursor=None, details=False):
+		page = get_page(self._conversations(subaccount_sid), page_size, cursor)
+		items = [extract_conversation_data(conversation) for conversation in page]
+		return {
+			'items': self.add_details(items, subaccount_sid) if details else items,
+			'next_cursor': encode_page_cursor(page)
+		}
+
+	def add_details(self, conversations, subaccount_sid=None):
+		"""
+		Add lastMessage, messageCountUpperBound and participantCount to conversation dicts, fetched
+		concurrently and cached until the conversation's date_updated changes. A conversation whose
+		details can't be fetched gets None values instead of failing the whole list.
+
+		messageCountUpperBound is the last message's index + 1. Twilio message indexes can skip
+		numbers, so the conversation has at most that many messages; counting them exactly would
+		mean paging through its whole history.
+		"""
+		resource = self._conversations(subaccount_sid)
+
+		def load(conversation):
+			key = (conversation['sid'], conversation['dateUpdated'])
+			try:
+				return conversation_details_cache.get_or_load(key, lambda: self._fetch_details(resource, conversation['sid']))
+			except Exception as e:
+				print(f"Error fetching details of conversation {conversation['sid']}: {e}")
+				return {'lastMessage': None, 'messageCountUpperBound': None, 'participantCount': None}
+
+		if not conversations:
+			return conversations
+		with ThreadPoolExecutor(max_workers=min(CONVERSATION_DETAILS_CONCURRENCY, len(conversations))) as executor:
+			details = list(executor.map(bind_context(load), conversations))
+		return [dict(conversation, **conversation_details) for conversation, conversation_details in zip(conversations, details)]
+
+	@staticmethod
+	def _fetch_details(resource, conversation_sid):
+		# Two calls: the newest message only, and the participants
+		conversation = resource(conversation_sid)
+		last = next(iter(conversation.messages.list(order='desc', limit=1)), None)
+		participants = conversation.participants.list(page_size=100)
+		return {
+			'lastMessage': {
+				'sid': last.sid,
+				'index': last.index,
+				'author': last.author,
+				'body': (last.body or '')[:MESSAGE_PREVIEW_LENGTH],
+				'dateCreated': last.date_created.isoformat()
+			} if last else None,
+			# Message indexes start at 0 but can skip numbers, this is a bound rather than a count
+			'messageCountUpperBound': last.index + 1 if last else 0,
+			'participantCount': len(participants)
+		}
+
+	def iter_messages(self, conversation_sid, order='asc'):
+		messages = self._conversations()(conversation_sid).messages
+		for msg in messages.stream(order=order, page_size=MESSAGE_PAGE_SIZE):
+			yield extract_message_data(msg)
+
+	def get_messages_page(self, conversation_sid, page_size=MESSAGE_PAGE_SIZE, cursor=None, order='asc'):
+		if order not in ('asc', 'desc'):
+			raise ValueError("order must be 'asc' or 'desc'")
+		page = get_page(self._conversations()(conversation_sid).messages, page_size, cursor, order=order)
+		return {
+			'items': [extract_message_data(msg) for msg in page],
+			'next_cursor': encode_page_cursor(page)
+		}
+
+	def list_conversations(self, subaccount_sid, phone_number=None, details=False):
 		print("Fetching conversations for subaccount:", subaccount_sid)
-		result = []
 		
 		try:
-			# Create a client specifically for this subaccount
-			subaccount_client = Client(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
-			subaccount_client.account_sid = subaccount_sid
+			# If phone number filter is requested, look it up in the participant index
+			if phone_number:
+				print(f"Filtering by phone number: {phone_number}")
+				conversations = participant_index.find_conversations(subaccount_sid, phone_number, parent=self.parent)
+				print(f"Found {len(conversations)} conversations for {phone_number}")
+				conversations = [extract_conversation_data(conversation) for conversation in conversations]
+				return self.add_details(conversations, subaccount_sid) if details else conversations
 			
-			# Fetch conversations using the subaccount client
-			conversations = subaccount_client.conversations.v1.conversations.list()
-			print(f"Found {len(conversations)} conversations")
-			
-			for conversation in conversations:
-				# Process each conversation
-				conversation_data = {
-					'sid': conversation.sid,
-					'friendlyName': conversation.friendly_name or "Unnamed Conversation",
-					'dateCreated': conversation.date_created.isoformat(),
-					'dateUpdated': conversation.date_updated.isoformat()
-				}
-				
-				# If phone number filter is requested, check participants
-				if phone_number:
-					print(f"Filtering by phone number: {phone_number}")
-					try:
-						participants = subaccount_client.conversations.v1.conversations(conversation.sid).participants.list()
-						
-						# Check if this phone number is a participant
-						for participant in participants:
-							messaging_binding = getattr(participant, 'messaging_binding', None)
-							if messaging_binding and isinstance(messaging_binding, dict):
-								participant_address = messaging_binding.get('address')
-								if participant_address and phone_number in participant_address:
-									print(f"Match found for {phone_number} in conversation {conversation.sid}")
-									result.append(conversation_data)
-									break
-							
-							# Also check identity field
-							if getattr(participant, 'identity', None) == phone_number:
-								print(f"Match found for {phone_number} in conversation {conversation.sid} by identity")
-								result.append(conversation_data)
-								break
-					except Exception as participant_error:
-						print(f"Error fetching participants for conversation {conversation.sid}: {participant_error}")
-				else:
-					# No phone filter, add all conversations
-					result.append(conversation_data)
+			# No phone filter, add all conversations
+			return list(self.iter_conversations(subaccount_sid, details=details))
 			
 		except Exception as e:
 			print(f"Error fetching conversations: {e}")
 			# Instead of silently failing, raise the exception to be handled by caller
 			raise e
-		
-		return result
 	
 	def get_messages(self, conversation_sid):
 		try:
-			# Use the subaccount SID if it's set, otherwise use the default client
-			if self.subaccount_sid:
-				subaccount_client = Client(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
-				subaccount_client.account_sid = self.subaccount_sid
-				messages = subaccount_client.conversations.v1.conversations(conversation_sid).messages.list()
-			else:
-				messages = self.client.conversations.v1.conversations(conversation_sid).messages.list()
-			
-			return [{
-				'sid': msg.sid,
-				'author': msg.author,
-				'body': msg.body,
-				'dateCreated': msg.date_created.isoformat(),
-				'dateUpdated': msg.date_updated.isoformat()
-			} for msg in messages]
+			return list(self.iter_messages(conversation_sid))
 		except Exception as e:
 			print(f"Error fetching messages for conversation {conversation_sid}: {e}")
 			raise e
 	
 	def get_message_details(self, conversation_sid, message_sid):
 		try:
-			# Use the subaccount SID if it's set, otherwise use the default client
-			if self.subaccount_sid:
-				subaccount_client = Client(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
-				subaccount_client.account_sid = self.subaccount_sid
-				message = subaccount_client.conversations.v1.conversations(conversation_sid).messages(message_sid).fetch()
-			else:
-				message = self.client.conversations.v1.conversations(conversation_sid).messages(message_sid).fetch()
+			message = self._conversations()(conversation_sid).messages(message_sid).fetch()
 			
 			return {
 				'sid': message.sid,
@@ -113,7 +228,7 @@ class ConversationsService:
 	
 	@staticmethod
 	def delete_message(subaccount_sid, message_sid):
-		client = Client(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
+		client = get_client()
 		# Note: We would need the conversation_sid to delete a message
 		# This is a placeholder - the actual implementation would need the conversation_sid
 		# client.conversations.conversations(conversation_sid).messages(message_sid).delete()
@@ -0,0 +1,62 @@
+import os
+import sqlite3
+import threading
+
+# Local SQLite database for job progress and other state that must survive restarts
+BUTLER_DB_PATH = os.getenv('BUTLER_DB_PATH', 'butler.db')
+
+_local = threading.local()
+# Schemas already created in this process, by (key, database path)
+_schemas = set()
+_schema_lock = threading.Lock()
+
+def _database_path():
+	return os.getenv('BUTLER_DB_PATH', BUTLER_DB_PATH)
+
+def get_connection():
+	"""
+	Return this thread's connection to the local database.
+
+	SQLite connections can't be shared across threads or forked processes, so each
+	thread gets its own, and a forked worker opens fresh ones instead of reusing its parent's.
+	"""
+	connection = getattr(_local, 'connection', None)
+	if connection is None or _local.pid != os.getpid():
+		connection = sqlite3.connect(_database_path(), timeout=30, isolation_level=None)
+		connection.row_factory = sqlite3.Row
+		connection.execute('PRAGMA journal_mode=WAL')
+		connection.execute('PRAGMA synchronous=NORMAL')
+		_local.connection = connection
+		_local.pid = os.getpid()
+	return connection
+
+def ensure_schema(key, schema, columns=None):
+	"""
+	Return this thread's connection to the local database, with the tables of schema created
+	first, once per process and database. key names the schema, e.g. 'jobs'.
+
+	columns lists the columns added to tables created before them, {table: [(column, type), ...]};
+	a third item, when given, is the value stored in the table's existing rows.
+	"""
+	connection = get_connection()
+	marker = (key, _database_path())
+	if marker not in _schemas:
+		with _schema_lock:
+			if marker not in _schemas:
+				connection.executescript(schema)
+				if columns:
+					_add_columns(connection, columns)
+				_schemas.add(marker)
+	return connection
+
+def _add_columns(connection, columns):
+	with connection:
+		connection.execute('BEGIN IMMEDIATE')
+		for table, table_columns in columns.items():
+			existing = [row['name'] for row in connection.execute(f'PRAGMA table_info({table})')]
+			for column, column_type, *fill in table_columns:
+				if column in existing:
+					continue
+				connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+				if fill:
+					connection.execute(f'UPDATE {table} SET {column} = ?', (fill[0],))
@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+from services.metrics import bind_context
+from services.phone_number_service import PhoneNumberService
+
+ASSIGN = 'assign'
+REMOVE = 'remove'
+
+# Most numbers one batch may change, and how many are updated at once (the rate limiter paces them further)
+MAX_EMERGENCY_BATCH = int(os.getenv('MAX_EMERGENCY_BATCH', '1000'))
+EMERGENCY_BATCH_CONCURRENCY = int(os.getenv('EMERGENCY_BATCH_CONCURRENCY', '8'))
+
+FILTER_FIELDS = ('emergency_status', 'emergency_registered', 'created_after', 'created_before', 'prefix', 'subaccount_sid')
+
+class EmergencyAddressBatch:
+	"""
+	Assigns or removes the emergency address of many numbers, across subaccounts, in one call.
+
+	Numbers are given as (subaccount, number SID) pairs or selected with the phone number
+	inventory's filters. Each number costs a single update call, made concurrently. The call is
+	made even when the inventory shows the number already in the requested state: the inventory
+	can be minutes behind Twilio, and the update is idempotent. Once the batch is done,
+	every subaccount it changed is updated once: inventory rows, in-flight reads and a single
+	badge recomputation.
+	"""
+	def __init__(self, subaccount_service, phone_inventory, badge_worker, concurrency=EMERGENCY_BATCH_CONCURRENCY):
+		self.subaccount_service = subaccount_service
+		self.phone_inventory = phone_inventory
+		self.badge_worker = badge_worker
+		self.concurrency = concurrency
+
+	def select(self, filters):
+		"""
+		(subaccount SID, number SID) pairs of the inventory numbers matching filters, see PhoneInventory.query.
+		Filters are JSON values or the strings GET /phone-numbers takes, e.g. emergency_registered true or
+		'false'. Raises ValueError for an unknown filter or a value of the wrong type rather than selecting
+		numbers the caller didn't mean to change.
+		"""
+		if not isinstance(filters, dict):
+			raise ValueError('filter must be an object')
+		unknown = set(filters) - set(FILTER_FIELDS)
+		if unknown:
+			raise ValueError(f"Unknown filter {sorted(unknown)[0]}, expected some of {', '.join(FILTER_FIELDS)}")
+		if not filters:
+			raise ValueError('filter needs at least one condition')
+		filters = dict(filters)
+
+		registered = filters.get('emergency_registered')
+		if isinstance(registered, str) and registered in ('true', 'false'):
+			filters['emergency_registered'] = registered == 'true'
+		elif registered is not None and not isinstance(registered, bool):
+			raise ValueError("emergency_registered must be true or false")
+		statuses = filters.get('emergency_status')
+		if isinstance(statuses, str):
+			filters['emergency_status'] = statuses.split(',')
+		elif statuses is not None and not (isinstance(statuses, list) and all(isinstance(status, str) for status in statuses)):
+			raise ValueError('emergency_status must be a list of statuses or a comma-separated string')
+		for field in ('created_after', 'created_before', 'prefix', 'subaccount_sid'):
+			if filters.get(field) is not None and not isinstance(filters[field], str):
+				raise ValueError(f'{field} must be a string')
+
+		self.phone_inventory.sync()
+		items = []
+		for number in self.phone_inventory.query(**filters):
+			items.append({'subaccount_sid': number['subaccount_sid'], 'phone_number_sid': number['sid']})
+			if len(items) > MAX_EMERGENCY_BATCH:
+				raise ValueError(f'The filter matches more than {MAX_EMERGENCY_BATCH} numbers, narrow it down')
+		return items
+
+	def run(self, action, items, emergency_address_sid=None):
+		"""
+		Apply action (ASSIGN or REMOVE) to every item, a dict with subaccount_sid, phone_number_sid
+		and optionally its own emergency_address_sid. For ASSIGN, emergency_address_sid is the
+		address SID, or a dict of address SIDs by subaccount (addresses belong to one account).
+
+		Returns {'summary': {...}, 'items': [...]} with the outcome of every number.
+		"""
+		if action not in (ASSIGN, REMOVE):
+			raise ValueError(f"action must be '{ASSIGN}' or '{REMOVE}'")
+		if len(items) > MAX_EMERGENCY_BATCH:
+			raise ValueError(f'At most {MAX_EMERGENCY_BATCH} numbers can be changed at once')
+		for item in items:
+			if not isinstance(item, dict) or not item.get('subaccount_sid') or not item.get('phone_number_sid'):
+				raise ValueError('Every item needs a subaccount_sid and a phone_number_sid')
+
+		def target_address(item):
+			if action == REMOVE:
+				return None
+			if item.get('emergency_address_sid'):
+				return item['emergency_address_sid']
+			if isinstance(emergency_address_sid, dict):
+				return emergency_address_sid.get(item['subaccount_sid'])
+			return emergency_address_sid
+
+		services = {}
+		for sid in dict.fromkeys(item['subaccount_sid'] for item in items):
+			try:
+				services[sid] = PhoneNumberService(sid, subaccount_auth_token=self.subaccount_service.get_auth_token(sid),
+					parent=self.subaccount_service.parent)
+			except Exception as e:
+				services[sid] = e
+
+		def apply(item):
+			sid, pn_sid = item['subaccount_sid'], item['phone_number_sid']
+			address_sid = target_address(item)
+			result = {'subaccount_sid': sid, 'phone_number_sid': pn_sid}
+			if action == ASSIGN and not address_sid:
+				return dict(result, status='failed', error=f'No emergency address given for subaccount {sid}')
+			service = services[sid]
+			if isinstance(service, Exception):
+				return dict(result, status='failed', error=str(service))
+			try:
+				updated = service.update_emergency_address(pn_sid, address_sid)
+			except Exception as e:
+				print(f"Error updating the emergency address of {pn_sid} in subaccount {sid}: {e}")
+				return dict(result, status='failed', error=str(e))
+			return dict(result, status='updated', record=updated, emergency_address_sid=updated['emergency_address_sid'],
+				emergency_address_status=updated['emergency_address_status'])
+
+		results = []
+		if items:
+			with ThreadPoolExecutor(max_workers=min(self.concurrency, len(items))) as executor:
+				results = list(executor.map(bind_context(apply), items))
+
+		# Follow-up work once per changed subaccount rather than once per number
+		changed = {}
+		for result in results:
+			record = result.pop('record', None)
+			if record is not None:
+				changed.setdefault(result['subaccount_sid'], []).append(record)
+		for sid, records in changed.items():
+			self.phone_inventory.update_numbers(sid, records)
+			self.subaccount_service.forget_in_flight(sid)
+			self.badge_worker.touch(sid)
+		if changed:
+			self.badge_worker.trigger(list(changed))
+
+		summary = {'total': len(results), 'updated': 0, 'failed': 0, 'subaccounts': len(changed)}
+		for result in results:
+			summary[result['status']] += 1
+		return {'summary': summary, 'items': results}
@@ -0,0 +1,123 @@
+from collections import deque
+import os
+import queue
+import threading
+import time
+
+# Events buffered per subscriber; a subscriber that falls this far behind is told to resync
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '1000'))
+# Recent events kept so a reconnecting client can catch up from its Last-Event-ID
+EVENT_BACKLOG = int(os.getenv('EVENT_BACKLOG', '1000'))
+
+# Event types
+BADGES_UPDATED = 'badges.updated'
+PHONE_NUMBER_PURCHASED = 'phone_number.purchased'
+PHONE_NUMBER_RELEASED = 'phone_number.released'
+EMERGENCY_ADDRESS_ASSIGNED = 'emergency_address.assigned'
+EMERGENCY_ADDRESS_REMOVED = 'emergency_address.removed'
+SUBACCOUNT_CREATED = 'subaccount.created'
+SUBACCOUNT_UPDATED = 'subaccount.updated'
+SUBACCOUNT_CLOSED = 'subaccount.closed'
+
+class Subscription:
+	def __init__(self, bus, sids, maxsize):
+		self.bus = bus
+		self.sids = set(sids) if sids else None
+		self.overflowed = False
+		self._queue = queue.Queue(maxsize=maxsize)
+
+	def matches(self, event):
+		return self.sids is None or event['subaccount_sid'] in self.sids
+
+	def offer(self, event):
+		try:
+			self._queue.put_nowait(event)
+		except queue.Full:
+			# Dropping events silently would leave the client out of date without knowing it
+			self.overflowed = True
+
+	def reset(self):
+		# Drop the queued events once the client has been told to resync
+		self.overflowed = False
+		while True:
+			try:
+				self._queue.get_nowait()
+			except queue.Empty:
+				return
+
+	def get(self, timeout):
+		# The next event, None if there was none for timeout seconds
+		try:
+			return self._queue.get(timeout=timeout)
+		except queue.Empty:
+			return None
+
+	def close(self):
+		self.bus.unsubscribe(self)
+
+class EventBus:
+	"""
+	In-process publish/subscribe of change events, streamed to the UI by GET /events.
+
+	The mutating service methods publish what they changed; every subscriber gets the events
+	of the subaccounts it asked for in its own bounded queue, so a slow client never blocks a
+	publisher. Events only reach the subscribers of the process that published them.
+	"""
+	def __init__(self, queue_size=EVENT_QUEUE_SIZE, backlog=EVENT_BACKLOG):
+		self.queue_size = queue_size
+		self.published = 0
+		# Ids start from the clock so they keep increasing across restarts, and a client
+		# reconnecting with an id from before the restart is told to resync
+		self._last_id = int(time.time() * 1000)
+		self._backlog = deque(maxlen=backlog)
+		self._subscribers = set()
+		self._lock = threading.Lock()
+
+	def publish(self, event_type, subaccount_sid, **data):
+		with self._lock:
+			self._last_id += 1
+			event = {
+				'id': self._last_id,
+				'type': event_type,
+				'subaccount_sid': subaccount_sid,
+				'time': time.time(),
+				'data': data
+			}
+			self.published += 1
+			self._backlog.append(event)
+			subscribers = [subscriber for subscriber in self._subscribers if subscriber.matches(event)]
+		for subscriber in subscribers:
+			subscriber.offer(event)
+		return event
+
+	def subscribe(self, sids=None, last_event_id=None):
+		"""
+		Subscribe to the events of the given subaccounts, or of all of them. With last_event_id,
+		the buffered events published after it are replayed first.
+		"""
+		subscription = Subscription(self, sids, self.queue_size)
+		with self._lock:
+			if last_event_id is not None:
+				# Older than the backlog: some events are gone, the client has to resync
+				oldest = self._backlog[0]['id'] if self._backlog else self._last_id + 1
+				if last_event_id < oldest - 1:
+					subscription.overflowed = True
+				for event in self._backlog:
+					if event['id'] > last_event_id and subscription.matches(event):
+						subscription.offer(event)
+			self._subscribers.add(subscription)
+		return subscription
+
+	@property
+	def last_id(self):
+		return self._last_id
+
+	def unsubscribe(self, subscription):
+		with self._lock:
+			self._subscribers.discard(subscription)
+
+	def stats(self):
+		with self._lock:
+			return {'subscribers': len(self._subscribers), 'published': self.published}
+
+event_bus = EventBus()
@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from services.badge_worker import BadgeWorker
+from services.conversations_service import ConversationsService
+from services.emergency_batch import EmergencyAddressBatch
+from services.message_index import MessageIndex
+from services.metrics import metrics, bind_context
+from services.parent_accounts import parent_registry
+from services.phone_inventory import PhoneInventory
+from services.phone_number_service import PhoneNumberService
+from services.provisioning_jobs import ProvisioningJobEngine
+from services.release_jobs import ReleaseJobEngine
+from services.subaccount_service import SubaccountService
+
+class ParentServices:
+	"""
+	The services of one parent account: its own caches and account index, background workers
+	(badge worker, job engines, message index syncs) and, through the client registry and the
+	rate limiter, its own Twilio connection pool and rate budget.
+	"""
+	def __init__(self, parent):
+		self.parent = parent
+		self.subaccount_service = SubaccountService(parent)
+		self.phone_number_service = PhoneNumberService(parent=parent)
+		self.conversations_service = ConversationsService(parent=parent)
+		self.release_job_engine = ReleaseJobEngine(self.subaccount_service)
+		self.badge_worker = BadgeWorker(self.subaccount_service)
+		self.phone_inventory = PhoneInventory(self.subaccount_service)
+		self.provisioning_job_engine = ProvisioningJobEngine(self.subaccount_service, self.phone_inventory)
+		self.emergency_address_batch = EmergencyAddressBatch(self.subaccount_service, self.phone_inventory, self.badge_worker)
+		self.message_index = MessageIndex(parent=parent)
+
+		# The default parent's caches keep the names they had with a single parent
+		suffix = '' if parent is parent_registry.default else f':{parent.name}'
+		metrics.register_cache('accounts' + suffix, self.subaccount_service.account_cache)
+		metrics.register_cache('auth_tokens' + suffix, self.subaccount_service.auth_token_cache)
+
+	def start_workers(self, badge_worker=True):
+		# Pick up the jobs interrupted by a restart, then keep the badges up to date
+		self.release_job_engine.resume_unfinished()
+		self.provisioning_job_engine.resume_unfinished()
+		if badge_worker:
+			self.badge_worker.start()
+
+class Fleet:
+	"""
+	The services of every configured parent account, created on first use, and the operations
+	spanning all of them. Those run for every parent at once, each on its own parent's pools,
+	so a slow or throttled parent only delays its own share of the work.
+	"""
+	def __init__(self, registry=parent_registry):
+		self.registry = registry
+		self._services = {}
+		self._lock = threading.Lock()
+
+	def get(self, name=None):
+		"""Services of the named parent, the default parent's if None. Raises UnknownParentError."""
+		parent = self.registry.get(name)
+		services = self._services.get(parent.name)
+		if services is None:
+			with self._lock:
+				services = self._services.get(parent.name)
+				if services is None:
+					services = self._services[parent.name] = ParentServices(parent)
+		return services
+
+	def all(self):
+		return [self.get(parent.name) for parent in self.registry.all()]
+
+	def subaccount_services(self):
+		return [services.subaccount_service for services in self.all()]
+
+	def map(self, fn):
+		"""
+		Call fn(services) for every parent in parallel. Returns ({parent name: result},
+		{parent name: error message}), a failing parent doesn't fail the others.
+		"""
+		all_services = self.all()
+		results = {}
+		errors = {}
+		with ThreadPoolExecutor(max_workers=len(all_services)) as executor:
+			futures = {executor.submit(bind_context(fn), services): services.parent.name for services in all_services}
+			for future in as_completed(futures):
+				name = futures[future]
+				try:
+					results[name] = future.result()
+				except Exception as e:
+					print(f"Error in parent account {name}: {e}")
+					errors[name] = str(e)
+		return results, errors
+
+	def list_subaccounts(self):
+		"""
+		The subaccounts of every parent, as SubaccountService.list_subaccounts() plus the name of
+		their parent, listed in parallel. Returns (subaccounts, {parent name: error message}).
+		"""
+		results, errors = self.map(lambda services: services.subaccount_service.list_subaccounts())
+		subaccounts = []
+		# In the configured order of the parents
+		for parent in self.registry.all():
+			for subaccount in results.get(parent.name, []):
+				subaccount['parent'] = parent.name
+				subaccounts.append(subaccount)
+		return subaccounts, errors
+
+	def refresh_badges(self):
+		# Every parent's badge worker recomputes its subaccounts with its own pool
+		for services in self.all():
+			services.badge_worker.start()
+			services.badge_worker.trigger()
+
+	def start_workers(self, badge_worker=True):
+		for services in self.all():
+			services.start_workers(badge_worker)
+
+	def resume_job(self, job_id):
+		# Only the engines of the parent that started the job take it
+		for services in self.all():
+			if services.release_job_engine.resume(job_id) or services.provisioning_job_engine.resume(job_id):
+				return True
+		return False
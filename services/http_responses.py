@@ -0,0 +1,104 @@
+from flask.json.provider import DefaultJSONProvider
+import gzip
+import os
+import zlib
+
+# Both are in requirements.txt; without them JSON is serialized with the standard library and responses only gzipped
+try:
+	import orjson
+except ImportError:
+	orjson = None
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Bodies smaller than this are sent as they are, compressing them costs more than it saves
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+class FastJSONProvider(DefaultJSONProvider):
+	"""
+	Flask's JSON provider, serializing with orjson when it is installed. The output is the
+	same as Flask's: sorted keys, datetimes as RFC 822 dates (through the default hook).
+	Anything orjson refuses, e.g. integers over 64 bits, goes through the standard library.
+	"""
+	if orjson is not None:
+		OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+	def dumps(self, obj, **kwargs):
+		if orjson is None or kwargs:
+			return super().dumps(obj, **kwargs)
+		try:
+			return orjson.dumps(obj, default=self.default, option=self.OPTIONS).decode()
+		except TypeError:
+			return super().dumps(obj)
+
+	def response(self, *args, **kwargs):
+		if orjson is None or self._app.debug:
+			return super().response(*args, **kwargs)
+		obj = self._prepare_response_obj(args, kwargs)
+		try:
+			body = orjson.dumps(obj, default=self.default, option=self.OPTIONS)
+		except TypeError:
+			body = super().dumps(obj)
+		return self._app.response_class(body, mimetype=self.mimetype)
+
+def conditional_response(request, response):
+	"""
+	Add an ETag, the hash of the body, to a successful GET response and answer 304 when the
+	client already has it (If-None-Match). The ETag is weak since the same value is used for
+	the compressed representations. Streamed responses are left alone.
+	"""
+	if request.method not in ('GET', 'HEAD') or response.status_code != 200 or response.is_streamed:
+		return response
+	if 'ETag' not in response.headers:
+		response.add_etag(weak=True)
+	return response.make_conditional(request)
+
+def compressed_response(request, response):
+	"""
+	Compress a response with brotli or gzip, whichever the client accepts and is available.
+	Streamed bodies are gzipped chunk by chunk so they keep streaming.
+	"""
+	if (response.status_code != 200 or 'Content-Encoding' in response.headers
+			or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+		return response
+	response.vary.add('Accept-Encoding')
+
+	if response.is_streamed:
+		if not request.accept_encodings['gzip']:
+			return response
+		response.response = _gzip_stream(response.response)
+		response.headers.pop('Content-Length', None)
+		response.headers['Content-Encoding'] = 'gzip'
+		return response
+
+	encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+	body = response.get_data()
+	if encoding is None or len(body) < COMPRESS_MIN_SIZE:
+		return response
+	if encoding == 'br':
+		response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+	else:
+		response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0))
+	response.headers['Content-Encoding'] = encoding
+	return response
+
+def _gzip_stream(chunks):
+	# Flush after every chunk so each one reaches the client as soon as it is produced
+	compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+	try:
+		for chunk in chunks:
+			if isinstance(chunk, str):
+				chunk = chunk.encode()
+			if chunk:
+				yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+		yield compressor.flush()
+	finally:
+		close = getattr(chunks, 'close', None)
+		if close is not None:
+			close()
@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from services.job_store import job_store, process_owner, COMPLETED, FAILED, JOB_HEARTBEAT_INTERVAL
+from services.parent_accounts import parent_registry
+from services.phone_number_service import PhoneNumberService
+
+class JobEngine:
+	"""
+	Runs one kind of job from the job store in the background, over a bounded pool of job
+	workers. Every parent account has its own engine; subclasses set kind and label and
+	implement _execute(job_id), which records the progress of the job's items.
+
+	A job only runs in the process holding its lease (see JobStore.claim_job), renewed by a
+	heartbeat thread while the engine has jobs queued or running, so several worker processes
+	never run the same job; a job is resumed elsewhere only once its owner stopped renewing
+	the lease.
+	"""
+	kind = None
+	# Names the jobs in log messages, e.g. 'close'
+	label = None
+
+	def __init__(self, subaccount_service, concurrency, workers):
+		self.subaccount_service = subaccount_service
+		self.concurrency = concurrency
+		self._executor = ThreadPoolExecutor(max_workers=workers)
+		self._running = set()
+		self._heartbeat = None
+		self._lock = threading.Lock()
+
+	@property
+	def parent_name(self):
+		return parent_registry.resolve(self.subaccount_service.parent).name
+
+	def _owns(self, job):
+		# Each parent's engine runs its own jobs, jobs from before there were several parents are the default parent's
+		return job['params'].get('parent', parent_registry.default.name) == self.parent_name
+
+	def _create_job(self, subaccount_sid, params):
+		return job_store.create_job(self.kind, subaccount_sid, dict(params, parent=self.parent_name))
+
+	def _phone_number_service(self, subaccount_sid):
+		auth_token = self.subaccount_service.get_auth_token(subaccount_sid)
+		return PhoneNumberService(subaccount_sid, subaccount_auth_token=auth_token, parent=self.subaccount_service.parent)
+
+	def resume(self, job_id):
+		job = job_store.get_job(job_id)
+		if job is None or job['kind'] != self.kind or not self._owns(job):
+			return False
+		if job['status'] != COMPLETED:
+			self._submit(job_id)
+		return True
+
+	def resume_unfinished(self):
+		# Pick up jobs that were interrupted by a restart, those of live processes keep their owner
+		job_ids = [job_id for job_id in job_store.unfinished_jobs(self.kind) if self._owns(job_store.get_job(job_id))]
+		return [job_id for job_id in job_ids if self._submit(job_id)]
+
+	def _submit(self, job_id):
+		# Returns False when another process holds the job's lease
+		with self._lock:
+			if job_id in self._running:
+				return True
+			if not job_store.claim_job(job_id, process_owner()):
+				return False
+			self._running.add(job_id)
+			if self._heartbeat is None:
+				self._heartbeat = threading.Thread(target=self._renew_leases, name=f'{self.label}-job-heartbeat', daemon=True)
+				self._heartbeat.start()
+		self._executor.submit(self._run, job_id)
+		return True
+
+	def _renew_leases(self):
+		# Runs while the engine has jobs, queued ones included
+		while True:
+			time.sleep(JOB_HEARTBEAT_INTERVAL)
+			with self._lock:
+				job_ids = list(self._running)
+				if not job_ids:
+					self._heartbeat = None
+					return
+			try:
+				job_store.heartbeat(job_ids, process_owner())
+			except Exception as e:
+				print(f"Error renewing the leases of {self.label} jobs {job_ids}: {e}")
+
+	def _run(self, job_id):
+		try:
+			self._execute(job_id)
+		except Exception as e:
+			print(f"Error running {self.label} job {job_id}: {e}")
+			job_store.update_job(job_id, FAILED, error=str(e))
+		finally:
+			with self._lock:
+				self._running.discard(job_id)
+			job_store.release_job(job_id, process_owner())
+			self._finished(job_id)
+
+	def _execute(self, job_id):
+		raise NotImplementedError
+
+	def _finished(self, job_id):
+		# Called once the job stopped, whatever its outcome
+		pass
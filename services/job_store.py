@@ -0,0 +1,183 @@
+import json
+import os
+import socket
+import time
+import uuid
+from services.db import ensure_schema
+
+# A running job's owner refreshes its heartbeat this often (seconds); a job whose heartbeat is
+# older than JOB_LEASE_TIMEOUT is taken to be interrupted and may be resumed by another process
+JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', '15'))
+JOB_LEASE_TIMEOUT = float(os.getenv('JOB_LEASE_TIMEOUT', '120'))
+
+# Job and item states
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+	id TEXT PRIMARY KEY,
+	kind TEXT NOT NULL,
+	subaccount_sid TEXT,
+	status TEXT NOT NULL,
+	params TEXT,
+	result TEXT,
+	error TEXT,
+	created_at REAL NOT NULL,
+	updated_at REAL NOT NULL,
+	owner TEXT,
+	heartbeat_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (kind, status);
+CREATE TABLE IF NOT EXISTS job_items (
+	job_id TEXT NOT NULL,
+	item_key TEXT NOT NULL,
+	status TEXT NOT NULL,
+	result TEXT,
+	error TEXT,
+	updated_at REAL NOT NULL,
+	PRIMARY KEY (job_id, item_key)
+);
+"""
+
+# Columns of tables created before jobs had owners
+ADDED_COLUMNS = {'jobs': [('owner', 'TEXT'), ('heartbeat_at', 'REAL')]}
+
+def process_owner():
+	# Identifies this process as the owner of a job, read on every call so forked workers differ
+	return f'{socket.gethostname()}:{os.getpid()}'
+
+class JobStore:
+	"""
+	Persists long running jobs and the progress of each of their items, so an
+	interrupted job can be resumed where it stopped.
+
+	A process runs a job under a lease: claim_job records it as the owner, and it keeps
+	the lease alive with heartbeat() while it works. Other processes (e.g. the other
+	gunicorn workers) leave the job alone until the lease has expired.
+	"""
+	def _db(self):
+		return ensure_schema('jobs', SCHEMA, ADDED_COLUMNS)
+
+	def create_job(self, kind, subaccount_sid=None, params=None):
+		job_id = uuid.uuid4().hex
+		now = time.time()
+		self._db().execute(
+			'INSERT INTO jobs (id, kind, subaccount_sid, status, params, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+			(job_id, kind, subaccount_sid, PENDING, json.dumps(params or {}), now, now)
+		)
+		return job_id
+
+	def add_items(self, job_id, item_keys):
+		# Items already recorded (e.g. when resuming) keep their progress
+		now = time.time()
+		db = self._db()
+		with db:
+			db.execute('BEGIN')
+			db.executemany(
+				'INSERT OR IGNORE INTO job_items (job_id, item_key, status, updated_at) VALUES (?, ?, ?, ?)',
+				[(job_id, key, PENDING, now) for key in item_keys]
+			)
+
+	def update_job(self, job_id, status, result=None, error=None):
+		self._db().execute(
+			'UPDATE jobs SET status = ?, result = COALESCE(?, result), error = ?, updated_at = ? WHERE id = ?',
+			(status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+		)
+
+	def claim_job(self, job_id, owner, lease_timeout=JOB_LEASE_TIMEOUT):
+		"""
+		Take the lease of an unfinished job. Returns False when the job is completed, or
+		when another owner holds a lease it renewed less than lease_timeout seconds ago.
+		"""
+		now = time.time()
+		cursor = self._db().execute(
+			'UPDATE jobs SET owner = ?, heartbeat_at = ? WHERE id = ? AND status != ? '
+			'AND (owner IS NULL OR owner = ? OR heartbeat_at IS NULL OR heartbeat_at < ?)',
+			(owner, now, job_id, COMPLETED, owner, now - lease_timeout)
+		)
+		return cursor.rowcount == 1
+
+	def heartbeat(self, job_ids, owner):
+		# Renew the leases still held by owner
+		now = time.time()
+		db = self._db()
+		with db:
+			db.execute('BEGIN')
+			db.executemany(
+				'UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND owner = ?',
+				[(now, job_id, owner) for job_id in job_ids]
+			)
+
+	def release_job(self, job_id, owner):
+		self._db().execute('UPDATE jobs SET owner = NULL, heartbeat_at = NULL WHERE id = ? AND owner = ?', (job_id, owner))
+
+	def update_item(self, job_id, item_key, status, result=None, error=None):
+		self._db().execute(
+			'UPDATE job_items SET status = ?, result = ?, error = ?, updated_at = ? WHERE job_id = ? AND item_key = ?',
+			(status, json.dumps(result) if result is not None else None, error, time.time(), job_id, item_key)
+		)
+
+	def pending_items(self, job_id):
+		# Failed items are retried too when a job is resumed
+		rows = self._db().execute(
+			'SELECT item_key FROM job_items WHERE job_id = ? AND status != ?', (job_id, COMPLETED)
+		).fetchall()
+		return [row['item_key'] for row in rows]
+
+	def has_items(self, job_id):
+		row = self._db().execute('SELECT 1 FROM job_items WHERE job_id = ? LIMIT 1', (job_id,)).fetchone()
+		return row is not None
+
+	def unfinished_jobs(self, kind, lease_timeout=JOB_LEASE_TIMEOUT):
+		# Jobs nobody is running: never claimed, or whose owner stopped renewing its lease
+		rows = self._db().execute(
+			'SELECT id FROM jobs WHERE kind = ? AND status IN (?, ?) AND (owner IS NULL OR heartbeat_at IS NULL OR heartbeat_at < ?) '
+			'ORDER BY created_at',
+			(kind, PENDING, RUNNING, time.time() - lease_timeout)
+		).fetchall()
+		return [row['id'] for row in rows]
+
+	def get_job(self, job_id, include_items=False):
+		db = self._db()
+		row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+		if row is None:
+			return None
+
+		counts = {PENDING: 0, RUNNING: 0, COMPLETED: 0, FAILED: 0}
+		for count_row in db.execute(
+				'SELECT status, COUNT(*) AS count FROM job_items WHERE job_id = ? GROUP BY status', (job_id,)):
+			counts[count_row['status']] = count_row['count']
+		total = sum(counts.values())
+
+		job = {
+			'id': row['id'],
+			'kind': row['kind'],
+			'subaccount_sid': row['subaccount_sid'],
+			'status': row['status'],
+			'params': json.loads(row['params']) if row['params'] else {},
+			'result': json.loads(row['result']) if row['result'] else None,
+			'error': row['error'],
+			'created_at': row['created_at'],
+			'updated_at': row['updated_at'],
+			'owner': row['owner'],
+			'heartbeat_at': row['heartbeat_at'],
+			'progress': {
+				'total': total,
+				'completed': counts[COMPLETED],
+				'failed': counts[FAILED],
+				'pending': counts[PENDING] + counts[RUNNING]
+			}
+		}
+		if include_items:
+			job['items'] = [{
+				'key': item['item_key'],
+				'status': item['status'],
+				'result': json.loads(item['result']) if item['result'] else None,
+				'error': item['error']
+			} for item in db.execute('SELECT * FROM job_items WHERE job_id = ? ORDER BY rowid', (job_id,))]
+		return job
+
+job_store = JobStore()
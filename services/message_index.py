@@ -0,0 +1,255 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+from services.client_registry import get_client
+from services.db import ensure_schema
+from services.participant_index import CONVERSATION_PAGE_SIZE
+
+# A search re-syncs the subaccount in the background when its last sync is older than this
+MESSAGE_INDEX_MAX_AGE = int(os.getenv('MESSAGE_INDEX_MAX_AGE', '300'))
+# Upper bound on concurrent conversation syncs per subaccount
+MESSAGE_SYNC_CONCURRENCY = int(os.getenv('MESSAGE_SYNC_CONCURRENCY', '8'))
+# Messages fetched per page while syncing, newest first; a conversation without new messages costs one page
+MESSAGE_SYNC_PAGE_SIZE = int(os.getenv('MESSAGE_SYNC_PAGE_SIZE', '50'))
+# Subaccounts synced at the same time
+MESSAGE_SYNC_WORKERS = int(os.getenv('MESSAGE_SYNC_WORKERS', '2'))
+
+# Trigram matching finds any part of a word or number, e.g. 5551234 in +15551234567
+MIN_QUERY_TERM = 3
+MAX_SEARCH_RESULTS = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indexed_conversations (
+	sid TEXT PRIMARY KEY,
+	subaccount_sid TEXT NOT NULL,
+	friendly_name TEXT,
+	state TEXT,
+	date_updated TEXT,
+	last_index INTEGER
+);
+CREATE INDEX IF NOT EXISTS indexed_conversations_subaccount ON indexed_conversations (subaccount_sid);
+CREATE TABLE IF NOT EXISTS indexed_messages (
+	sid TEXT PRIMARY KEY,
+	subaccount_sid TEXT NOT NULL,
+	conversation_sid TEXT NOT NULL,
+	message_index INTEGER,
+	author TEXT,
+	body TEXT,
+	date_created TEXT,
+	date_updated TEXT
+);
+CREATE INDEX IF NOT EXISTS indexed_messages_conversation ON indexed_messages (conversation_sid, message_index);
+CREATE TABLE IF NOT EXISTS message_index_syncs (
+	subaccount_sid TEXT PRIMARY KEY,
+	synced_at REAL,
+	error TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS indexed_messages_fts USING fts5(
+	body, author, content='indexed_messages', content_rowid='rowid', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS indexed_messages_insert AFTER INSERT ON indexed_messages BEGIN
+	INSERT INTO indexed_messages_fts (rowid, body, author) VALUES (new.rowid, new.body, new.author);
+END;
+CREATE TRIGGER IF NOT EXISTS indexed_messages_delete AFTER DELETE ON indexed_messages BEGIN
+	INSERT INTO indexed_messages_fts (indexed_messages_fts, rowid, body, author) VALUES ('delete', old.rowid, old.body, old.author);
+END;
+CREATE TRIGGER IF NOT EXISTS indexed_messages_update AFTER UPDATE ON indexed_messages BEGIN
+	INSERT INTO indexed_messages_fts (indexed_messages_fts, rowid, body, author) VALUES ('delete', old.rowid, old.body, old.author);
+	INSERT INTO indexed_messages_fts (rowid, body, author) VALUES (new.rowid, new.body, new.author);
+END;
+"""
+
+def _iso(value):
+	return value.isoformat() if value else None
+
+def match_expression(query):
+	"""
+	FTS5 query for a search string: every term must appear, in any order. A string in double
+	quotes is searched as one phrase. Raises ValueError when no term is long enough to match.
+	"""
+	query = query.strip()
+	if len(query) > 1 and query.startswith('"') and query.endswith('"'):
+		terms = [query[1:-1]]
+	else:
+		terms = query.split()
+	terms = [term for term in terms if len(term) >= MIN_QUERY_TERM]
+	if not terms:
+		raise ValueError(f'q needs at least one term of {MIN_QUERY_TERM} characters or more')
+	return ' AND '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+class MessageIndex:
+	"""
+	Local full-text index of the messages of every conversation of a subaccount.
+
+	A sync lists the subaccount's conversations, then for each one pages through its messages
+	newest first and stops at the highest message index already stored, so only new messages
+	are pulled. Closed conversations whose date_updated hasn't changed are skipped altogether.
+	Searches only read the local index: a subaccount never synced, or synced more than
+	max_age seconds ago, is synced in the background and the search answers with what is
+	indexed so far.
+
+	Every parent account has its own index, with its own sync workers; the messages are stored
+	in the same tables, by subaccount.
+	"""
+	def __init__(self, max_age=MESSAGE_INDEX_MAX_AGE, concurrency=MESSAGE_SYNC_CONCURRENCY, workers=MESSAGE_SYNC_WORKERS, parent=None):
+		self.parent = parent
+		self.max_age = max_age
+		self.concurrency = concurrency
+		self._executor = ThreadPoolExecutor(max_workers=workers)
+		self._syncing = set()
+		self._lock = threading.Lock()
+
+	def _db(self):
+		return ensure_schema('message_index', SCHEMA)
+
+	def sync_status(self, subaccount_sid):
+		row = self._db().execute('SELECT synced_at, error FROM message_index_syncs WHERE subaccount_sid = ?', (subaccount_sid,)).fetchone()
+		with self._lock:
+			syncing = subaccount_sid in self._syncing
+		return {
+			'synced_at': row['synced_at'] if row else None,
+			'error': row['error'] if row else None,
+			'syncing': syncing
+		}
+
+	def sync_in_background(self, subaccount_sid):
+		# At most one sync per subaccount at a time, returns False when one is already running
+		with self._lock:
+			if subaccount_sid in self._syncing:
+				return False
+			self._syncing.add(subaccount_sid)
+		self._executor.submit(self._sync_safely, subaccount_sid)
+		return True
+
+	def _sync_safely(self, subaccount_sid):
+		try:
+			self.sync(subaccount_sid)
+		except Exception as e:
+			print(f"Error syncing messages of subaccount {subaccount_sid}: {e}")
+			self._db().execute(
+				'INSERT INTO message_index_syncs (subaccount_sid, error) VALUES (?, ?) '
+				'ON CONFLICT(subaccount_sid) DO UPDATE SET error = excluded.error',
+				(subaccount_sid, str(e))
+			)
+		finally:
+			with self._lock:
+				self._syncing.discard(subaccount_sid)
+
+	def sync(self, subaccount_sid):
+		"""Pull the new messages of every conversation of the subaccount. Returns the number of messages stored."""
+		client = get_client(account_sid=subaccount_sid, parent=self.parent)
+		db = self._db()
+		known = {row['sid']: row for row in db.execute(
+			'SELECT sid, state, date_updated, last_index FROM indexed_conversations WHERE subaccount_sid = ?', (subaccount_sid,))}
+
+		listed = {}
+		for conversation in client.conversations.v1.conversations.stream(page_size=CONVERSATION_PAGE_SIZE):
+			listed[conversation.sid] = conversation
+
+		# Forget conversations that no longer exist
+		gone = [(sid,) for sid in set(known) - set(listed)]
+		if gone:
+			with db:
+				db.execute('BEGIN IMMEDIATE')
+				db.executemany('DELETE FROM indexed_messages WHERE conversation_sid = ?', gone)
+				db.executemany('DELETE FROM indexed_conversations WHERE sid = ?', gone)
+
+		def unchanged(conversation):
+			row = known.get(conversation.sid)
+			return row is not None and row['state'] == 'closed' and row['date_updated'] == _iso(conversation.date_updated)
+
+		stale = [conversation for conversation in listed.values() if not unchanged(conversation)]
+		stored = 0
+		if stale:
+			print(f"Syncing messages of {len(stale)} of {len(listed)} conversations for subaccount {subaccount_sid}")
+			last_indexes = {sid: row['last_index'] for sid, row in known.items()}
+			with ThreadPoolExecutor(max_workers=min(self.concurrency, len(stale))) as executor:
+				stored = sum(executor.map(
+					lambda conversation: self._sync_conversation(client, subaccount_sid, conversation, last_indexes.get(conversation.sid)),
+					stale
+				))
+
+		db.execute(
+			'INSERT INTO message_index_syncs (subaccount_sid, synced_at, error) VALUES (?, ?, NULL) '
+			'ON CONFLICT(subaccount_sid) DO UPDATE SET synced_at = excluded.synced_at, error = NULL',
+			(subaccount_sid, time.time())
+		)
+		return stored
+
+	def _sync_conversation(self, client, subaccount_sid, conversation, last_index):
+		messages = []
+		stream = client.conversations.v1.conversations(conversation.sid).messages.stream(order='desc', page_size=MESSAGE_SYNC_PAGE_SIZE)
+		for message in stream:
+			# Newest first, everything from here on is already stored
+			if last_index is not None and message.index <= last_index:
+				break
+			messages.append((
+				message.sid, subaccount_sid, conversation.sid, message.index, message.author, message.body,
+				_iso(message.date_created), _iso(message.date_updated)
+			))
+
+		if last_index is not None and messages:
+			last_index = max(last_index, messages[0][3])
+		elif messages:
+			last_index = messages[0][3]
+
+		# The conversation's watermark moves in the same transaction as its messages
+		db = self._db()
+		with db:
+			db.execute('BEGIN IMMEDIATE')
+			db.executemany(
+				'INSERT INTO indexed_messages (sid, subaccount_sid, conversation_sid, message_index, author, body, date_created, date_updated) '
+				'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+				'ON CONFLICT(sid) DO UPDATE SET author = excluded.author, body = excluded.body, date_updated = excluded.date_updated',
+				messages
+			)
+			db.execute(
+				'INSERT INTO indexed_conversations (sid, subaccount_sid, friendly_name, state, date_updated, last_index) '
+				'VALUES (?, ?, ?, ?, ?, ?) '
+				'ON CONFLICT(sid) DO UPDATE SET friendly_name = excluded.friendly_name, state = excluded.state, '
+				'date_updated = excluded.date_updated, last_index = excluded.last_index',
+				(conversation.sid, subaccount_sid, conversation.friendly_name, conversation.state,
+					_iso(conversation.date_updated), last_index)
+			)
+		return len(messages)
+
+	def search(self, subaccount_sid, query, limit=50):
+		"""
+		Messages of the subaccount matching query, best matches first. Only reads the local
+		index; starts a background sync when the subaccount's index is missing or stale.
+		"""
+		if not 1 <= limit <= MAX_SEARCH_RESULTS:
+			raise ValueError(f'limit must be between 1 and {MAX_SEARCH_RESULTS}')
+		expression = match_expression(query)
+
+		status = self.sync_status(subaccount_sid)
+		if status['synced_at'] is None or time.time() - status['synced_at'] > self.max_age:
+			status['syncing'] = self.sync_in_background(subaccount_sid) or status['syncing']
+
+		rows = self._db().execute(
+			'SELECT m.sid, m.conversation_sid, c.friendly_name, m.message_index, m.author, m.body, m.date_created, '
+			'm.date_updated, bm25(indexed_messages_fts) AS rank '
+			'FROM indexed_messages_fts JOIN indexed_messages m ON m.rowid = indexed_messages_fts.rowid '
+			'JOIN indexed_conversations c ON c.sid = m.conversation_sid '
+			'WHERE indexed_messages_fts MATCH ? AND m.subaccount_sid = ? '
+			'ORDER BY rank LIMIT ?',
+			(expression, subaccount_sid, limit)
+		).fetchall()
+		return {
+			'items': [{
+				'sid': row['sid'],
+				'conversationSid': row['conversation_sid'],
+				'conversationName': row['friendly_name'] or 'Unnamed Conversation',
+				'index': row['message_index'],
+				'author': row['author'],
+				'body': row['body'],
+				'dateCreated': row['date_created'],
+				'dateUpdated': row['date_updated'],
+				# bm25 is lower for better matches, flipped so higher is better
+				'score': -row['rank']
+			} for row in rows],
+			'synced_at': status['synced_at'],
+			'syncing': status['syncing'],
+			'sync_error': status['error']
+		}
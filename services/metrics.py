@@ -0,0 +1,220 @@
+from urllib.parse import urlsplit
+import contextvars
+import math
+import os
+import re
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds of the Twilio calls per request histogram buckets
+CALL_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Clients may ask for the X-Debug-Timing header unless this is turned off
+DEBUG_TIMING_ENABLED = os.getenv('DEBUG_TIMING_ENABLED', 'true').lower() == 'true'
+
+# Route label of the Twilio calls made outside of an API request (background workers, jobs)
+BACKGROUND_ROUTE = 'background'
+
+SID_PATTERN = re.compile(r'^[A-Z]{2}[0-9a-fA-F]{32}$')
+
+_current_timing = contextvars.ContextVar('request_timing', default=None)
+
+def twilio_resource(url):
+	# Last path segment that isn't a SID, e.g. /2010-04-01/Accounts/AC.../IncomingPhoneNumbers/PN....json -> IncomingPhoneNumbers
+	for segment in reversed(urlsplit(url).path.split('/')):
+		segment = segment.removesuffix('.json')
+		if segment and not SID_PATTERN.match(segment):
+			return segment
+	return 'unknown'
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=''):
+	pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+	# None is a value not known yet, e.g. the hit ratio of a cache never read
+	if value is None or (isinstance(value, float) and math.isnan(value)):
+		return 'NaN'
+	if isinstance(value, float) and math.isinf(value):
+		return '+Inf' if value > 0 else '-Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self._values = {}
+		self._lock = threading.Lock()
+
+	def inc(self, *label_values, amount=1):
+		with self._lock:
+			self._values[label_values] = self._values.get(label_values, 0) + amount
+
+	def render(self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+		with self._lock:
+			for label_values, value in sorted(self._values.items()):
+				lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}')
+		return lines
+
+class Histogram:
+	def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.buckets = buckets
+		self._values = {}
+		self._lock = threading.Lock()
+
+	def observe(self, value, *label_values):
+		with self._lock:
+			series = self._values.get(label_values)
+			if series is None:
+				# One count per bucket, then the +Inf count and the sum
+				series = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					series[i] += 1
+					break
+			else:
+				series[len(self.buckets)] += 1
+			series[-1] += value
+
+	def render(self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+		with self._lock:
+			for label_values, series in sorted(self._values.items()):
+				cumulative = 0
+				for bound, count in zip(self.buckets + ('+Inf',), series):
+					cumulative += count
+					le = f'le="{bound}"'
+					lines.append(f'{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}')
+				labels = _format_labels(self.labels, label_values)
+				lines.append(f'{self.name}_sum{labels} {_format_value(series[-1])}')
+				lines.append(f'{self.name}_count{labels} {cumulative}')
+		return lines
+
+class RequestTiming:
+	"""
+	Twilio calls made while serving one API request, including the ones made from
+	worker threads started with bind_context().
+	"""
+	def __init__(self, route):
+		self.route = route
+		self.started = time.perf_counter()
+		self.calls = 0
+		self.twilio_seconds = 0.0
+		self.resources = {}
+		self._lock = threading.Lock()
+
+	def add(self, resource, seconds):
+		with self._lock:
+			self.calls += 1
+			self.twilio_seconds += seconds
+			entry = self.resources.setdefault(resource, [0, 0.0])
+			entry[0] += 1
+			entry[1] += seconds
+
+	def elapsed(self):
+		return time.perf_counter() - self.started
+
+	def header(self):
+		# Server-Timing syntax: total;dur=..., twilio;count=..;dur=..., then one entry per resource
+		with self._lock:
+			parts = [
+				f'total;dur={self.elapsed() * 1000:.1f}',
+				f'twilio;count={self.calls};dur={self.twilio_seconds * 1000:.1f}'
+			]
+			for resource, (count, seconds) in sorted(self.resources.items(), key=lambda item: -item[1][1]):
+				parts.append(f'{resource};count={count};dur={seconds * 1000:.1f}')
+		return ', '.join(parts)
+
+class Metrics:
+	"""
+	In-process metrics rendered in the Prometheus text format.
+
+	Every outbound Twilio call is counted and timed by resource and by the API route
+	that caused it; routes get latency and calls-per-request histograms, and registered
+	caches report their hit ratios when scraped.
+	"""
+	def __init__(self):
+		self.twilio_requests = Counter(
+			'twilio_requests_total', 'Outbound Twilio API calls.', ('resource', 'method', 'status', 'route'))
+		self.twilio_duration = Histogram(
+			'twilio_request_duration_seconds', 'Latency of outbound Twilio API calls, one sample per attempt.', ('resource', 'route'))
+		self.http_duration = Histogram(
+			'http_request_duration_seconds', 'Latency of API requests, streamed bodies included.', ('route', 'method', 'status'))
+		self.calls_per_request = Histogram(
+			'twilio_calls_per_request', 'Twilio API calls made per API request.', ('route',), buckets=CALL_COUNT_BUCKETS)
+		self._caches = {}
+		self._gauges = []
+
+	def register_cache(self, name, cache):
+		# Anything with a TTLCache-like stats() method
+		self._caches[name] = cache
+
+	def register_gauge(self, name, help, labels, collect):
+		# collect() returns {label values: value}, read when the metrics are scraped
+		self._gauges.append((name, help, labels, collect))
+
+	def record_twilio_call(self, method, url, status, seconds):
+		resource = twilio_resource(url)
+		timing = _current_timing.get()
+		route = timing.route if timing else BACKGROUND_ROUTE
+		self.twilio_requests.inc(resource, method.upper(), status, route)
+		self.twilio_duration.observe(seconds, resource, route)
+		if timing:
+			timing.add(resource, seconds)
+
+	def start_request(self, route):
+		timing = RequestTiming(route)
+		_current_timing.set(timing)
+		return timing
+
+	def finish_request(self, timing, method, status):
+		self.http_duration.observe(timing.elapsed(), timing.route, method, status)
+		self.calls_per_request.observe(timing.calls, timing.route)
+
+	def render(self):
+		lines = []
+		for metric in (self.twilio_requests, self.twilio_duration, self.http_duration, self.calls_per_request):
+			lines += metric.render()
+
+		cache_stats = {name: cache.stats() for name, cache in self._caches.items()}
+		for key, kind, help in (
+				('hits', 'counter', 'Cache hits.'),
+				('misses', 'counter', 'Cache misses.'),
+				('evictions', 'counter', 'Cache evictions.'),
+				('hit_ratio', 'gauge', 'Cache hit ratio since startup.')):
+			name = f'cache_{key}' + ('_total' if kind == 'counter' else '')
+			lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+			for cache_name, stats in sorted(cache_stats.items()):
+				lines.append(f'{name}{_format_labels(("cache",), (cache_name,))} {_format_value(stats.get(key, 0))}')
+
+		for name, help, labels, collect in self._gauges:
+			lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+			for label_values, value in sorted(collect().items()):
+				lines.append(f'{name}{_format_labels(labels, label_values)} {_format_value(value)}')
+		return '\n'.join(lines) + '\n'
+
+def current_timing():
+	return _current_timing.get()
+
+def bind_context(fn):
+	"""
+	Wrap fn so it runs with the caller's context, e.g. when submitted to a worker pool,
+	so the Twilio calls it makes are attributed to the API request that started it.
+	"""
+	context = contextvars.copy_context()
+	# A context can only be entered by one thread at a time, every call runs in its own copy
+	return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+metrics = Metrics()
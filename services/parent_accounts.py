@@ -0,0 +1,125 @@
+import os
+import re
+import threading
+
+# Parent accounts served by the process, the first one being the default:
+#	TWILIO_PARENTS=us,emea
+#	TWILIO_US_ACCOUNT_SID=AC...    TWILIO_US_AUTH_TOKEN=...
+#	TWILIO_EMEA_ACCOUNT_SID=AC...  TWILIO_EMEA_AUTH_TOKEN=...
+# Each parent can override TWILIO_<NAME>_RATE (requests per second for the parent and its
+# subaccounts), TWILIO_<NAME>_POOL_SIZE and TWILIO_<NAME>_BADGE_CONCURRENCY, otherwise
+# TWILIO_PARENT_RATE, TWILIO_POOL_SIZE and BADGE_CONCURRENCY apply.
+# Without TWILIO_PARENTS, TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN are the only parent.
+DEFAULT_PARENT_NAME = 'default'
+PARENT_NAME_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]*$')
+
+class UnknownParentError(LookupError):
+	pass
+
+class ParentAccount:
+	"""
+	A parent account's credentials and the share of the process it gets: its own Twilio
+	connection pool, rate budget and background workers. Limits left as None use the
+	process-wide settings.
+	"""
+	def __init__(self, name, account_sid, auth_token, rate=None, pool_size=None, badge_concurrency=None):
+		self.name = name
+		self.account_sid = account_sid
+		self.auth_token = auth_token
+		self.rate = rate
+		self.pool_size = pool_size
+		self.badge_concurrency = badge_concurrency
+
+	def __repr__(self):
+		return f'ParentAccount({self.name!r}, {self.account_sid!r})'
+
+	def describe(self):
+		# Everything but the auth token
+		return {
+			'name': self.name,
+			'account_sid': self.account_sid,
+			'rate': self.rate,
+			'pool_size': self.pool_size,
+			'badge_concurrency': self.badge_concurrency
+		}
+
+def _setting(environ, key, convert):
+	value = environ.get(key)
+	if not value:
+		return None
+	try:
+		return convert(value)
+	except ValueError:
+		raise ValueError(f'{key} must be a number')
+
+def parents_from_env(environ=os.environ):
+	names = [name.strip().lower() for name in environ.get('TWILIO_PARENTS', '').split(',') if name.strip()]
+	if not names:
+		return [ParentAccount(DEFAULT_PARENT_NAME, environ.get('TWILIO_ACCOUNT_SID'), environ.get('TWILIO_AUTH_TOKEN'))]
+
+	parents = []
+	for name in dict.fromkeys(names):
+		if not PARENT_NAME_PATTERN.match(name):
+			raise ValueError(f'Invalid parent name {name!r}, use letters, digits, - and _')
+		prefix = f"TWILIO_{name.upper().replace('-', '_')}_"
+		account_sid = environ.get(prefix + 'ACCOUNT_SID')
+		auth_token = environ.get(prefix + 'AUTH_TOKEN')
+		if not account_sid or not auth_token:
+			raise ValueError(f'{prefix}ACCOUNT_SID and {prefix}AUTH_TOKEN are required for parent {name}')
+		parents.append(ParentAccount(
+			name, account_sid, auth_token,
+			rate=_setting(environ, prefix + 'RATE', float),
+			pool_size=_setting(environ, prefix + 'POOL_SIZE', int),
+			badge_concurrency=_setting(environ, prefix + 'BADGE_CONCURRENCY', int)
+		))
+	return parents
+
+class ParentRegistry:
+	"""
+	The configured parent accounts, by name. Loaded on first use rather than at import,
+	so settings loaded afterwards (e.g. from .env) are taken into account.
+
+	Services take an optional ParentAccount; None stands for the default parent, which is
+	what the code written for a single parent account keeps using.
+	"""
+	def __init__(self, loader=parents_from_env):
+		self.loader = loader
+		self._parents = None
+		self._by_sid = None
+		self._lock = threading.Lock()
+
+	def _load(self):
+		parents = self._parents
+		if parents is None:
+			with self._lock:
+				if self._parents is None:
+					parents = {parent.name: parent for parent in self.loader()}
+					self._by_sid = {parent.account_sid: parent for parent in parents.values()}
+					self._parents = parents
+				parents = self._parents
+		return parents
+
+	@property
+	def default(self):
+		return next(iter(self._load().values()))
+
+	def all(self):
+		return list(self._load().values())
+
+	def get(self, name=None):
+		if name is None:
+			return self.default
+		parent = self._load().get(name)
+		if parent is None:
+			raise UnknownParentError(f'Unknown parent account {name}')
+		return parent
+
+	def resolve(self, parent=None):
+		return parent or self.default
+
+	def find(self, account_sid):
+		# The parent with this account SID, None for subaccounts and unknown accounts
+		self._load()
+		return self._by_sid.get(account_sid)
+
+parent_registry = ParentRegistry()
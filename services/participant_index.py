@@ -0,0 +1,161 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+from services.client_registry import get_client
+from services.metrics import bind_context
+
+# How long an index is trusted before the conversation list is checked again
+PARTICIPANT_INDEX_TTL = int(os.getenv('PARTICIPANT_INDEX_TTL', '60'))
+# Upper bound on concurrent participant fetches while (re)building an index
+PARTICIPANT_CONCURRENCY = int(os.getenv('PARTICIPANT_CONCURRENCY', '16'))
+CONVERSATION_PAGE_SIZE = int(os.getenv('CONVERSATION_PAGE_SIZE', '100'))
+
+def participant_address(participant):
+	# Binding address of an SMS or WhatsApp participant, None for chat participants
+	messaging_binding = getattr(participant, 'messaging_binding', None)
+	if messaging_binding and isinstance(messaging_binding, dict):
+		return messaging_binding.get('address')
+	return None
+
+def participant_keys(participant):
+	"""
+	Lookup keys for a participant: its identity, and its binding address both as-is
+	and without the channel prefix (e.g. 'whatsapp:+15551234567' -> '+15551234567').
+	"""
+	keys = set()
+	identity = getattr(participant, 'identity', None)
+	if identity:
+		keys.add(identity)
+	address = participant_address(participant)
+	if address:
+		keys.add(address)
+		keys.add(address.split(':', 1)[-1])
+	return keys
+
+class ParticipantIndex:
+	"""
+	Per-subaccount inverted index from participant address/identity to conversation SIDs.
+
+	The first lookup for a subaccount scans every conversation's participants concurrently.
+	After ttl seconds the conversation list is fetched again and only conversations that are
+	new or whose date_updated changed are re-scanned; deleted conversations are dropped.
+
+	Lookups match like conversations_service.participant_matches: a full number or identity is found through the
+	keys, and a partial number (e.g. without its country code) is searched for in the binding
+	addresses kept in memory, without calling Twilio.
+	"""
+	def __init__(self, ttl=PARTICIPANT_INDEX_TTL, concurrency=PARTICIPANT_CONCURRENCY):
+		self.ttl = ttl
+		self.concurrency = concurrency
+		self._indexes = {}
+		self._lock = threading.Lock()
+
+	def _get_index(self, subaccount_sid):
+		with self._lock:
+			index = self._indexes.get(subaccount_sid)
+			if index is None:
+				index = {
+					'conversations': {},
+					'date_updated': {},
+					'keys': {},
+					'addresses': {},
+					'lookup': {},
+					'refreshed_at': None,
+					'lock': threading.Lock()
+				}
+				self._indexes[subaccount_sid] = index
+			return index
+
+	def find_conversations(self, subaccount_sid, phone_number, parent=None):
+		index = self.refresh(subaccount_sid, parent=parent)
+		with index['lock']:
+			matches = set(index['lookup'].get(phone_number, ()))
+			for sid, addresses in index['addresses'].items():
+				if sid not in matches and any(phone_number in address for address in addresses):
+					matches.add(sid)
+			return [conversation for sid, conversation in index['conversations'].items() if sid in matches]
+
+	def refresh(self, subaccount_sid, force=False, parent=None):
+		# parent: ParentAccount of the subaccount, the default parent if None
+		index = self._get_index(subaccount_sid)
+		with index['lock']:
+			refreshed_at = index['refreshed_at']
+			if force or refreshed_at is None or time.monotonic() - refreshed_at > self.ttl:
+				self._refresh(subaccount_sid, index, parent)
+		return index
+
+	def invalidate(self, subaccount_sid):
+		with self._lock:
+			self._indexes.pop(subaccount_sid, None)
+
+	def _refresh(self, subaccount_sid, index, parent=None):
+		# Callers hold index['lock']
+		client = get_client(account_sid=subaccount_sid, parent=parent)
+		conversations = client.conversations.v1.conversations.list(page_size=CONVERSATION_PAGE_SIZE)
+
+		listed = {}
+		stale = []
+		for conversation in conversations:
+			listed[conversation.sid] = conversation
+			if index['date_updated'].get(conversation.sid) != conversation.date_updated:
+				stale.append(conversation)
+
+		# Forget conversations that no longer exist
+		for sid in set(index['conversations']) - set(listed):
+			self._unindex(index, sid)
+			index['date_updated'].pop(sid, None)
+
+		def scan(conversation):
+			try:
+				participants = client.conversations.v1.conversations(conversation.sid).participants.list()
+				keys = set()
+				addresses = set()
+				for participant in participants:
+					keys |= participant_keys(participant)
+					address = participant_address(participant)
+					if address:
+						addresses.add(address)
+				return conversation, keys, addresses
+			except Exception as participant_error:
+				print(f"Error fetching participants for conversation {conversation.sid}: {participant_error}")
+				return conversation, None, None
+
+		if stale:
+			print(f"Indexing participants of {len(stale)} of {len(listed)} conversations for subaccount {subaccount_sid}")
+			with ThreadPoolExecutor(max_workers=min(self.concurrency, len(stale))) as executor:
+				for conversation, keys, addresses in executor.map(bind_context(scan), stale):
+					if keys is None:
+						# Leave date_updated unset so it is retried on the next refresh
+						continue
+					self._unindex(index, conversation.sid)
+					index['keys'][conversation.sid] = keys
+					index['addresses'][conversation.sid] = addresses
+					for key in keys:
+						index['lookup'].setdefault(key, set()).add(conversation.sid)
+					index['date_updated'][conversation.sid] = conversation.date_updated
+
+		# Keep Twilio's listing order for the results
+		index['conversations'] = listed
+		index['refreshed_at'] = time.monotonic()
+
+	def _unindex(self, index, conversation_sid):
+		index['addresses'].pop(conversation_sid, None)
+		for key in index['keys'].pop(conversation_sid, set()):
+			sids = index['lookup'].get(key)
+			if sids:
+				sids.discard(conversation_sid)
+				if not sids:
+					del index['lookup'][key]
+
+	def stats(self):
+		with self._lock:
+			return {
+				sid: {
+					'conversations': len(index['conversations']),
+					'keys': len(index['lookup'])
+				}
+				for sid, index in self._indexes.items()
+			}
+
+participant_index = ParticipantIndex()
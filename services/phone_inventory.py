@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+import os
+import threading
+import time
+from services.db import ensure_schema
+from services.metrics import bind_context
+from services.parent_accounts import parent_registry
+
+# Subaccounts synced longer ago than this are listed again before answering a query
+INVENTORY_MAX_AGE = int(os.getenv('INVENTORY_MAX_AGE', '600'))
+# Upper bound on concurrent subaccount listings while syncing
+INVENTORY_CONCURRENCY = int(os.getenv('INVENTORY_CONCURRENCY', '8'))
+
+# Emergency status of a number without an emergency address
+NO_EMERGENCY_ADDRESS = 'none'
+
+INVENTORY_FIELDS = (
+	'sid', 'subaccount_sid', 'phone_number', 'friendly_name', 'status',
+	'emergency_address_sid', 'emergency_address_status', 'date_created'
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS phone_numbers (
+	sid TEXT PRIMARY KEY,
+	subaccount_sid TEXT NOT NULL,
+	phone_number TEXT NOT NULL,
+	friendly_name TEXT,
+	status TEXT,
+	emergency_address_sid TEXT,
+	emergency_address_status TEXT,
+	date_created TEXT
+);
+CREATE INDEX IF NOT EXISTS phone_numbers_subaccount ON phone_numbers (subaccount_sid, phone_number);
+CREATE INDEX IF NOT EXISTS phone_numbers_number ON phone_numbers (phone_number);
+CREATE TABLE IF NOT EXISTS phone_number_syncs (
+	subaccount_sid TEXT PRIMARY KEY,
+	synced_at REAL,
+	error TEXT,
+	parent TEXT
+);
+"""
+
+def parse_date(value, name):
+	# ISO 8601 date or datetime, naive values are taken as UTC
+	try:
+		parsed = datetime.fromisoformat(value)
+	except ValueError:
+		raise ValueError(f'{name} must be an ISO 8601 date or datetime')
+	if parsed.tzinfo is None:
+		parsed = parsed.replace(tzinfo=timezone.utc)
+	return parsed.astimezone(timezone.utc).isoformat()
+
+class PhoneInventory:
+	"""
+	Local table of the phone numbers of every subaccount, for queries across subaccounts.
+
+	Each subaccount is synced on its own: a query first re-lists, concurrently, only the active
+	subaccounts never synced or synced more than max_age seconds ago (or marked stale with
+	invalidate() after a change), and drops the numbers of subaccounts that are gone or closed.
+
+	Every parent account has its own inventory, syncing and querying only its subaccounts'
+	numbers; they share the tables.
+	"""
+	def __init__(self, subaccount_service, max_age=INVENTORY_MAX_AGE, concurrency=INVENTORY_CONCURRENCY):
+		self.subaccount_service = subaccount_service
+		self.max_age = max_age
+		self.concurrency = concurrency
+		self._sync_lock = threading.Lock()
+
+	def _db(self):
+		# Tables created before there were several parents: their subaccounts are the default parent's
+		return ensure_schema('phone_inventory', SCHEMA, {'phone_number_syncs': [('parent', 'TEXT', parent_registry.default.name)]})
+
+	@property
+	def parent_name(self):
+		return parent_registry.resolve(self.subaccount_service.parent).name
+
+	def invalidate(self, subaccount_sid):
+		self._db().execute('UPDATE phone_number_syncs SET synced_at = NULL WHERE subaccount_sid = ?', (subaccount_sid,))
+
+	def stale_subaccounts(self, max_age=None):
+		max_age = self.max_age if max_age is None else max_age
+		active = [sa['sid'] for sa in self.subaccount_service.account_index.all() if sa['status'] == 'active']
+		synced = {row['subaccount_sid']: row['synced_at'] for row in self._db().execute(
+			'SELECT subaccount_sid, synced_at FROM phone_number_syncs WHERE parent = ?', (self.parent_name,))}
+		now = time.time()
+		return active, [sid for sid in active if synced.get(sid) is None or now - synced[sid] > max_age]
+
+	def sync(self, max_age=None):
+		"""
+		Bring the inventory up to date. Returns {'synced': n, 'errors': {sid: error}}.
+		A subaccount that fails to list keeps its previous numbers.
+		"""
+		# One sync at a time, concurrent queries wait for it rather than listing the same subaccounts
+		with self._sync_lock:
+			active, stale = self.stale_subaccounts(max_age)
+			self._drop_missing(active)
+			errors = {}
+			if stale:
+				print(f"Syncing phone numbers of {len(stale)} of {len(active)} subaccounts")
+				list_numbers = bind_context(self.subaccount_service.get_phone_numbers)
+				with ThreadPoolExecutor(max_workers=min(self.concurrency, len(stale))) as executor:
+					futures = {executor.submit(list_numbers, sid): sid for sid in stale}
+					for future in as_completed(futures):
+						sid = futures[future]
+						try:
+							self._store(sid, future.result())
+						except Exception as e:
+							print(f"Error syncing phone numbers of subaccount {sid}: {e}")
+							errors[sid] = str(e)
+							self._db().execute(
+								'INSERT INTO phone_number_syncs (subaccount_sid, error, parent) VALUES (?, ?, ?) '
+								'ON CONFLICT(subaccount_sid) DO UPDATE SET error = excluded.error, parent = excluded.parent',
+								(sid, str(e), self.parent_name)
+							)
+			return {'synced': len(stale) - len(errors), 'errors': errors}
+
+	def _store(self, subaccount_sid, phone_numbers):
+		# Replace the subaccount's numbers in one transaction, readers never see it half-synced
+		rows = self._rows(subaccount_sid, phone_numbers)
+		db = self._db()
+		with db:
+			db.execute('BEGIN IMMEDIATE')
+			db.execute('DELETE FROM phone_numbers WHERE subaccount_sid = ?', (subaccount_sid,))
+			db.executemany(f'INSERT OR REPLACE INTO phone_numbers ({", ".join(INVENTORY_FIELDS)}) VALUES ({", ".join("?" * len(INVENTORY_FIELDS))})', rows)
+			db.execute(
+				'INSERT INTO phone_number_syncs (subaccount_sid, synced_at, error, parent) VALUES (?, ?, NULL, ?) '
+				'ON CONFLICT(subaccount_sid) DO UPDATE SET synced_at = excluded.synced_at, error = NULL, parent = excluded.parent',
+				(subaccount_sid, time.time(), self.parent_name)
+			)
+
+	def update_numbers(self, subaccount_sid, phone_numbers):
+		# Store numbers changed through the API, without waiting for the subaccount's next sync
+		self._db().executemany(
+			f'INSERT OR REPLACE INTO phone_numbers ({", ".join(INVENTORY_FIELDS)}) VALUES ({", ".join("?" * len(INVENTORY_FIELDS))})',
+			self._rows(subaccount_sid, phone_numbers)
+		)
+
+	@staticmethod
+	def _rows(subaccount_sid, phone_numbers):
+		return [(
+			pn['sid'], subaccount_sid, pn['phone_number'], pn['friendly_name'], pn['status'],
+			pn['emergency_address_sid'], pn['emergency_address_status'],
+			pn['date_created'].astimezone(timezone.utc).isoformat() if pn['date_created'] else None
+		) for pn in phone_numbers]
+
+	def _drop_missing(self, active):
+		db = self._db()
+		known = [row['subaccount_sid'] for row in db.execute('SELECT subaccount_sid FROM phone_number_syncs WHERE parent = ?', (self.parent_name,))]
+		gone = set(known) - set(active)
+		if gone:
+			with db:
+				db.execute('BEGIN IMMEDIATE')
+				db.executemany('DELETE FROM phone_numbers WHERE subaccount_sid = ?', [(sid,) for sid in gone])
+				db.executemany('DELETE FROM phone_number_syncs WHERE subaccount_sid = ?', [(sid,) for sid in gone])
+
+	def query(self, emergency_status=None, emergency_registered=None, created_after=None, created_before=None,
+			prefix=None, subaccount_sid=None):
+		"""
+		Yield the matching numbers of the parent's subaccounts one at a time, ordered by subaccount and number.
+
+		Args:
+			emergency_status: Emergency address statuses to keep, NO_EMERGENCY_ADDRESS for numbers without one.
+			emergency_registered: True for registered numbers only, False for all the others.
+			created_after: Only numbers created at or after this ISO 8601 date.
+			created_before: Only numbers created before this ISO 8601 date.
+			prefix: Only numbers starting with this, e.g. +1555.
+			subaccount_sid: Only numbers of this subaccount.
+		"""
+		clauses = ['subaccount_sid IN (SELECT subaccount_sid FROM phone_number_syncs WHERE parent = ?)']
+		params = [self.parent_name]
+		if emergency_status:
+			conditions = []
+			statuses = [status for status in emergency_status if status != NO_EMERGENCY_ADDRESS]
+			if statuses:
+				conditions.append(f'(emergency_address_sid IS NOT NULL AND emergency_address_status IN ({", ".join("?" * len(statuses))}))')
+				params += statuses
+			if NO_EMERGENCY_ADDRESS in emergency_status:
+				conditions.append('emergency_address_sid IS NULL')
+			clauses.append('(' + ' OR '.join(conditions) + ')')
+		if emergency_registered is not None:
+			registered = "(emergency_address_sid IS NOT NULL AND emergency_address_status = 'registered')"
+			clauses.append(registered if emergency_registered else f'NOT {registered}')
+		if created_after:
+			clauses.append('date_created >= ?')
+			params.append(parse_date(created_after, 'created_after'))
+		if created_before:
+			clauses.append('date_created < ?')
+			params.append(parse_date(created_before, 'created_before'))
+		if prefix:
+			clauses.append("phone_number LIKE ? ESCAPE '\\'")
+			params.append(prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+		if subaccount_sid:
+			clauses.append('subaccount_sid = ?')
+			params.append(subaccount_sid)
+
+		cursor = self._db().execute(
+			f'SELECT {", ".join(INVENTORY_FIELDS)} FROM phone_numbers WHERE {" AND ".join(clauses)} ORDER BY subaccount_sid, phone_number',
+			params
+		)
+		# Rows are read from SQLite as they are consumed
+		for row in cursor:
+			yield dict(row)
@@ -1,19 +1,74 @@
-from twilio.rest import Client
+from concurrent.futures import ThreadPoolExecutor
 import os
+from services.cache import TTLCache
+from services.client_registry import get_client
+from services.events import (
+	event_bus, PHONE_NUMBER_PURCHASED, PHONE_NUMBER_RELEASED, EMERGENCY_ADDRESS_ASSIGNED, EMERGENCY_ADDRESS_REMOVED
+)
+from services.metrics import bind_context
+from services.parent_accounts import parent_registry
+from services.single_flight import SingleFlight
+
+# Records fetched per page when listing phone numbers (Twilio allows up to 1000)
+PHONE_NUMBER_PAGE_SIZE = int(os.getenv('PHONE_NUMBER_PAGE_SIZE', '1000'))
+# Upper bound on concurrent number releases per subaccount
+RELEASE_CONCURRENCY = int(os.getenv('RELEASE_CONCURRENCY', '8'))
+
+# Available number searches: numbers returned per (country, type, area code) query,
+# queries run at once, and how long results are reused
+SEARCH_LIMIT = int(os.getenv('SEARCH_LIMIT', '20'))
+SEARCH_CONCURRENCY = int(os.getenv('SEARCH_CONCURRENCY', '8'))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '60'))
+MAX_SEARCH_QUERIES = 50
+
+# Number types accepted by the search, mapped to the AvailablePhoneNumbers sub-resource
+NUMBER_TYPES = {'local': 'local', 'mobile': 'mobile', 'toll_free': 'toll_free', 'toll-free': 'toll_free'}
+# Countries where area codes apply (North American Numbering Plan)
+AREA_CODE_COUNTRIES = ('US', 'CA')
+
+# Available numbers are the same whichever account searches, so results are shared process-wide
+search_cache = TTLCache(maxsize=512, ttl=SEARCH_CACHE_TTL)
+_search_in_flight = SingleFlight()
+
+def extract_phone_number_data(phone_number):
+	return {
+		'sid': phone_number.sid,
+		'phone_number': phone_number.phone_number,
+		'friendly_name': phone_number.friendly_name,
+		'date_created': phone_number.date_created,
+		'status': phone_number.status,
+		'emergency_address_sid': phone_number.emergency_address_sid,
+		'emergency_address_status': getattr(phone_number, 'emergency_address_status', None),
+	}
 
 class PhoneNumberService:
-	def __init__(self, subaccount_sid=None, subaccount_auth_token=None):
+	def __init__(self, subaccount_sid=None, subaccount_auth_token=None, parent=None):
+		# parent: ParentAccount of the subaccount, whose connection pool and rate budget are used
+		self.parent = parent
 		if not subaccount_sid and not subaccount_auth_token:
-			self.client = Client(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
+			parent = parent_registry.resolve(parent)
+			self.credentials = (parent.account_sid, parent.auth_token)
 		else:
-			self.client = Client(subaccount_sid, subaccount_auth_token)
+			self.credentials = (subaccount_sid, subaccount_auth_token)
+
+	@property
+	def client(self):
+		# Clients come from the shared registry so connections are reused across requests
+		return get_client(*self.credentials, parent=self.parent)
 	
-	def list_phone_numbers(self):
+	def list_phone_numbers(self, page_size=None):
 		# List all phone numbers associated with the subaccount
-		phone_numbers = self.client.incoming_phone_numbers.list()
+		phone_numbers = self.client.incoming_phone_numbers.stream(page_size=page_size or PHONE_NUMBER_PAGE_SIZE)
 		
 		return [{'sid': pn.sid, 'phone_number': pn.phone_number} for pn in phone_numbers]
 
+	def list_phone_numbers_details(self, page_size=None):
+		# The list response already carries the full IncomingPhoneNumber records,
+		# so build the detailed view in one paged pass instead of fetching each number
+		phone_numbers = self.client.incoming_phone_numbers.stream(page_size=page_size or PHONE_NUMBER_PAGE_SIZE)
+		
+		return [extract_phone_number_data(pn) for pn in phone_numbers]
+
 	def get_phone_number_info(self, phone_number_sid):
 		phone_number = self.client.incoming_phone_numbers(phone_number_sid).fetch()
 		return phone_number
@@ -21,43 +76,114 @@ class PhoneNumberService:
 	def release_all_phone_numbers(self):
 		# List all phone numbers associated with the subaccount
 		phone_numbers = self.list_phone_numbers()
+		if not phone_numbers:
+			return []
 
-		for number in phone_numbers:
-			# Release each phone number
-			self.release_phone_number(number['sid'])
+		# Release the phone numbers over a bounded worker pool
+		with ThreadPoolExecutor(max_workers=min(RELEASE_CONCURRENCY, len(phone_numbers))) as executor:
+			return list(executor.map(bind_context(self.release_phone_number), [number['sid'] for number in phone_numbers]))
 			   
-	def buy_phone_number(self, subaccount_sid, phone_number):
-		subaccount_client = Client(subaccount_sid, os.getenv('TWILIO_AUTH_TOKEN'))
-		return subaccount_client.incoming_phone_numbers.create(phone_number=phone_number)
-
 	def release_phone_number(self, phone_number_sid):
-	   # Release the phone number (delete it)
-		phone_number = self.client.incoming_phone_numbers(phone_number_sid).fetch()
+		# Release the phone number (delete it), no need to fetch it first
+		phone_number = self.client.incoming_phone_numbers(phone_number_sid)
 		# First, remove the emergency address before releasing the number
-		self.remove_emergency_address(phone_number_sid)
+		phone_number.update(emergency_address_sid="")
 		phone_number.delete()
+		event_bus.publish(PHONE_NUMBER_RELEASED, self.credentials[0], sid=phone_number_sid)
 		return f'Phone number {phone_number_sid} released successfully.'
 
 	def remove_emergency_address(self, phone_number_sid):
-		# Fetch the phone number and update it to remove the emergency address
-		phone_number = self.client.incoming_phone_numbers(phone_number_sid).fetch()
-		phone_number.update(emergency_address_sid="")  # Unset emergency address
+		self.update_emergency_address(phone_number_sid, None)
 		return f'Emergency address removed for {phone_number_sid}'
+
+	def update_emergency_address(self, phone_number_sid, emergency_address_sid):
+		# Assign an emergency address, or remove it when emergency_address_sid is empty. Returns the updated number
+		updated = self.client.incoming_phone_numbers(phone_number_sid).update(emergency_address_sid=emergency_address_sid or "")
+		if emergency_address_sid:
+			event_bus.publish(EMERGENCY_ADDRESS_ASSIGNED, self.credentials[0], sid=phone_number_sid, emergency_address_sid=emergency_address_sid)
+		else:
+			event_bus.publish(EMERGENCY_ADDRESS_REMOVED, self.credentials[0], sid=phone_number_sid)
+		return extract_phone_number_data(updated)
 	
-	def search_available_phone_numbers(self, country='US', area_code=None):
-		# Search for available phone numbers in the specified country and area code (if provided)
-		available_numbers = self.client.available_phone_numbers(country).local.list(area_code=area_code, limit=5)
+	def search_available_phone_numbers(self, countries=('US',), area_codes=None, number_types=('local',), limit=SEARCH_LIMIT, cached=True):
+		"""
+		Search available numbers for every combination of country, number type and area code, concurrently.
+		Area codes only apply to US and CA, other countries are searched without one. With cached=False
+		the searches always go to Twilio, e.g. right before buying the numbers found.
+
+		Returns {'numbers': [...], 'errors': [...]}: the merged numbers without duplicates, and the
+		queries that failed. Raises the first error if every query failed.
+		"""
+		countries = [country.upper() for country in countries]
+		unknown = [number_type for number_type in number_types if number_type not in NUMBER_TYPES]
+		if unknown:
+			raise ValueError(f"Unknown number type {unknown[0]}, expected one of local, mobile, toll_free")
+		number_types = list(dict.fromkeys(NUMBER_TYPES[number_type] for number_type in number_types))
+		area_codes = list(dict.fromkeys(area_codes or []))
+
+		queries = []
+		for country in dict.fromkeys(countries):
+			for number_type in number_types:
+				for area_code in (area_codes if area_codes and country in AREA_CODE_COUNTRIES else [None]):
+					queries.append((country, number_type, area_code, limit))
+		if len(queries) > MAX_SEARCH_QUERIES:
+			raise ValueError(f'Search would need {len(queries)} queries, at most {MAX_SEARCH_QUERIES} are allowed')
 
-		# Return a list of available phone numbers
-		return [{'phone_number': number.phone_number, 'friendly_name': number.friendly_name} for number in available_numbers]
+		def search(query):
+			# Identical concurrent searches share one call, repeated ones are served from cache
+			if not cached:
+				return self._search(*query)
+			return search_cache.get_or_load(query, lambda: _search_in_flight.do(query, lambda: self._search(*query)))
 
-	def buy_phone_number(self, phone_number):
-		# Purchase the phone number for the subaccount
-		purchased_number = self.client.incoming_phone_numbers.create(phone_number=phone_number)
+		results = {}
+		errors = []
+		first_error = None
+		with ThreadPoolExecutor(max_workers=min(SEARCH_CONCURRENCY, len(queries))) as executor:
+			futures = [executor.submit(bind_context(search), query) for query in queries]
+			for query, future in zip(queries, futures):
+				try:
+					for number in future.result():
+						results.setdefault(number['phone_number'], number)
+				except Exception as e:
+					country, number_type, area_code, _ = query
+					print(f"Error searching {number_type} numbers in {country} (area code {area_code}): {e}")
+					errors.append({'country': country, 'number_type': number_type, 'area_code': area_code, 'error': str(e)})
+					first_error = first_error or e
+
+		# Queries are read in order, the first error is that of the first query
+		if len(errors) == len(queries):
+			raise first_error
+		return {'numbers': list(results.values()), 'errors': errors}
+
+	def _search(self, country, number_type, area_code, limit):
+		resource = getattr(self.client.available_phone_numbers(country), number_type)
+		params = {'area_code': area_code} if area_code else {}
+		return [{
+			'phone_number': number.phone_number,
+			'friendly_name': number.friendly_name,
+			'iso_country': number.iso_country,
+			'number_type': number_type,
+			'locality': number.locality,
+			'region': number.region,
+			'postal_code': number.postal_code,
+			'capabilities': number.capabilities
+		} for number in resource.list(limit=limit, **params)]
+
+	def buy_phone_number(self, phone_number, friendly_name=None, emergency_address_sid=None):
+		# Purchase the phone number for the subaccount, configured by the create call itself
+		options = {}
+		if friendly_name:
+			options['friendly_name'] = friendly_name
+		if emergency_address_sid:
+			options['emergency_address_sid'] = emergency_address_sid
+		purchased_number = self.client.incoming_phone_numbers.create(phone_number=phone_number, **options)
+		purchased = extract_phone_number_data(purchased_number)
+		event_bus.publish(PHONE_NUMBER_PURCHASED, self.credentials[0], **purchased)
 		
-		return {
-			'sid': purchased_number.sid,
-			'phone_number': purchased_number.phone_number,
-			'friendly_name': purchased_number.friendly_name,
-			'date_created': purchased_number.date_created
-		}
\ No newline at end of file
+		return purchased
+
+	def find_phone_number(self, phone_number):
+		# The subaccount's record of a number in E.164 format, None if it doesn't own it
+		for pn in self.client.incoming_phone_numbers.list(phone_number=phone_number, limit=1):
+			return extract_phone_number_data(pn)
+		return None
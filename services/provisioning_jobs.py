@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+from twilio.base.exceptions import TwilioRestException
+import os
+from services.badge_store import badge_store
+from services.job_engine import JobEngine
+from services.job_store import job_store, RUNNING, COMPLETED, FAILED
+
+PROVISION_NUMBERS_JOB = 'provision_numbers'
+
+# Upper bound on concurrent purchases per job, the rate limiter paces them further
+PROVISION_CONCURRENCY = int(os.getenv('PROVISION_CONCURRENCY', '8'))
+# Number of provisioning jobs processed at the same time
+PROVISION_JOB_WORKERS = int(os.getenv('PROVISION_JOB_WORKERS', '2'))
+# Most numbers one job may buy
+MAX_PROVISION_NUMBERS = int(os.getenv('MAX_PROVISION_NUMBERS', '500'))
+
+def provisioning_params(data):
+	"""
+	Validate a provisioning request body and return the job parameters. Either
+
+		{"phone_numbers": ["+14155550100", {"phone_number": "+14155550101", "friendly_name": "Desk"}], ...}
+
+	or a search spec and how many of the numbers found to buy:
+
+		{"search": {"country": "US", "area_code": "415", "type": "local"}, "count": 10, ...}
+
+	friendly_name and emergency_address_sid at the top level apply to every number without its own.
+	Raises ValueError for an invalid body.
+	"""
+	params = {
+		'friendly_name': data.get('friendly_name'),
+		'emergency_address_sid': data.get('emergency_address_sid')
+	}
+	phone_numbers = data.get('phone_numbers')
+	search = data.get('search')
+	if bool(phone_numbers) == bool(search):
+		raise ValueError('Either phone_numbers or search is required')
+
+	if phone_numbers:
+		if not isinstance(phone_numbers, list):
+			raise ValueError('phone_numbers must be a list')
+		numbers = {}
+		for entry in phone_numbers:
+			if isinstance(entry, str):
+				entry = {'phone_number': entry}
+			if not isinstance(entry, dict) or not entry.get('phone_number'):
+				raise ValueError('Every entry of phone_numbers needs a phone_number')
+			numbers[entry['phone_number']] = {
+				key: entry[key] for key in ('friendly_name', 'emergency_address_sid') if entry.get(key)
+			}
+		if len(numbers) > MAX_PROVISION_NUMBERS:
+			raise ValueError(f'At most {MAX_PROVISION_NUMBERS} numbers can be provisioned at once')
+		params['numbers'] = numbers
+		return params
+
+	if not isinstance(search, dict):
+		raise ValueError('search must be an object')
+	try:
+		count = int(data.get('count'))
+	except (TypeError, ValueError):
+		raise ValueError('count is required with search')
+	if not 1 <= count <= MAX_PROVISION_NUMBERS:
+		raise ValueError(f'count must be between 1 and {MAX_PROVISION_NUMBERS}')
+
+	def as_list(value):
+		if value is None:
+			return []
+		return value if isinstance(value, list) else [str(value)]
+
+	params['search'] = {
+		'countries': as_list(search.get('country')) or ['US'],
+		'area_codes': as_list(search.get('area_code')),
+		'number_types': as_list(search.get('type')) or ['local']
+	}
+	params['count'] = count
+	return params
+
+class ProvisioningJobEngine(JobEngine):
+	"""
+	Buys phone numbers for a subaccount as background jobs: the numbers, given or found with a
+	search, are recorded as job items and purchased over a bounded worker pool, each with its
+	friendly name and emergency address set by the create call. Per-number results are kept in
+	the job store; a resumed job only retries the numbers not bought yet. Every parent account
+	has its own engine and workers.
+	"""
+	kind = PROVISION_NUMBERS_JOB
+	label = 'provisioning'
+
+	def __init__(self, subaccount_service, phone_inventory=None, concurrency=PROVISION_CONCURRENCY,
+			workers=PROVISION_JOB_WORKERS):
+		super().__init__(subaccount_service, concurrency, workers)
+		self.phone_inventory = phone_inventory
+
+	def start(self, subaccount_sid, params):
+		job_id = self._create_job(subaccount_sid, params)
+		# Given numbers are known upfront, the job reports its total right away
+		if params.get('numbers'):
+			job_store.add_items(job_id, list(params['numbers']))
+		self._submit(job_id)
+		return job_id
+
+	def _execute(self, job_id):
+		job = job_store.get_job(job_id)
+		subaccount_sid = job['subaccount_sid']
+		params = job['params']
+		job_store.update_job(job_id, RUNNING)
+
+		phone_number_service = self._phone_number_service(subaccount_sid)
+
+		# Search once, a resumed job works from the recorded numbers. Searches skip the
+		# cache, numbers found a minute ago may have been bought since
+		if not job_store.has_items(job_id):
+			search = params['search']
+			found = phone_number_service.search_available_phone_numbers(
+				search['countries'], search['area_codes'], search['number_types'], limit=params['count'], cached=False)
+			job_store.add_items(job_id, [number['phone_number'] for number in found['numbers'][:params['count']]])
+
+		pending = job_store.pending_items(job_id)
+		print(f"Buying {len(pending)} phone numbers for subaccount {subaccount_sid} (job {job_id})")
+
+		def buy(phone_number):
+			options = params.get('numbers', {}).get(phone_number, {})
+			friendly_name = options.get('friendly_name') or params.get('friendly_name')
+			emergency_address_sid = options.get('emergency_address_sid') or params.get('emergency_address_sid')
+			job_store.update_item(job_id, phone_number, RUNNING)
+			try:
+				purchased = phone_number_service.buy_phone_number(phone_number, friendly_name, emergency_address_sid)
+			except TwilioRestException as e:
+				# Bought right before an interruption, the subaccount already owns it
+				purchased = phone_number_service.find_phone_number(phone_number) if e.status == 400 else None
+				if purchased is None:
+					raise
+			if purchased['date_created']:
+				purchased['date_created'] = purchased['date_created'].isoformat()
+			job_store.update_item(job_id, phone_number, COMPLETED, result=purchased)
+
+		def buy_safely(phone_number):
+			try:
+				buy(phone_number)
+			except Exception as e:
+				print(f"Error buying phone number {phone_number}: {e}")
+				job_store.update_item(job_id, phone_number, FAILED, error=str(e))
+
+		if pending:
+			with ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending))) as executor:
+				list(executor.map(buy_safely, pending))
+
+		progress = job_store.get_job(job_id)['progress']
+		if progress['failed']:
+			job_store.update_job(job_id, FAILED, error=f"{progress['failed']} of {progress['total']} phone numbers could not be bought")
+			return
+
+		result = {'purchased': progress['completed']}
+		if 'count' in params and progress['total'] < params['count']:
+			result['shortfall'] = params['count'] - progress['total']
+		job_store.update_job(job_id, COMPLETED, result=result)
+
+	def _finished(self, job_id):
+		# The subaccount's numbers changed, whatever the outcome
+		try:
+			subaccount_sid = job_store.get_job(job_id)['subaccount_sid']
+			self.subaccount_service.forget_in_flight(subaccount_sid)
+			badge_store.touch(subaccount_sid)
+			if self.phone_inventory is not None:
+				self.phone_inventory.invalidate(subaccount_sid)
+		except Exception as e:
+			print(f"Error refreshing subaccount of provisioning job {job_id}: {e}")
@@ -0,0 +1,252 @@
+from urllib.parse import urlsplit
+import os
+import random
+import re
+import threading
+import time
+from services.parent_accounts import parent_registry
+
+# Sustained requests per second allowed per account, and for a parent account and its subaccounts together
+# (parents can have their own, see services/parent_accounts.py)
+TWILIO_ACCOUNT_RATE = float(os.getenv('TWILIO_ACCOUNT_RATE', '25'))
+TWILIO_PARENT_RATE = float(os.getenv('TWILIO_PARENT_RATE', '100'))
+# Requests that may be sent at once after a quiet period, as a multiple of the rate
+TWILIO_BURST_SECONDS = float(os.getenv('TWILIO_BURST_SECONDS', '1'))
+# A request that would have to wait longer than this for its turn fails right away instead
+TWILIO_MAX_WAIT = float(os.getenv('TWILIO_MAX_WAIT', '10'))
+# Consecutive failures (5xx, timeouts, connection errors) that open the circuit, and how long it stays open
+TWILIO_BREAKER_THRESHOLD = int(os.getenv('TWILIO_BREAKER_THRESHOLD', '5'))
+TWILIO_BREAKER_RESET = float(os.getenv('TWILIO_BREAKER_RESET', '30'))
+
+# Backoff between attempts after a 429 without Retry-After: base * 2^attempt, with full jitter, capped
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+
+ACCOUNT_PATTERN = re.compile(r'/Accounts/(AC[0-9a-fA-F]{32})')
+
+class TwilioUnavailableError(Exception):
+	"""
+	Raised instead of calling Twilio when it is degraded (open circuit) or keeps rate limiting
+	us. Routes report it as a 503 with a Retry-After header.
+	"""
+	def __init__(self, message, retry_after=None):
+		super().__init__(message)
+		self.retry_after = retry_after
+
+class TokenBucket:
+	"""
+	Token bucket whose rate adapts to Twilio's answers: halved on a 429 (and paused for its
+	Retry-After), then increased again by a fraction of the configured rate on every success.
+	"""
+	def __init__(self, rate, burst_seconds=TWILIO_BURST_SECONDS):
+		self.max_rate = rate
+		self.min_rate = max(rate / 32, 0.1)
+		self.rate = rate
+		self.burst_seconds = burst_seconds
+		self.tokens = self.capacity
+		self.blocked_until = 0.0
+		self.throttled = 0
+		self._updated_at = time.monotonic()
+		self._lock = threading.Lock()
+
+	@property
+	def capacity(self):
+		return max(self.rate * self.burst_seconds, 1)
+
+	def _refill(self, now):
+		self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+		self._updated_at = now
+
+	def delay(self):
+		# Seconds before a request may be sent, without taking a token
+		with self._lock:
+			now = time.monotonic()
+			self._refill(now)
+			wait = max(0.0, self.blocked_until - now)
+			if self.tokens < 1:
+				wait = max(wait, (1 - self.tokens) / self.rate)
+			return wait
+
+	def reserve(self):
+		"""Take a token and return how long to wait before using it. Waiting callers queue up in order."""
+		with self._lock:
+			now = time.monotonic()
+			self._refill(now)
+			self.tokens -= 1
+			wait = max(0.0, self.blocked_until - now)
+			if self.tokens < 0:
+				wait = max(wait, -self.tokens / self.rate)
+			return wait
+
+	def throttle(self, retry_after=None):
+		with self._lock:
+			now = time.monotonic()
+			self._refill(now)
+			self.throttled += 1
+			self.rate = max(self.min_rate, self.rate / 2)
+			self.tokens = min(self.tokens, 0)
+			if retry_after:
+				self.blocked_until = max(self.blocked_until, now + retry_after)
+
+	def succeeded(self):
+		if self.rate < self.max_rate:
+			with self._lock:
+				self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+class CircuitBreaker:
+	"""
+	Opens after `threshold` consecutive failures and fails fast for `reset_timeout` seconds,
+	then lets a single trial request through (half-open) to decide whether to close again.
+	"""
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half_open'
+
+	def __init__(self, threshold=TWILIO_BREAKER_THRESHOLD, reset_timeout=TWILIO_BREAKER_RESET):
+		self.threshold = threshold
+		self.reset_timeout = reset_timeout
+		self.state = self.CLOSED
+		self.failures = 0
+		self._opened_at = 0.0
+		self._trial_running = False
+		self._lock = threading.Lock()
+
+	def check(self, name):
+		with self._lock:
+			if self.state == self.CLOSED:
+				return
+			remaining = self._opened_at + self.reset_timeout - time.monotonic()
+			if self.state == self.OPEN and remaining <= 0:
+				self.state = self.HALF_OPEN
+			if self.state == self.HALF_OPEN and not self._trial_running:
+				self._trial_running = True
+				return
+			raise TwilioUnavailableError(
+				f'Twilio ({name}) is failing, requests are paused for up to {self.reset_timeout:.0f}s',
+				retry_after=max(1, round(remaining))
+			)
+
+	def succeeded(self):
+		with self._lock:
+			self.failures = 0
+			self.state = self.CLOSED
+			self._trial_running = False
+
+	def failed(self):
+		with self._lock:
+			self.failures += 1
+			if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+				self.state = self.OPEN
+				self._opened_at = time.monotonic()
+			self._trial_running = False
+
+class RateLimiter:
+	"""
+	Paces the Twilio calls of the whole process.
+
+	Every call takes a token from the bucket of the account it acts on and, for subaccounts,
+	from the bucket of their parent, so neither a single subaccount nor the parent as a whole
+	goes over its rate. Every parent account has its own budget: one parent being throttled
+	doesn't slow the others down. 429 responses slow the affected buckets down. Failures are
+	tracked by Twilio host with a circuit breaker.
+
+	Used by the pooled HTTP clients, see services/client_registry.py:
+
+		wait = rate_limiter.acquire(url, auth, parent_sid)
+		... sleep for wait, send the request ...
+		rate_limiter.record(url, auth, parent_sid, status, retry_after)
+	"""
+	def __init__(self, account_rate=TWILIO_ACCOUNT_RATE, parent_rate=TWILIO_PARENT_RATE, max_wait=TWILIO_MAX_WAIT,
+			breaker_threshold=TWILIO_BREAKER_THRESHOLD, breaker_reset=TWILIO_BREAKER_RESET):
+		self.account_rate = account_rate
+		self.parent_rate = parent_rate
+		self.max_wait = max_wait
+		self.breaker_threshold = breaker_threshold
+		self.breaker_reset = breaker_reset
+		self._buckets = {}
+		self._breakers = {}
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def account_for(url, auth=None):
+		# The account in the path (2010 API), otherwise the account making the request (v1 APIs)
+		match = ACCOUNT_PATTERN.search(url)
+		if match:
+			return match.group(1)
+		return auth[0] if auth else None
+
+	def _bucket(self, account_sid, rate):
+		bucket = self._buckets.get(account_sid)
+		if bucket is None:
+			with self._lock:
+				bucket = self._buckets.setdefault(account_sid, TokenBucket(rate))
+		return bucket
+
+	def _parent_bucket(self, parent_sid):
+		parent = parent_registry.find(parent_sid) if parent_sid else None
+		return self._bucket(parent_sid, parent.rate if parent and parent.rate else self.parent_rate)
+
+	def _breaker(self, host):
+		breaker = self._breakers.get(host)
+		if breaker is None:
+			with self._lock:
+				breaker = self._breakers.setdefault(host, CircuitBreaker(self.breaker_threshold, self.breaker_reset))
+		return breaker
+
+	def _buckets_for(self, url, auth, parent_sid):
+		account_sid = self.account_for(url, auth)
+		if account_sid is None or account_sid == parent_sid:
+			return [self._parent_bucket(parent_sid)]
+		buckets = [self._bucket(account_sid, self.account_rate)]
+		if parent_sid:
+			buckets.append(self._parent_bucket(parent_sid))
+		return buckets
+
+	def acquire(self, url, auth=None, parent_sid=None):
+		"""
+		Check the circuit and take the tokens for one call. Returns the seconds to wait
+		before sending it, or raises TwilioUnavailableError if that is more than max_wait.
+		"""
+		buckets = self._buckets_for(url, auth, parent_sid)
+		# Fail fast without queueing behind a long Retry-After
+		wait = max(bucket.delay() for bucket in buckets)
+		if wait > self.max_wait:
+			raise TwilioUnavailableError('Twilio is rate limiting requests, try again later', retry_after=max(1, round(wait)))
+		host = urlsplit(url).netloc
+		self._breaker(host).check(host)
+		return max(bucket.reserve() for bucket in buckets)
+
+	def record(self, url, auth, parent_sid, status, retry_after=None):
+		"""Adapt to the outcome of a call. status is None when no response was received."""
+		breaker = self._breaker(urlsplit(url).netloc)
+		if status is None or status >= 500:
+			breaker.failed()
+			return
+		breaker.succeeded()
+		for bucket in self._buckets_for(url, auth, parent_sid):
+			if status == 429:
+				bucket.throttle(retry_after)
+			else:
+				bucket.succeeded()
+
+	@staticmethod
+	def backoff(attempt, retry_after=None):
+		# Full jitter so throttled callers don't retry in lockstep, never sooner than Retry-After
+		return max(retry_after or 0, random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+	def stats(self):
+		with self._lock:
+			buckets = dict(self._buckets)
+			breakers = dict(self._breakers)
+		return {
+			'buckets': {sid: {'rate': bucket.rate, 'max_rate': bucket.max_rate, 'throttled': bucket.throttled} for sid, bucket in buckets.items()},
+			'breakers': {host: {'state': breaker.state, 'failures': breaker.failures} for host, breaker in breakers.items()}
+		}
+
+def parse_retry_after(value):
+	try:
+		return max(0.0, float(value))
+	except (TypeError, ValueError):
+		return None
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+from twilio.base.exceptions import TwilioRestException
+import os
+from services.job_engine import JobEngine
+from services.job_store import job_store, RUNNING, COMPLETED, FAILED
+from services.phone_number_service import RELEASE_CONCURRENCY
+
+CLOSE_SUBACCOUNT_JOB = 'close_subaccount'
+
+# Number of close jobs processed at the same time
+RELEASE_JOB_WORKERS = int(os.getenv('RELEASE_JOB_WORKERS', '2'))
+
+class ReleaseJobEngine(JobEngine):
+	"""
+	Runs subaccount closes as background jobs: every phone number is released over a
+	bounded worker pool and its progress is recorded in the job store, so an interrupted
+	close can be resumed without releasing anything twice. Every parent account has its own
+	engine and workers.
+	"""
+	kind = CLOSE_SUBACCOUNT_JOB
+	label = 'close'
+
+	def __init__(self, subaccount_service, concurrency=RELEASE_CONCURRENCY, workers=RELEASE_JOB_WORKERS):
+		super().__init__(subaccount_service, concurrency, workers)
+
+	def start_close(self, subaccount_sid, closed):
+		job_id = self._create_job(subaccount_sid, {'closed': bool(closed)})
+		self._submit(job_id)
+		return job_id
+
+	def _execute(self, job_id):
+		job = job_store.get_job(job_id)
+		subaccount_sid = job['subaccount_sid']
+		job_store.update_job(job_id, RUNNING)
+
+		phone_number_service = self._phone_number_service(subaccount_sid)
+
+		# Enumerate the numbers once, a resumed job works from the recorded list
+		if not job_store.has_items(job_id):
+			job_store.add_items(job_id, [pn['sid'] for pn in phone_number_service.list_phone_numbers()])
+
+		pending = job_store.pending_items(job_id)
+		print(f"Releasing {len(pending)} phone numbers for subaccount {subaccount_sid} (job {job_id})")
+
+		def release(phone_number_sid):
+			job_store.update_item(job_id, phone_number_sid, RUNNING)
+			try:
+				phone_number_service.release_phone_number(phone_number_sid)
+			except TwilioRestException as e:
+				# Already gone, e.g. released right before an interruption
+				if e.status != 404:
+					raise
+			job_store.update_item(job_id, phone_number_sid, COMPLETED)
+
+		def release_safely(phone_number_sid):
+			try:
+				release(phone_number_sid)
+			except Exception as e:
+				print(f"Error releasing phone number {phone_number_sid}: {e}")
+				job_store.update_item(job_id, phone_number_sid, FAILED, error=str(e))
+
+		if pending:
+			with ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending))) as executor:
+				list(executor.map(release_safely, pending))
+
+		failed = job_store.get_job(job_id)['progress']['failed']
+		if failed:
+			job_store.update_job(job_id, FAILED, error=f'{failed} phone numbers could not be released')
+			return
+
+		# Close the subaccount by updating its status
+		subaccount = self.subaccount_service.get_account(subaccount_sid)
+		if job['params'].get('closed'):
+			subaccount = subaccount.update(status='closed')
+			self.subaccount_service.account_closed(subaccount)
+
+		job_store.update_job(job_id, COMPLETED, result={
+			'sid': subaccount.sid,
+			'friendly_name': subaccount.friendly_name,
+			'status': subaccount.status
+		})
@@ -0,0 +1,69 @@
+import threading
+
+class _Call:
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+class SingleFlight:
+	"""
+	Collapses concurrent identical reads into one upstream call.
+
+	The first caller for a key runs the function, callers arriving while it is in flight
+	wait for it and get the same result, or the same exception. Nothing is kept once the
+	call returns, a later call runs again. Results are shared between callers, treat them
+	as read-only.
+
+	Works across the threads of one process, including gevent greenlets once threading is
+	monkey-patched.
+	"""
+	def __init__(self):
+		self.leaders = 0
+		self.shared = 0
+		self._calls = {}
+		self._lock = threading.Lock()
+
+	def do(self, key, fn):
+		with self._lock:
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = _Call()
+				self.leaders += 1
+			else:
+				self.shared += 1
+
+		if not leader:
+			call.done.wait()
+			if call.error is not None:
+				raise call.error
+			return call.result
+
+		try:
+			call.result = fn()
+			return call.result
+		except BaseException as e:
+			call.error = e
+			raise
+		finally:
+			with self._lock:
+				if self._calls.get(key) is call:
+					del self._calls[key]
+			call.done.set()
+
+	def forget(self, key):
+		# Callers arriving after this start a new call instead of joining the one in flight,
+		# e.g. after a write that the in-flight read may not see
+		with self._lock:
+			self._calls.pop(key, None)
+
+	def stats(self):
+		with self._lock:
+			calls = self.leaders + self.shared
+			return {
+				'in_flight': len(self._calls),
+				'calls': self.leaders,
+				'shared': self.shared,
+				'shared_ratio': self.shared / calls if calls else None
+			}
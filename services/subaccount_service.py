@@ -1,10 +1,79 @@
-from twilio.rest import Client
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
-from services.phone_number_service import PhoneNumberService
+from services.phone_number_service import PhoneNumberService, extract_phone_number_data
+from services.cache import TTLCache
+from services.single_flight import SingleFlight
+from services.rate_limiter import TwilioUnavailableError
+from services.client_registry import get_client
+from services.metrics import bind_context
+from services.events import event_bus, SUBACCOUNT_CREATED, SUBACCOUNT_UPDATED, SUBACCOUNT_CLOSED
+from services.account_index import AccountIndex, ACCOUNT_PAGE_SIZE
+
+# Upper bound on concurrent badge computations, keeps us under Twilio's rate limits
+BADGE_CONCURRENCY = int(os.getenv('BADGE_CONCURRENCY', '8'))
+
+# Account fetches are cached briefly, auth tokens rarely change so they live longer
+ACCOUNT_CACHE_SIZE = int(os.getenv('ACCOUNT_CACHE_SIZE', '1024'))
+ACCOUNT_CACHE_TTL = int(os.getenv('ACCOUNT_CACHE_TTL', '300'))
+AUTH_TOKEN_CACHE_TTL = int(os.getenv('AUTH_TOKEN_CACHE_TTL', '3600'))
+
+# Reads shared between concurrent callers through SubaccountService.in_flight, keyed by (operation, SID)
+SINGLE_FLIGHT_OPERATIONS = ('account', 'subaccount_info', 'phone_numbers', 'basic_auth_media')
+
+def summarize_emergency_status(phone_numbers_data):
+	"""
+	Reduce the emergency address state of a subaccount's phone numbers to a single badge value.
+	See SubaccountService.check_all_emergencies_registered for the possible values.
+	"""
+	# If there are no phone numbers, return "none"
+	if not phone_numbers_data:
+		return "none"
+	
+	has_pending = False
+	has_failed = False
+	
+	for pn in phone_numbers_data:
+		emergency_address_sid = pn.get('emergency_address_sid')
+		emergency_address_status = pn.get('emergency_address_status')
+		
+		# If no emergency address at all, it's failed
+		if not emergency_address_sid:
+			has_failed = True
+			continue
+		
+		# Check the emergency_address_status field from the phone number
+		if emergency_address_status == 'registered':
+			# This is good, continue checking others
+			continue
+		elif emergency_address_status in ['pending-verification', 'pending', 'in-review']:
+			has_pending = True
+		else:
+			# Any other status (failed, rejected, etc.) or None is treated as failed
+			has_failed = True
+	
+	# Return status based on priority: failed > pending > registered
+	if has_failed:
+		return "failed"
+	elif has_pending:
+		return "pending"
+	else:
+		return "registered"
 
 class SubaccountService:
-	def __init__(self):
-		self.client = Client(os.getenv('TWILIO_ACCOUNT_SID'), os.getenv('TWILIO_AUTH_TOKEN'))
+	def __init__(self, parent=None):
+		# parent: ParentAccount whose subaccounts are managed, the default parent if None
+		self.parent = parent
+		self.badge_concurrency = (parent.badge_concurrency if parent else None) or BADGE_CONCURRENCY
+		self.account_cache = TTLCache(maxsize=ACCOUNT_CACHE_SIZE, ttl=ACCOUNT_CACHE_TTL)
+		self.auth_token_cache = TTLCache(maxsize=ACCOUNT_CACHE_SIZE, ttl=AUTH_TOKEN_CACHE_TTL)
+		self.account_index = AccountIndex(self._load_accounts)
+		# Overlapping UI requests for the same subaccount share one upstream call
+		self.in_flight = SingleFlight()
+
+	@property
+	def client(self):
+		# Shared pooled client for the parent account
+		return get_client(parent=self.parent)
 
 	def list_subaccounts(self, include_badges=False):
 		"""
@@ -15,19 +84,20 @@ class SubaccountService:
 						   This is slower but provides complete information.
 						   If False (default), only returns basic subaccount info for faster loading.
 		"""
-		subaccounts = self.client.api.accounts.list()
+		# Served from the local account index instead of a full Twilio listing
+		subaccounts = self.account_index.all()
 		result = []
 		
 		for sa in subaccounts:
 			subaccount_data = {
-				"sid": sa.sid,
-				"id": sa.friendly_name,
+				"sid": sa['sid'],
+				"id": sa['friendly_name'],
 			}
 			
 			# Only fetch badge data if explicitly requested
 			if include_badges:
-				subaccount_data["allEmergenciesRegistered"] = self.check_all_emergencies_registered(sa.sid, sa.auth_token)
-				subaccount_data["basicAuthMedia"] = self.check_basic_auth_media(sa.sid)
+				subaccount_data["allEmergenciesRegistered"] = self.check_all_emergencies_registered(sa['sid'])
+				subaccount_data["basicAuthMedia"] = self.check_basic_auth_media(sa['sid'])
 			else:
 				# Return null/undefined so frontend knows these haven't been loaded yet
 				subaccount_data["allEmergenciesRegistered"] = None
@@ -37,8 +107,84 @@ class SubaccountService:
 		
 		return result
 
+	def query_subaccounts(self, **params):
+		"""
+		Return one page of subaccounts from the account index, see AccountIndex.query for the parameters.
+		Items have the same shape as list_subaccounts() plus the account status and dates.
+		"""
+		page = self.account_index.query(**params)
+		page['items'] = [{
+			"sid": sa['sid'],
+			"id": sa['friendly_name'],
+			"friendly_name": sa['friendly_name'],
+			"status": sa['status'],
+			"date_created": sa['date_created'],
+			"date_updated": sa['date_updated'],
+			"allEmergenciesRegistered": None,
+			"basicAuthMedia": None
+		} for sa in page['items']]
+		return page
+
+	def _load_accounts(self):
+		# The listing returns full account records, prime the cache with them
+		accounts = list(self.client.api.accounts.stream(page_size=ACCOUNT_PAGE_SIZE))
+		for account in accounts:
+			self._cache_account(account)
+		return accounts
+
+	def get_account(self, subaccount_sid):
+		"""
+		Fetch the account record only, without computing badges. Served from cache when possible.
+		"""
+		account = self.account_cache.get(subaccount_sid)
+		if account is None:
+			account = self.in_flight.do(('account', subaccount_sid), lambda: self._fetch_account(subaccount_sid))
+		return account
+
+	def _fetch_account(self, subaccount_sid):
+		account = self.client.api.accounts(subaccount_sid).fetch()
+		self._cache_account(account)
+		return account
+
+	def get_auth_token(self, subaccount_sid):
+		auth_token = self.auth_token_cache.get(subaccount_sid)
+		if auth_token is None:
+			auth_token = self.get_account(subaccount_sid).auth_token
+		return auth_token
+
+	def invalidate_account(self, subaccount_sid, auth_token=True):
+		self.account_cache.invalidate(subaccount_sid)
+		if auth_token:
+			self.auth_token_cache.invalidate(subaccount_sid)
+		self.forget_in_flight(subaccount_sid)
+
+	def forget_in_flight(self, subaccount_sid):
+		# After a write, later reads must not join a read started before it
+		for operation in SINGLE_FLIGHT_OPERATIONS:
+			self.in_flight.forget((operation, subaccount_sid))
+
+	def cache_stats(self):
+		return {
+			'accounts': self.account_cache.stats(),
+			'auth_tokens': self.auth_token_cache.stats(),
+			'single_flight': self.in_flight.stats()
+		}
+
+	def account_closed(self, account):
+		# Closed accounts can't be used anymore, forget them but keep them listed as closed
+		self.account_index.upsert(account)
+		self.invalidate_account(account.sid)
+		event_bus.publish(SUBACCOUNT_CLOSED, account.sid, friendly_name=account.friendly_name, status=account.status)
+
+	def _cache_account(self, account):
+		self.account_cache.set(account.sid, account)
+		self.auth_token_cache.set(account.sid, account.auth_token)
+
 	def get_subaccount_info(self, subaccount_sid):
-		res = self.client.api.accounts(subaccount_sid).fetch()
+		return self.in_flight.do(('subaccount_info', subaccount_sid), lambda: self._get_subaccount_info(subaccount_sid))
+
+	def _get_subaccount_info(self, subaccount_sid):
+		res = self.get_account(subaccount_sid)
 		
 		# Check if all phone numbers have emergency addresses registered
 		all_emergencies_registered = self.check_all_emergencies_registered(subaccount_sid, res.auth_token)
@@ -56,44 +202,68 @@ class SubaccountService:
 	
 	def get_phone_number_info(self, subaccount_sid, phone_number_sid):
 		# Initialize the PhoneNumberService with the subaccount SID and auth token
-		subaccount_info = self.get_subaccount_info(subaccount_sid)
-		subaccount = subaccount_info['account_instance']
-		phone_number_service = PhoneNumberService(subaccount.sid, subaccount_auth_token=subaccount.auth_token)
+		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=self.get_auth_token(subaccount_sid), parent=self.parent)
 		phone_number = phone_number_service.get_phone_number_info(phone_number_sid)
 
 		# Return a dictionary with relevant info
-		return {
-			'sid': phone_number.sid,
-			'phone_number': phone_number.phone_number,
-			'friendly_name': phone_number.friendly_name,
-			'date_created': phone_number.date_created,
-			'status': phone_number.status,
-			'emergency_address_sid': phone_number.emergency_address_sid,
-		}
+		return extract_phone_number_data(phone_number)
 
-	def get_phone_numbers(self, subaccount_sid, subaccount_auth_token=None): 
+	def get_phone_numbers(self, subaccount_sid, subaccount_auth_token=None, page_size=None): 
 		# Initialize the PhoneNumberService with the subaccount SID and auth token
 		if subaccount_auth_token is None:
-			subaccount_info = self.get_subaccount_info(subaccount_sid)
-			subaccount = subaccount_info['account_instance']
-			subaccount_auth_token = subaccount.auth_token
-		
-		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=subaccount_auth_token)
-		phone_numbers = phone_number_service.list_phone_numbers()
-		phone_numbers_data = []
-		for phone_number in phone_numbers:
-			raw_data = phone_number_service.get_phone_number_info(phone_number['sid'])
-			phone_numbers_data.append({
-			'sid': raw_data.sid,
-			'phone_number': raw_data.phone_number,
-			'friendly_name': raw_data.friendly_name,
-			'date_created': raw_data.date_created,
-			'status': raw_data.status,
-			'emergency_address_sid': raw_data.emergency_address_sid,
-			'emergency_address_status': getattr(raw_data, 'emergency_address_status', None),
-		})
-
-		return phone_numbers_data
+			subaccount_auth_token = self.get_auth_token(subaccount_sid)
+		
+		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=subaccount_auth_token, parent=self.parent)
+		
+		# One paged listing, no per-number fetch. The page size doesn't change the result,
+		# so concurrent listings of the same subaccount share one call.
+		return self.in_flight.do(
+			('phone_numbers', subaccount_sid),
+			lambda: phone_number_service.list_phone_numbers_details(page_size=page_size)
+		)
+	
+	def get_badges(self, subaccount_sid):
+		return {
+			'sid': subaccount_sid,
+			'allEmergenciesRegistered': self.check_all_emergencies_registered(subaccount_sid, self.get_auth_token(subaccount_sid)),
+			'basicAuthMedia': self.check_basic_auth_media(subaccount_sid)
+		}
+
+	def iter_badges(self, subaccount_sids, max_workers=None):
+		"""
+		Compute badges for many subaccounts over a bounded worker pool.
+		
+		Args:
+			subaccount_sids: SIDs to compute badges for. Duplicates are only computed once.
+			max_workers: Requested concurrency, capped at the parent's badge concurrency (BADGE_CONCURRENCY by default).
+		
+		Yields one result per SID as soon as it finishes. A failing SID yields
+		{'sid': ..., 'error': ...} instead of aborting the whole batch.
+		"""
+		subaccount_sids = list(dict.fromkeys(subaccount_sids))
+		if not subaccount_sids:
+			return
+		
+		workers = min(max_workers or self.badge_concurrency, self.badge_concurrency, len(subaccount_sids))
+		executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+		try:
+			get_badges = bind_context(self.get_badges)
+			futures = {executor.submit(get_badges, sid): sid for sid in subaccount_sids}
+			for future in as_completed(futures):
+				sid = futures[future]
+				try:
+					yield future.result()
+				except Exception as e:
+					print(f"Error computing badges for subaccount {sid}: {e}")
+					yield {
+						'sid': sid,
+						'allEmergenciesRegistered': None,
+						'basicAuthMedia': None,
+						'error': str(e)
+					}
+		finally:
+			# Stop pending work if the consumer goes away (e.g. client disconnected)
+			executor.shutdown(wait=False, cancel_futures=True)
 	
 	def check_all_emergencies_registered(self, subaccount_sid, subaccount_auth_token=None):
 		"""
@@ -108,40 +278,11 @@ class SubaccountService:
 			# Get phone numbers with their emergency address status
 			phone_numbers_data = self.get_phone_numbers(subaccount_sid, subaccount_auth_token)
 			
-			# If there are no phone numbers, return "none"
-			if not phone_numbers_data:
-				return "none"
-			
-			has_pending = False
-			has_failed = False
-			
-			for pn in phone_numbers_data:
-				emergency_address_sid = pn.get('emergency_address_sid')
-				emergency_address_status = pn.get('emergency_address_status')
-				
-				# If no emergency address at all, it's failed
-				if not emergency_address_sid:
-					has_failed = True
-					continue
-				
-				# Check the emergency_address_status field from the phone number
-				if emergency_address_status == 'registered':
-					# This is good, continue checking others
-					continue
-				elif emergency_address_status in ['pending-verification', 'pending', 'in-review']:
-					has_pending = True
-				else:
-					# Any other status (failed, rejected, etc.) or None is treated as failed
-					has_failed = True
-			
-			# Return status based on priority: failed > pending > registered
-			if has_failed:
-				return "failed"
-			elif has_pending:
-				return "pending"
-			else:
-				return "registered"
+			return summarize_emergency_status(phone_numbers_data)
 				
+		except TwilioUnavailableError:
+			# Not a badge state, let the caller report Twilio as unavailable
+			raise
 		except Exception as e:
 			print(f"Error checking emergency addresses for subaccount {subaccount_sid}: {e}")
 			return "failed"
@@ -158,46 +299,58 @@ class SubaccountService:
 		try:
 			# Check if the account has any SIP credential lists
 			# This indicates that authentication is required for media access
-			credential_lists = self.client.api.accounts(subaccount_sid).sip.credential_lists.list(limit=1)
+			credential_lists = self.in_flight.do(
+				('basic_auth_media', subaccount_sid),
+				lambda: self.client.api.accounts(subaccount_sid).sip.credential_lists.list(limit=1)
+			)
 			
 			# If there are credential lists, basic auth is enabled
 			has_credential_lists = len(credential_lists) > 0
 			
 			return has_credential_lists
+		except TwilioUnavailableError:
+			raise
 		except Exception as e:
 			print(f"Error checking basic auth media for subaccount {subaccount_sid}: {e}")
 			return False
 	
 	def create_subaccount(self, friendly_name):
-		return self.client.api.accounts.create(friendly_name=friendly_name)
+		subaccount = self.client.api.accounts.create(friendly_name=friendly_name)
+		self._cache_account(subaccount)
+		self.account_index.upsert(subaccount)
+		event_bus.publish(SUBACCOUNT_CREATED, subaccount.sid, friendly_name=subaccount.friendly_name, status=subaccount.status)
+		return subaccount
 
 	def update_subaccount(self, subaccount_sid, friendly_name):
-		subaccount = self.client.api.accounts(subaccount_sid).fetch()
-		return subaccount.update(friendly_name=friendly_name)
+		# Drop the cached record, the auth token is unaffected by a rename
+		self.invalidate_account(subaccount_sid, auth_token=False)
+		subaccount = self.client.api.accounts(subaccount_sid).update(friendly_name=friendly_name)
+		self._cache_account(subaccount)
+		self.account_index.upsert(subaccount)
+		event_bus.publish(SUBACCOUNT_UPDATED, subaccount.sid, friendly_name=subaccount.friendly_name, status=subaccount.status)
+		return subaccount
 	
 	def release_phone_number(self, subaccount_sid, phone_number_sid): 
 		# Initialize the PhoneNumberService with the subaccount SID and auth token
-		subaccount_info = self.get_subaccount_info(subaccount_sid)
-		subaccount = subaccount_info['account_instance']
-		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=subaccount.auth_token)
+		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=self.get_auth_token(subaccount_sid), parent=self.parent)
 		# Release the specified phone number
-		return phone_number_service.release_phone_number(phone_number_sid)
+		message = phone_number_service.release_phone_number(phone_number_sid)
+		self.forget_in_flight(subaccount_sid)
+		return message
 	
-	def remove_emergency_address(self, subaccount_sid, phone_number):
-		subaccount_info = self.get_subaccount_info(subaccount_sid)
-		subaccount = subaccount_info['account_instance']
-		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=subaccount.auth_token)
-		phone_number_sid = self.get_phone_number_info(subaccount_sid, phone_number)['sid']
+	def remove_emergency_address(self, subaccount_sid, phone_number_sid):
+		# Updated by SID directly, fetching the number first would only return the same SID
+		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=self.get_auth_token(subaccount_sid), parent=self.parent)
 		message = phone_number_service.remove_emergency_address(phone_number_sid)
+		self.forget_in_flight(subaccount_sid)
 		return message
 
 	def close_subaccount(self, subaccount_sid, closed):
 		# Fetch the subaccount
-		subaccount_info = self.get_subaccount_info(subaccount_sid)
-		subaccount = subaccount_info['account_instance']
+		subaccount = self.get_account(subaccount_sid)
 		
 		# Initialize the PhoneNumberService with the subaccount SID
-		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=subaccount.auth_token)
+		phone_number_service = PhoneNumberService(subaccount_sid, subaccount_auth_token=subaccount.auth_token, parent=self.parent)
 		
 		# Release all phone numbers associated with the subaccount
 		phone_number_service.release_all_phone_numbers()
@@ -205,6 +358,7 @@ class SubaccountService:
 		# Close the subaccount by updating its status
 		if closed:
 			updated_subaccount = subaccount.update(status='closed')
+			self.account_closed(updated_subaccount)
 			return updated_subaccount
 		else:
 			return subaccount
@@ -0,0 +1,272 @@
+from twilio.base.exceptions import TwilioRestException
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from services.db import ensure_schema
+from services.job_store import process_owner, PENDING, RUNNING, COMPLETED, FAILED
+from services.rate_limiter import TwilioUnavailableError
+
+# Attempts per event before it is left failed
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '5'))
+# Seconds before the first retry, doubled after every failed attempt
+WEBHOOK_RETRY_DELAY = float(os.getenv('WEBHOOK_RETRY_DELAY', '10'))
+# Processed events are kept this many seconds so redeliveries are still recognised
+WEBHOOK_RETENTION = int(os.getenv('WEBHOOK_RETENTION', str(7 * 24 * 3600)))
+# Seconds between two polls of the queue when nothing wakes the consumer up
+WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', '30'))
+# A claimed event still running after this many seconds was left by a process that stopped, it is queued again
+WEBHOOK_CLAIM_TIMEOUT = float(os.getenv('WEBHOOK_CLAIM_TIMEOUT', '300'))
+
+# Payload fields read as text: the Message-ID is looked for in headers, the account ID in the others
+TEXT_FIELDS = ('headers', 'text', 'html', 'email')
+
+ACCOUNT_ID_PATTERN = re.compile(r'Id: (\w+)')
+MESSAGE_ID_PATTERN = re.compile(r'^Message-ID:\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+	id TEXT PRIMARY KEY,
+	payload TEXT NOT NULL,
+	status TEXT NOT NULL,
+	account_sid TEXT,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	next_attempt_at REAL NOT NULL,
+	error TEXT,
+	received_at REAL NOT NULL,
+	updated_at REAL NOT NULL,
+	claimed_by TEXT,
+	claimed_at REAL
+);
+CREATE INDEX IF NOT EXISTS webhook_events_status ON webhook_events (status, next_attempt_at);
+"""
+# Columns of tables created before claims were recorded
+ADDED_COLUMNS = {'webhook_events': [('claimed_by', 'TEXT'), ('claimed_at', 'REAL')]}
+
+def check_payload(payload):
+	# Raises ValueError for a payload the queue can't process
+	if not isinstance(payload, dict):
+		raise ValueError('The payload must be an object')
+	for field in TEXT_FIELDS:
+		if payload.get(field) is not None and not isinstance(payload[field], str):
+			raise ValueError(f'{field} must be a string')
+
+def webhook_event_id(payload):
+	"""
+	Identify a delivery so redeliveries of the same email are recognised: its Message-ID
+	header when SendGrid forwarded the headers, otherwise a hash of the payload.
+	"""
+	match = MESSAGE_ID_PATTERN.search(payload.get('headers') or '')
+	if match:
+		return match.group(1).strip('<>')
+	return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def extract_account_id(payload):
+	# The account ID is in the email text, e.g. "Id: AC..."
+	for field in ('text', 'html', 'email'):
+		match = ACCOUNT_ID_PATTERN.search(payload.get(field) or '')
+		if match:
+			return match.group(1)
+	match = ACCOUNT_ID_PATTERN.search(json.dumps(payload))
+	return match.group(1) if match else None
+
+class WebhookQueue:
+	"""
+	Durable queue of received webhook events, de-duplicated by event ID.
+
+	Claimed events record the claiming process and when, so events claimed by a process
+	that is still running them aren't queued again by another one.
+	"""
+	def _db(self):
+		return ensure_schema('webhook_events', SCHEMA, ADDED_COLUMNS)
+
+	def enqueue(self, event_id, payload):
+		# Returns False for a delivery that was already received
+		now = time.time()
+		cursor = self._db().execute(
+			'INSERT OR IGNORE INTO webhook_events (id, payload, status, next_attempt_at, received_at, updated_at) '
+			'VALUES (?, ?, ?, ?, ?, ?)',
+			(event_id, json.dumps(payload), PENDING, now, now, now)
+		)
+		return cursor.rowcount == 1
+
+	def claim(self, limit=10):
+		# Take the events that are due, oldest first
+		db = self._db()
+		with db:
+			db.execute('BEGIN IMMEDIATE')
+			rows = db.execute(
+				'SELECT * FROM webhook_events WHERE status = ? AND next_attempt_at <= ? ORDER BY received_at LIMIT ?',
+				(PENDING, time.time(), limit)
+			).fetchall()
+			now = time.time()
+			db.executemany(
+				'UPDATE webhook_events SET status = ?, attempts = attempts + 1, claimed_by = ?, claimed_at = ?, updated_at = ? WHERE id = ?',
+				[(RUNNING, process_owner(), now, now, row['id']) for row in rows]
+			)
+		events = [self._to_event(row) for row in rows]
+		for event in events:
+			event['status'] = RUNNING
+			event['attempts'] += 1
+		return events
+
+	def complete(self, event_id, account_sid=None):
+		self._db().execute(
+			'UPDATE webhook_events SET status = ?, account_sid = ?, error = NULL, updated_at = ? WHERE id = ?',
+			(COMPLETED, account_sid, time.time(), event_id)
+		)
+
+	def fail(self, event_id, error, retry_in=None):
+		# With retry_in the event goes back to the queue, otherwise it stays failed
+		now = time.time()
+		self._db().execute(
+			'UPDATE webhook_events SET status = ?, error = ?, next_attempt_at = ?, updated_at = ? WHERE id = ?',
+			(PENDING if retry_in is not None else FAILED, error, now + (retry_in or 0), now, event_id)
+		)
+
+	def next_attempt_in(self):
+		# Seconds until the next pending event is due, None when the queue is empty
+		row = self._db().execute('SELECT MIN(next_attempt_at) AS due FROM webhook_events WHERE status = ?', (PENDING,)).fetchone()
+		return None if row['due'] is None else max(0.0, row['due'] - time.time())
+
+	def requeue_interrupted(self, timeout=WEBHOOK_CLAIM_TIMEOUT):
+		# Events claimed by a process that stopped before finishing them, those of running processes are left alone
+		now = time.time()
+		cursor = self._db().execute(
+			'UPDATE webhook_events SET status = ?, claimed_by = NULL, claimed_at = NULL, updated_at = ? '
+			'WHERE status = ? AND (claimed_at IS NULL OR claimed_at < ?)',
+			(PENDING, now, RUNNING, now - timeout)
+		)
+		return cursor.rowcount
+
+	def prune(self, max_age=WEBHOOK_RETENTION):
+		self._db().execute(
+			'DELETE FROM webhook_events WHERE status IN (?, ?) AND updated_at < ?',
+			(COMPLETED, FAILED, time.time() - max_age)
+		)
+
+	def get(self, event_id):
+		row = self._db().execute('SELECT * FROM webhook_events WHERE id = ?', (event_id,)).fetchone()
+		return self._to_event(row) if row else None
+
+	def counts(self):
+		rows = self._db().execute('SELECT status, COUNT(*) AS count FROM webhook_events GROUP BY status').fetchall()
+		return {row['status']: row['count'] for row in rows}
+
+	@staticmethod
+	def _to_event(row):
+		return {
+			'id': row['id'],
+			'payload': json.loads(row['payload']),
+			'status': row['status'],
+			'account_sid': row['account_sid'],
+			'attempts': row['attempts'],
+			'error': row['error'],
+			'received_at': row['received_at'],
+			'updated_at': row['updated_at']
+		}
+
+class WebhookConsumer:
+	"""
+	Background consumer of the webhook queue.
+
+	For every subaccount-created email it extracts the account ID, fetches the new subaccount
+	(which caches it and adds it to the account index) and computes its badges into the badge
+	store, so the subaccount is ready when it is first opened. Failed events are retried with
+	exponential backoff, up to WEBHOOK_MAX_ATTEMPTS attempts.
+
+	Args:
+		subaccount_services: Callable returning the SubaccountService of every parent account,
+			the default parent first. The email doesn't say which parent the subaccount belongs
+			to, it is looked up in each of them.
+	"""
+	def __init__(self, subaccount_services, badge_store, queue=None, poll_interval=WEBHOOK_POLL_INTERVAL):
+		self.subaccount_services = subaccount_services
+		self.badge_store = badge_store
+		self.queue = queue or webhook_queue
+		self.poll_interval = poll_interval
+		self._wakeup = threading.Event()
+		self._stopped = threading.Event()
+		self._lock = threading.Lock()
+		self._thread = None
+
+	def start(self):
+		with self._lock:
+			if self._thread is None or not self._thread.is_alive():
+				self._stopped.clear()
+				self.queue.requeue_interrupted()
+				self._thread = threading.Thread(target=self._loop, name='webhook-consumer', daemon=True)
+				self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		self._wakeup.set()
+
+	def wake(self):
+		self._wakeup.set()
+
+	def _loop(self):
+		while not self._stopped.is_set():
+			try:
+				# Keep going while there is a backlog
+				while self.run_once() and not self._stopped.is_set():
+					pass
+				self.queue.requeue_interrupted()
+				self.queue.prune()
+			except Exception as e:
+				print(f"Error consuming webhook events: {e}")
+			# Sleep until the next retry is due, or until a new event arrives
+			try:
+				next_attempt_in = self.queue.next_attempt_in()
+			except Exception:
+				next_attempt_in = None
+			self._wakeup.wait(self.poll_interval if next_attempt_in is None else min(self.poll_interval, next_attempt_in))
+			self._wakeup.clear()
+
+	def run_once(self, limit=10):
+		events = self.queue.claim(limit)
+		for event in events:
+			self.process(event)
+		return len(events)
+
+	def process(self, event):
+		account_id = extract_account_id(event['payload'])
+		if not account_id:
+			print(f"No Account ID found in webhook event {event['id']}")
+			self.queue.fail(event['id'], 'No Account ID found')
+			return
+
+		try:
+			subaccount_service, account = self._find_account(account_id)
+			subaccount_service.account_index.upsert(account)
+			self.badge_store.save(subaccount_service.get_badges(account_id))
+		except Exception as e:
+			if event['attempts'] >= WEBHOOK_MAX_ATTEMPTS:
+				print(f"Giving up on webhook event {event['id']} for account {account_id}: {e}")
+				self.queue.fail(event['id'], str(e))
+				return
+			retry_in = WEBHOOK_RETRY_DELAY * 2 ** (event['attempts'] - 1)
+			if isinstance(e, TwilioUnavailableError) and e.retry_after:
+				retry_in = max(retry_in, e.retry_after)
+			print(f"Error processing webhook event {event['id']} for account {account_id}, retrying in {retry_in:.0f}s: {e}")
+			self.queue.fail(event['id'], str(e), retry_in=retry_in)
+			return
+
+		print(f"Subaccount {account_id} created, badges pre-warmed")
+		self.queue.complete(event['id'], account_id)
+
+	def _find_account(self, account_id):
+		# Another parent's subaccount can't be fetched, the first parent that can fetch it owns it
+		not_found = None
+		for subaccount_service in self.subaccount_services():
+			try:
+				return subaccount_service, subaccount_service.get_account(account_id)
+			except TwilioRestException as e:
+				if e.status not in (401, 403, 404):
+					raise
+				not_found = e
+		raise not_found
+
+webhook_queue = WebhookQueue()
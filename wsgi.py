@@ -0,0 +1,16 @@
+"""
+Entry point for WSGI servers, e.g. gunicorn --preload wsgi:app
+
+.env is loaded before api.py is imported so the settings the services read at import
+(pool sizes, rate limits, cache TTLs) see it too. Importing api.py itself has no side
+effects beyond building the app: Twilio clients, HTTP sessions and worker threads are
+created on first use in each worker process, so preloading and forking is safe.
+"""
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from api import app  # noqa: E402
+
+if __name__ == '__main__':
+	app.run(debug=True)